@@ -8,6 +8,7 @@ from werkzeug.exceptions import HTTPException
 from flask import current_app
 
 from jobserv.api.build import blueprint as build_bp
+from jobserv.api.build_status import blueprint as build_status_bp
 from jobserv.api.github import blueprint as github_bp
 from jobserv.api.gitlab import blueprint as gitlab_bp
 from jobserv.api.health import blueprint as health_bp
@@ -22,6 +23,7 @@ BLUEPRINTS = (
     project_bp,
     project_triggers_bp,
     build_bp,
+    build_status_bp,
     run_bp,
     test_bp,
     worker_bp,
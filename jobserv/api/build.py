@@ -2,22 +2,65 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 import logging
 from flask import Blueprint, request, url_for
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 
 from jobserv.flask import permissions
 from jobserv.settings import BUILD_URL_FMT
 from jobserv.storage import Storage
-from jobserv.jsend import ApiError, get_or_404, jsendify, paginate, paginate_custom
-from jobserv.models import Build, BuildStatus, Project, Run, TriggerTypes, db
+from jobserv.jsend import (
+    ApiError,
+    get_or_404,
+    jsendify,
+    jsendify_cached,
+    paginate,
+    paginate_custom,
+)
+from jobserv.models import (
+    Artifact,
+    Build,
+    BuildStatus,
+    Project,
+    Run,
+    Test,
+    TriggerTypes,
+    db,
+)
 from jobserv.trigger import trigger_build
+from jobserv.urls import external_url
 
 blueprint = Blueprint("api_build", __name__, url_prefix="/projects/<project:proj>")
 
+# Build.as_json walks each run's tests. Loading them up front keeps the
+# number of queries from growing with the runs in a build.
+_build_json_options = (
+    joinedload(Build.project),
+    selectinload(Build.runs).selectinload(Run.tests),
+)
+_build_detail_options = _build_json_options + (selectinload(Build.status_events),)
+_promoted_json_options = _build_detail_options + (
+    selectinload(Build.runs).selectinload(Run.tests).selectinload(Test.results),
+    selectinload(Build.runs).selectinload(Run.artifacts),
+)
+
 
 @blueprint.route("/builds/", methods=("GET",))
 def build_list(proj):
     p = get_or_404(Project.query.filter(Project.name == proj))
     q = Build.query.filter_by(proj_id=p.id).order_by(Build.id.desc())
-    return paginate("builds", q)
+
+    def approx_total():
+        # build numbers are handed out in order, so the latest one is the
+        # count give or take deleted builds. It's a single index lookup.
+        latest = db.session.query(func.max(Build.build_id))
+        return latest.filter_by(proj_id=p.id).scalar() or 0
+
+    return paginate(
+        "builds",
+        q.options(*_build_json_options),
+        cursor_column=Build.id,
+        approx_total=approx_total,
+    )
 
 
 @blueprint.route("/builds/", methods=("POST",))
@@ -88,6 +131,7 @@ def build_patch(proj, build_id):
     annotation = d.get("annotation")
     if annotation:
         b.annotation = annotation
+        b.bump_version()
         db.session.commit()
         return jsendify({}), 200
 
@@ -96,9 +140,13 @@ def build_patch(proj, build_id):
 
 @blueprint.route("/builds/<int:build_id>/", methods=("GET",))
 def build_get(proj, build_id):
-    p = get_or_404(Project.query.filter(Project.name == proj))
-    b = get_or_404(Build.query.filter(Build.project == p, Build.build_id == build_id))
-    return jsendify({"build": b.as_json(detailed=True)})
+    def render():
+        p = get_or_404(Project.query.filter(Project.name == proj))
+        q = Build.query.options(*_build_detail_options)
+        b = get_or_404(q.filter(Build.project == p, Build.build_id == build_id))
+        return {"build": b.as_json(detailed=True)}
+
+    return jsendify_cached(Build.cache_version(proj, build_id), render)
 
 
 @blueprint.route("/builds/<int:build_id>/project.yml", methods=("GET",))
@@ -124,7 +172,7 @@ def build_get_latest(proj):
     trigger = request.args.get("trigger_name")
     if trigger:
         qs = qs.filter(Build.trigger_name == trigger)
-    b = get_or_404(qs.order_by(Build.id.desc()))
+    b = get_or_404(qs.options(*_build_detail_options).order_by(Build.id.desc()))
     return jsendify({"build": b.as_json(detailed=True)})
 
 
@@ -154,6 +202,7 @@ def build_promote(proj, build_id):
     b.status = BuildStatus.PROMOTED
     b.name = data.get("name")
     b.annotation = data.get("annotation")
+    b.bump_version()
     db.session.commit()
     return jsendify({}, 201)
 
@@ -168,15 +217,14 @@ def _promoted_as_json(storage, build):
             test = t.as_json(detailed=True)
             test["name"] = "%s-%s" % (run.name, test["name"])
             rv["tests"].append(test)
-        for a in storage.list_artifacts(run):
+        for a in Artifact.listing(storage, run):
             if v2:
-                u = url_for(
+                u = external_url(
                     "api_run.run_get_artifact",
                     proj=build.project.name,
                     build_id=build.build_id,
                     run=run.name,
                     path=a["name"],
-                    _external=True,
                 )
                 rv["artifacts"].append({"url": u, "size_bytes": a["size_bytes"]})
             else:
@@ -191,16 +239,25 @@ def promoted_build_list(proj):
         Build.query.filter(Build.proj_id == p.id)
         .filter(Build.status == BuildStatus.PROMOTED)
         .order_by(Build.id.desc())
+        .options(*_promoted_json_options)
     )
 
     s = Storage()
-    return paginate_custom("builds", q, lambda x: _promoted_as_json(s, x))
+    return paginate_custom(
+        "builds",
+        q,
+        lambda x: _promoted_as_json(s, x),
+        cursor_column=Build.id,
+        stream=True,
+    )
 
 
 @blueprint.route("/promoted-builds/<name>/", methods=("GET",))
 def promoted_build_get(proj, name):
     b = get_or_404(
-        Build.query.join(Project).filter(
+        Build.query.options(*_promoted_json_options)
+        .join(Project)
+        .filter(
             Project.name == proj,
             Build.status == BuildStatus.PROMOTED,
             Build.name == name,
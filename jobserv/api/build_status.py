@@ -0,0 +1,376 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+import datetime
+import heapq
+from itertools import groupby, islice
+import threading
+import time
+
+from flask import Blueprint, current_app, request, stream_with_context
+from sqlalchemy import select, text, tuple_, union
+
+from jobserv.flask import permissions
+from jobserv.jsend import ApiError, jsendify, jsendify_stream
+from jobserv.models import BuildEvents, BuildStatus, Build, Project, Run, RunEvents, db
+from jobserv.settings import EVENT_FEED_MAX_WAIT, EVENT_STREAM_SECONDS
+
+blueprint = Blueprint("api_build_status", __name__, url_prefix="/build-status")
+
+# The most (project, build[, run]) items a single request can ask about
+MAX_ITEMS = 500
+
+# The most events returned at once by the event feed
+MAX_EVENTS = 500
+
+# How often the event feed checks for new events while waiting
+EVENT_POLL_SECONDS = 1
+
+# Event ids are handed out when they're inserted, not when they're committed.
+# A status change is committed along with the triggers and notifications it
+# sets off, so an event can show up well after ones with higher ids. Cursors
+# only move through ids in order. When one is missing, the cursor is held
+# until EVENT_GAP_SECONDS after this process first saw the gap. Gaps behind
+# events older than EVENT_GAP_MAX_AGE can't be a transaction still being
+# committed. They're from rolled back inserts or deleted builds.
+EVENT_GAP_SECONDS = 120
+EVENT_GAP_MAX_AGE = 3600
+
+# How many of the latest events are checked for gaps when starting "from now"
+EVENT_CURSOR_WINDOW = 100
+
+_gaps = {}
+_gaps_lock = threading.Lock()
+_id_step = None
+
+
+def _event_id_step():
+    """MySQL can be configured to hand out ids in steps other than 1."""
+    global _id_step
+    if _id_step is None:
+        _id_step = 1
+        if db.engine.dialect.name == "mysql":
+            q = text("SELECT @@auto_increment_increment")
+            _id_step = db.session.execute(q).scalar() or 1
+    return _id_step
+
+
+def _gap_held(table, last, row):
+    """Should the cursor wait at `last` because the ids between it and
+    `row` may still be committed?"""
+    age = datetime.datetime.utcnow() - (row.time or datetime.datetime.min)
+    if age > datetime.timedelta(seconds=EVENT_GAP_MAX_AGE):
+        return False
+    now = time.monotonic()
+    with _gaps_lock:
+        for key, seen in list(_gaps.items()):
+            if now - seen > EVENT_GAP_MAX_AGE:
+                del _gaps[key]
+        seen = _gaps.setdefault((table.__tablename__, last, row.id), now)
+    return now - seen < EVENT_GAP_SECONDS
+
+
+def _settled(table, last, rows):
+    """Return the rows, in id order after id `last`, up to the first gap
+    that may be an event still being committed."""
+    step = _event_id_step()
+    for i, row in enumerate(rows):
+        if row.id > last + step and _gap_held(table, last, row):
+            return rows[:i]
+        last = row.id
+    return rows
+
+
+def _latest_settled(table):
+    rows = (
+        db.session.query(table.id, table.time)
+        .order_by(table.id.desc())
+        .limit(EVENT_CURSOR_WINDOW)
+        .all()
+    )
+    if not rows:
+        return 0
+    rows.reverse()
+    settled = _settled(table, rows[0].id, rows[1:])
+    return settled[-1].id if settled else rows[0].id
+
+
+def _event_cursor():
+    """The build and run event ids everything up to has been committed.
+    Passing this back as ?since_event= returns the builds that have
+    changed since."""
+    return "%d.%d" % (_latest_settled(BuildEvents), _latest_settled(RunEvents))
+
+
+def _parse_event_cursor(cursor):
+    try:
+        b, r = (int(x) for x in cursor.split("."))
+        return b, r
+    except ValueError:
+        raise ApiError(400, 'Invalid "since_event". It must be an "event_cursor"')
+
+
+def _parse_time(val):
+    try:
+        ts = datetime.datetime.fromisoformat(val)
+    except ValueError:
+        raise ApiError(400, 'Invalid "since". It must be an ISO 8601 timestamp')
+    if ts.tzinfo:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _can_access(proj, build_id):
+    return permissions.project_can_access("%s/builds/%d/" % (proj, build_id))
+
+
+def _build_records(*criterion):
+    """Yield the status of each build matching `criterion` and its runs
+    from a single query."""
+    q = (
+        db.session.query(
+            Project.name,
+            Build.build_id,
+            Build._status,
+            Build.version,
+            Run.name,
+            Run._status,
+        )
+        .select_from(Build)
+        .join(Project, Project.id == Build.proj_id)
+        .outerjoin(Run, Run.build_id == Build.id)
+        .filter(*criterion)
+        .order_by(Build.id, Run.id)
+    )
+    for (proj, build_id), rows in groupby(q, lambda x: (x[0], x[1])):
+        if not _can_access(proj, build_id):
+            continue
+        rows = list(rows)
+        yield {
+            "project": proj,
+            "build": build_id,
+            "status": BuildStatus(rows[0][2]).name,
+            "version": rows[0][3],
+            "runs": {x[4]: BuildStatus(x[5]).name for x in rows if x[4]},
+        }
+
+
+def _run_records(runs):
+    q = (
+        db.session.query(Project.name, Build.build_id, Run.name, Run._status)
+        .select_from(Run)
+        .join(Build, Build.id == Run.build_id)
+        .join(Project, Project.id == Build.proj_id)
+        .filter(tuple_(Project.name, Build.build_id, Run.name).in_(runs))
+        .order_by(Run.id)
+    )
+    for proj, build_id, run, status in q:
+        if _can_access(proj, build_id):
+            yield {
+                "project": proj,
+                "build": build_id,
+                "run": run,
+                "status": BuildStatus(status).name,
+            }
+
+
+@blueprint.route("/", methods=("GET",))
+def build_status_changed():
+    """Return the builds with a build or run event since ?since=<ISO 8601
+    time> or ?since_event=<event_cursor from a previous response>."""
+    since = request.args.get("since")
+    since_event = request.args.get("since_event")
+    if since_event:
+        b, r = _parse_event_cursor(since_event)
+        build_changed = BuildEvents.id > b
+        run_changed = RunEvents.id > r
+    elif since:
+        ts = _parse_time(since)
+        build_changed = BuildEvents.time >= ts
+        run_changed = RunEvents.time >= ts
+    else:
+        raise ApiError(400, 'Missing required parameter: "since" or "since_event"')
+
+    # Taken first so nothing that happens while we query is missed
+    cursor = _event_cursor()
+    changed = union(
+        select(BuildEvents.build_id).where(build_changed),
+        select(Run.build_id)
+        .join(RunEvents, RunEvents.run_id == Run.id)
+        .where(run_changed),
+    )
+    data = {"event_cursor": cursor, "builds": _build_records(Build.id.in_(changed))}
+    return jsendify_stream(data)
+
+
+@blueprint.route("/", methods=("POST",))
+def build_status_query():
+    """Return the status of each item in {"builds": [...]}. An item is
+    [project, build] for a build and its runs or [project, build, run] for a
+    single run. Items that don't exist are left out of the response."""
+    d = request.get_json() or {}
+    items = d.get("builds")
+    if not items or not isinstance(items, list):
+        raise ApiError(400, 'Missing required parameter: "builds"')
+    if len(items) > MAX_ITEMS:
+        raise ApiError(400, 'No more than %d "builds" can be queried' % MAX_ITEMS)
+
+    builds = []
+    runs = []
+    for item in items:
+        if (
+            not isinstance(item, list)
+            or len(item) not in (2, 3)
+            or not isinstance(item[0], str)
+            or not isinstance(item[1], int)
+            or (len(item) == 3 and not isinstance(item[2], str))
+        ):
+            msg = (
+                "Invalid item: %r. It must be [project, build] or [project, build, run]"
+            )
+            raise ApiError(400, msg % (item,))
+        if len(item) == 2:
+            builds.append(tuple(item))
+        else:
+            runs.append(tuple(item))
+
+    data = {"event_cursor": _event_cursor(), "builds": [], "runs": []}
+    if builds:
+        data["builds"] = _build_records(
+            tuple_(Project.name, Build.build_id).in_(builds)
+        )
+    if runs:
+        data["runs"] = _run_records(runs)
+    return jsendify_stream(data)
+
+
+def _events_after(b, r, limit):
+    """Return up to `limit` events after the build event `b` and run event
+    `r` in the order they happened, along with the cursor for them."""
+    builds = (
+        db.session.query(
+            BuildEvents.id,
+            BuildEvents.time,
+            BuildEvents._status,
+            Project.name,
+            Build.build_id,
+        )
+        .join(Build, Build.id == BuildEvents.build_id)
+        .join(Project, Project.id == Build.proj_id)
+        .filter(BuildEvents.id > b)
+        .order_by(BuildEvents.id)
+        .limit(limit)
+        .all()
+    )
+    runs = (
+        db.session.query(
+            RunEvents.id,
+            RunEvents.time,
+            RunEvents._status,
+            Project.name,
+            Build.build_id,
+            Run.name,
+            RunEvents.worker_name,
+        )
+        .join(Run, Run.id == RunEvents.run_id)
+        .join(Build, Build.id == Run.build_id)
+        .join(Project, Project.id == Build.proj_id)
+        .filter(RunEvents.id > r)
+        .order_by(RunEvents.id)
+        .limit(limit)
+        .all()
+    )
+
+    # Each list stays in id order so the cursor never skips an event
+    builds = [("build", x) for x in _settled(BuildEvents, b, builds)]
+    runs = [("run", x) for x in _settled(RunEvents, r, runs)]
+    merged = heapq.merge(builds, runs, key=lambda x: x[1].time or datetime.datetime.min)
+
+    events = []
+    for etype, row in islice(merged, limit):
+        if etype == "build":
+            b = row.id
+        else:
+            r = row.id
+        cursor = "%d.%d" % (b, r)
+        if not _can_access(row[3], row[4]):
+            continue
+        event = {
+            "type": etype,
+            "time": row.time,
+            "project": row[3],
+            "build": row[4],
+            "status": BuildStatus(row[2]).name,
+        }
+        if etype == "run":
+            event["run"] = row[5]
+            event["worker"] = row[6]
+        events.append((cursor, event))
+    return events, "%d.%d" % (b, r)
+
+
+def _event_stream(cursor):
+    """Server-sent events, one for each status change, until
+    EVENT_STREAM_SECONDS is up."""
+    dumps = current_app.json.dumps
+    deadline = time.monotonic() + EVENT_STREAM_SECONDS
+    idle = 0
+    yield "retry: %d\n\n" % (EVENT_POLL_SECONDS * 1000)
+    while time.monotonic() < deadline:
+        events, cursor = _events_after(*_parse_event_cursor(cursor), MAX_EVENTS)
+        for event_id, event in events:
+            yield "id: %s\nevent: %s\ndata: %s\n\n" % (
+                event_id,
+                event["type"],
+                dumps(event),
+            )
+        if not events:
+            idle += EVENT_POLL_SECONDS
+            if idle >= 15:
+                # keep proxies from closing the connection
+                yield ": keepalive\n\n"
+                idle = 0
+            db.session.rollback()  # end the transaction to see new commits
+            time.sleep(EVENT_POLL_SECONDS)
+
+
+@blueprint.route("/events/", methods=("GET",))
+def build_status_events():
+    """A feed of every build and run status change as written by
+    Build.refresh_status and Run.set_status.
+
+    Events after ?since_event=<event_cursor> are returned along with the
+    cursor to ask for the next ones. Without one, the feed starts from
+    now. ?wait=<seconds> long-polls until there are some. Clients asking
+    for text/event-stream get them as server-sent events instead.
+    """
+    cursor = request.args.get("since_event") or request.headers.get("Last-Event-ID")
+    if not cursor:
+        cursor = _event_cursor()
+    _parse_event_cursor(cursor)  # fail now rather than mid-stream
+
+    mimetype = request.accept_mimetypes.best_match(
+        ["application/json", "text/event-stream"]
+    )
+    if mimetype == "text/event-stream":
+        return current_app.response_class(
+            stream_with_context(_event_stream(cursor)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    try:
+        wait = int(request.args.get("wait", "0"))
+        limit = int(request.args.get("limit", "100"))
+    except ValueError:
+        raise ApiError(400, '"wait" and "limit" must be numeric')
+    wait = max(0, min(wait, EVENT_FEED_MAX_WAIT))
+    limit = max(1, min(limit, MAX_EVENTS))
+
+    deadline = time.monotonic() + wait
+    while True:
+        events, cursor = _events_after(*_parse_event_cursor(cursor), limit)
+        if events or time.monotonic() >= deadline:
+            break
+        db.session.rollback()  # end the transaction to see new commits
+        time.sleep(EVENT_POLL_SECONDS)
+    return jsendify({"events": [x[1] for x in events], "event_cursor": cursor})
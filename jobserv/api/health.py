@@ -1,56 +1,27 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
-from flask import Blueprint, url_for
-
-from sqlalchemy import func
+from flask import Blueprint
 
+from jobserv.health import read_snapshot, snapshot
 from jobserv.jsend import jsendify
-from jobserv.models import BuildStatus, Run, db
+from jobserv.urls import external_url
 
 blueprint = Blueprint("api_health", __name__, url_prefix="/health")
 
 
 @blueprint.route("/runs/")
 def run_health():
-    health = {}
-    # get an overall count for each run state
-    vals = db.session.query(Run.status, func.count(Run.status)).group_by(Run.status)
-    health["statuses"] = {BuildStatus(status).name: count for status, count in vals}
-
-    # now give some details about what's queued and what's running
-    health["RUNNING"] = {}
-    health["QUEUED"] = []
+    health = read_snapshot() or snapshot()
 
-    active = (
-        BuildStatus.QUEUED,
-        BuildStatus.RUNNING,
-        BuildStatus.UPLOADING,
-        BuildStatus.CANCELLING,
-    )
-    runs = Run.query.filter(Run.status.in_(active)).order_by(
-        Run.queue_priority.asc(), Run.build_id.asc(), Run.id.asc()
-    )
-    for run in runs:
-        url = url_for(
+    items = list(health["QUEUED"])
+    for runs in health["RUNNING"].values():
+        items.extend(runs)
+    for item in items:
+        item["url"] = external_url(
             "api_run.run_get",
-            proj=run.build.project.name,
-            build_id=run.build.build_id,
-            run=run.name,
-            _external=True,
+            proj=item["project"],
+            build_id=item["build"],
+            run=item["run"],
         )
-        item = {
-            "project": run.build.project.name,
-            "build": run.build.build_id,
-            "run": run.name,
-            "url": url,
-            "created": run.build.status_events[0].time,
-            "host_tag": run.host_tag,
-        }
-
-        if run.status == BuildStatus.QUEUED:
-            health["QUEUED"].append(item)
-        else:
-            worker = run.worker_name or "?"
-            health["RUNNING"].setdefault(worker, []).append(item)
     return jsendify({"health": health})
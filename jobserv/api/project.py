@@ -3,9 +3,16 @@
 
 import json
 from flask import Blueprint, request, url_for
+from sqlalchemy.orm import contains_eager, selectinload
 
 from jobserv.flask import permissions
-from jobserv.jsend import ApiError, get_or_404, jsendify, paginate_custom
+from jobserv.jsend import (
+    ApiError,
+    get_or_404,
+    jsendify,
+    jsendify_stream,
+    paginate_custom,
+)
 from jobserv.models import (
     Build,
     BuildStatus,
@@ -103,6 +110,11 @@ def project_run_history(proj, run):
         Run.query.join(Build, Project)
         .filter(Project.name == proj, Run.name == run)
         .order_by(-Build.id)
+        .options(
+            contains_eager(Run.build).contains_eager(Build.project),
+            selectinload(Run.status_events),
+            selectinload(Run.tests),
+        )
     )
 
     def render(run):
@@ -115,7 +127,7 @@ def project_run_history(proj, run):
                 break
         return r
 
-    return paginate_custom("runs", q, render)
+    return paginate_custom("runs", q, render, cursor_column=Run.id)
 
 
 @blueprint.route("/<project:proj>/triggers/", methods=("GET",))
@@ -129,12 +141,14 @@ def project_trigger_list(proj):
         triggers = [x for x in triggers if x.type == TriggerTypes[t].value]
 
     # Remove the secret values, no need to ever expose them
-    redacted = []
-    for t in triggers:
-        data = t.as_json()
-        data["secrets"] = [{"name": x} for x in (data.get("secrets") or {}).keys()]
-        redacted.append(data)
-    return jsendify(redacted)
+    def redacted():
+        for t in triggers:
+            data = t.as_json()
+            secrets = data.get("secrets") or {}
+            data["secrets"] = [{"name": x} for x in secrets.keys()]
+            yield data
+
+    return jsendify_stream(redacted())
 
 
 @blueprint.route("/<project:proj>/triggers/", methods=("POST",))
@@ -2,9 +2,10 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 from flask import Blueprint, request
+from sqlalchemy.orm import joinedload
 
 from jobserv.flask import permissions
-from jobserv.jsend import jsendify
+from jobserv.jsend import jsendify_stream
 from jobserv.models import ProjectTrigger, TriggerTypes
 
 blueprint = Blueprint("api_project_triggers", __name__, url_prefix="/project-triggers")
@@ -18,5 +19,6 @@ def project_trigger_list():
         t = TriggerTypes[t].value
         query = ProjectTrigger.query.filter(ProjectTrigger.type == t)
     else:
-        query = ProjectTrigger.query.all()
-    return jsendify([x.as_json() for x in query])
+        query = ProjectTrigger.query
+    query = query.options(joinedload(ProjectTrigger.project)).yield_per(500)
+    return jsendify_stream(x.as_json() for x in query)
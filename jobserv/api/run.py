@@ -3,18 +3,30 @@
 
 import json
 import re
+import zlib
 
 import yaml
 
 from flask import Blueprint, current_app, make_response, request, send_file, url_for
+from sqlalchemy.orm import selectinload
 
 from jobserv.flask import permissions
 from jobserv.storage import Storage
-from jobserv.jsend import ApiError, get_or_404, jsendify
-from jobserv.models import db, Build, BuildStatus, Project, Run, Test, TestResult
+from jobserv.jsend import ApiError, get_or_404, jsendify, jsendify_cached
+from jobserv.models import (
+    db,
+    Artifact,
+    Build,
+    BuildStatus,
+    Project,
+    Run,
+    Test,
+    TestResult,
+)
 from jobserv.project import ProjectDefinition
 from jobserv.notify import notify_build_complete_email, notify_build_complete_webhook
 from jobserv.trigger import trigger_runs
+from jobserv.urls import external_url
 
 prefix = "/projects/<project:proj>/builds/<int:build_id>/runs"
 blueprint = Blueprint("api_run", __name__, url_prefix=prefix)
@@ -22,9 +34,13 @@ blueprint = Blueprint("api_run", __name__, url_prefix=prefix)
 
 @blueprint.route("/", methods=("GET",))
 def run_list(proj, build_id):
-    p = get_or_404(Project.query.filter_by(name=proj))
-    b = get_or_404(Build.query.filter_by(project=p, build_id=build_id))
-    return jsendify({"runs": [x.as_json(detailed=False) for x in b.runs]})
+    def render():
+        p = get_or_404(Project.query.filter_by(name=proj))
+        q = Build.query.options(selectinload(Build.runs).selectinload(Run.tests))
+        b = get_or_404(q.filter_by(project=p, build_id=build_id))
+        return {"runs": [x.as_json(detailed=False) for x in b.runs]}
+
+    return jsendify_cached(Build.cache_version(proj, build_id), render)
 
 
 def _get_run(proj, build_id, run):
@@ -39,25 +55,27 @@ def _get_run(proj, build_id, run):
 
 @blueprint.route("/<run>/", methods=("GET",))
 def run_get(proj, build_id, run):
-    r = _get_run(proj, build_id, run)
-    data = r.as_json(detailed=True)
-    artifacts = []
-    v2 = request.args.get("version") == "v2"
-    for a in Storage().list_artifacts(r):
-        u = url_for(
-            "api_run.run_get_artifact",
-            proj=proj,
-            build_id=build_id,
-            run=run,
-            path=a["name"],
-            _external=True,
-        )
-        if v2:
-            artifacts.append({"url": u, "size_bytes": a["size_bytes"]})
-        else:
-            artifacts.append(u)
-    data["artifacts"] = artifacts
-    return jsendify({"run": data})
+    def render():
+        r = _get_run(proj, build_id, run)
+        data = r.as_json(detailed=True)
+        artifacts = []
+        v2 = request.args.get("version") == "v2"
+        for a in Artifact.listing(Storage(), r):
+            u = external_url(
+                "api_run.run_get_artifact",
+                proj=proj,
+                build_id=build_id,
+                run=run,
+                path=a["name"],
+            )
+            if v2:
+                artifacts.append({"url": u, "size_bytes": a["size_bytes"]})
+            else:
+                artifacts.append(u)
+        data["artifacts"] = artifacts
+        return {"run": data}
+
+    return jsendify_cached(Build.cache_version(proj, build_id), render)
 
 
 def _create_triggers(
@@ -248,6 +266,41 @@ def _authenticate_runner(run):
         raise ApiError(401, {"message": "Run has already completed"})
 
 
+def _content_encoding():
+    encoding = request.headers.get("Content-Encoding", "identity")
+    if encoding not in ("gzip", "identity"):
+        raise ApiError(415, {"message": "Unsupported Content-Encoding: " + encoding})
+    return encoding
+
+
+def _gunzip_stream(stream, fout, chunk_size=65536):
+    """Decompress a gzip'd request stream into fout without holding the
+    whole payload in memory."""
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            while chunk:
+                fout.write(d.decompress(chunk, chunk_size))
+                chunk = d.unconsumed_tail
+        fout.write(d.flush())
+    except zlib.error as e:
+        raise ApiError(400, {"message": "Invalid gzip content: %s" % e})
+
+
+def _runner_json():
+    """Like request.get_json(), but handles payloads gzip'd by the runner"""
+    if _content_encoding() == "gzip":
+        try:
+            data = zlib.decompress(request.get_data(), 16 + zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise ApiError(400, {"message": "Invalid gzip content: %s" % e})
+        return json.loads(data) if data else None
+    return request.get_json()
+
+
 @blueprint.route("/<run>/", methods=("POST",))
 def run_update(proj, build_id, run):
     r = _get_run(proj, build_id, run)
@@ -258,15 +311,30 @@ def run_update(proj, build_id, run):
         db.session.commit()
 
     storage = Storage()
-    if request.data:
+    if _content_encoding() == "gzip":
+        with storage.console_logfd(r, "ab") as f:
+            _gunzip_stream(request.stream, f)
+        storage.ship_log_segments(r)
+    elif request.data:
         with storage.console_logfd(r, "ab") as f:
             f.write(request.data)
+        storage.ship_log_segments(r)
 
     metadata = request.headers.get("X-RUN-METADATA")
     if metadata:
         r.meta = metadata
         db.session.commit()
 
+    resources = request.headers.get("X-RUN-RESOURCES")
+    if resources:
+        try:
+            resources = json.loads(resources)
+            for x in Run.RESOURCES:
+                setattr(r, x, int(resources[x]))
+        except (ValueError, KeyError, TypeError) as e:
+            raise ApiError(400, {"message": "Invalid X-RUN-RESOURCES: %s" % e})
+        db.session.commit()
+
     status = request.headers.get("X-RUN-STATUS")
     if status:
         status = BuildStatus[status]
@@ -281,6 +349,8 @@ def run_update(proj, build_id, run):
                 r.set_status(status)
                 if r.complete:
                     _handle_triggers(storage, r)
+            if r.complete:
+                Artifact.index(storage, r)
 
     resp = jsendify({})
     if r.status == BuildStatus.CANCELLING:
@@ -418,6 +488,12 @@ def run_upload(proj, build_id, run):
     if data:
         # determine url expiration, default 1800 = 30 minues
         expiration = request.headers.get("X-URL-EXPIRATION", 1800)
-        urls = Storage().generate_signed(r, data, expiration)
+        resumable = request.args.get("resumable") == "1"
+        # Newer runners send {path: {"sha256": .., "md5": ..} or null} so that
+        # artifacts already stored for the project don't get uploaded again
+        hashes = data if isinstance(data, dict) else None
+        urls = Storage().generate_signed(r, data, expiration, resumable, hashes)
+        Artifact.record_signed(r, urls, hashes)
+        db.session.commit()
 
     return jsendify({"urls": urls})
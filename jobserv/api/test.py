@@ -3,9 +3,14 @@
 
 from flask import Blueprint, request
 
-from jobserv.api.run import _authenticate_runner, _get_run, _handle_triggers
-from jobserv.jsend import jsendify
-from jobserv.models import BuildStatus, Run, Test, TestResult, db
+from jobserv.api.run import (
+    _authenticate_runner,
+    _get_run,
+    _handle_triggers,
+    _runner_json,
+)
+from jobserv.jsend import jsendify, jsendify_cached, jsendify_stream
+from jobserv.models import Artifact, Build, BuildStatus, Run, Test, TestResult, db
 from jobserv.storage import Storage
 
 prefix = "/projects/<project:proj>/builds/<int:build_id>/runs/<run>/tests"
@@ -14,15 +19,24 @@ blueprint = Blueprint("api_test", __name__, url_prefix=prefix)
 
 @blueprint.route("/", methods=("GET",))
 def test_list(proj, build_id, run):
-    r = _get_run(proj, build_id, run)
-    return jsendify({"tests": [x.as_json(detailed=False) for x in r.tests]})
+    def render():
+        r = _get_run(proj, build_id, run)
+        return {"tests": [x.as_json(detailed=False) for x in r.tests]}
+
+    return jsendify_cached(Build.cache_version(proj, build_id), render)
 
 
 @blueprint.route("/<test>/", methods=("GET",))
 def test_get(proj, build_id, run, test):
     r = _get_run(proj, build_id, run)
     t = Test.query.filter_by(run_id=r.id, name=test).first_or_404()
-    return jsendify({"test": t.as_json(detailed=True)})
+    data = t.as_json(detailed=False)
+    # Tests can have many thousands of results, so they are streamed
+    results = (
+        TestResult.query.filter_by(test_id=t.id).order_by(TestResult.id).yield_per(500)
+    )
+    data["results"] = t.results_json(results)
+    return jsendify_stream({"test": data})
 
 
 def create_test_result(test, test_result_dict):
@@ -39,7 +53,7 @@ def test_create(proj, build_id, run, test):
     _authenticate_runner(r)
     context = ""
     status = results = None
-    json = request.get_json()
+    json = _runner_json()
     if json:
         context = json.get("context")
         status = json.get("status")
@@ -70,7 +84,7 @@ def test_update(proj, build_id, run, test):
         t = t.filter(Test.context == context)
     t = t.first_or_404()
 
-    json = request.get_json()
+    json = _runner_json()
     if json:
         msg = json.get("message")
         status = json.get("status")
@@ -94,5 +108,7 @@ def test_update(proj, build_id, run, test):
                     t.run.set_status(run_status)
                     if r.complete:
                         _handle_triggers(storage, r)
+                if r.complete:
+                    Artifact.index(storage, r)
 
     return jsendify({"complete": t.run.complete})
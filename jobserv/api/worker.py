@@ -1,6 +1,7 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import datetime
 import functools
 import json
 import logging
@@ -12,15 +13,17 @@ from jwt.exceptions import PyJWTError
 
 from jobserv.flask import permissions
 from jobserv.jsend import ApiError, get_or_404, jsendify, paginate
-from jobserv.models import Project, Run, Worker, db
+from jobserv.models import BuildStatus, Project, Run, Worker, db
 from jobserv.project import ProjectDefinition
 from jobserv.settings import (
     RUNNER,
+    RUNNER_VERSION,
     SIMULATOR_SCRIPT,
     SIMULATOR_SCRIPT_VERSION,
     WORKER_DISK_FREE_THRESHOLD_BYTES,
     WORKER_SCRIPT,
     WORKER_SCRIPT_VERSION,
+    WORKER_STAGING_SECONDS,
 )
 from jobserv.storage import Storage
 from jobserv.worker_jwt import worker_from_jwt
@@ -77,7 +80,8 @@ def worker_authenticated(f):
 @blueprint.route("workers/", methods=("GET",))
 def worker_list():
     permissions.assert_worker_list()
-    return paginate("workers", Worker.query.filter_by(deleted=False))
+    q = Worker.query.filter_by(deleted=False)
+    return paginate("workers", q, cursor_column=Worker.name, descending=False)
 
 
 def _fix_run_urls(rundef):
@@ -88,12 +92,36 @@ def _fix_run_urls(rundef):
 
     rundef["run_url"] = public + urllib.parse.urlparse(rundef["run_url"]).path
     rundef["runner_url"] = public + urllib.parse.urlparse(rundef["runner_url"]).path
+    if RUNNER_VERSION:
+        # lets a worker with this version cached skip the download
+        rundef["runner_url"] += "?version=" + RUNNER_VERSION
     rundef["env"]["H_RUN_URL"] = rundef["run_url"]
     url = rundef["env"].get("H_TRIGGER_URL")
     if url:
         rundef["env"]["H_TRIGGER_URL"] = public + urllib.parse.urlparse(url).path
 
 
+def _stage_run(w):
+    """Reserve the worker's next run while its current one is uploading so
+    that it can prefetch what the run will need."""
+    runs = Run.query.filter(Run.worker_name == w.name)
+    if not runs.filter(Run.status == BuildStatus.UPLOADING).count():
+        return
+    now = datetime.datetime.utcnow()
+    staged = runs.filter(Run.status == BuildStatus.QUEUED, Run.staged_until > now)
+    if staged.count():
+        return  # one is enough
+
+    r = Run.stage_queued(w, WORKER_STAGING_SECONDS)
+    if r:
+        rundef = Storage().get_run_definition(r)
+        _fix_run_urls(rundef)
+        refine_func = getattr(permissions, "refine_run_definition", None)
+        if refine_func:
+            refine_func(r, rundef)
+        return json.dumps(rundef)
+
+
 @blueprint.route("workers/<name>/", methods=("GET",))
 @worker_authenticated
 def worker_get(name):
@@ -104,6 +132,11 @@ def worker_get(name):
     if w.enlisted:
         w.ping(**request.args)
 
+    # Workers that pre-pull images ask for hints of what they'll need
+    hints = int(request.headers.get("X-IMAGE-HINTS", "0"))
+    if hints and w.available:
+        data["image-hints"] = Run.image_hints(w, min(hints, 10))
+
     runners = int(request.args.get("available_runners", "0"))
     disk_free_bytes = int(request.args.get("disk_free", "0"))
     if (
@@ -136,6 +169,11 @@ def worker_get(name):
                 r.status = "QUEUED"
                 db.session.commit()
                 raise
+    elif w.available and request.headers.get("X-PREFETCH") == "1":
+        if disk_free_bytes >= WORKER_DISK_FREE_THRESHOLD_BYTES:
+            staged = _stage_run(w)
+            if staged:
+                data["staged-run-def"] = staged
 
     return jsendify({"worker": data})
 
@@ -267,7 +305,12 @@ def worker_deleted_volumes(name):
 
 @blueprint.route("runner", methods=("GET",))
 def runner_download():
-    return send_file(open(RUNNER, "rb"), mimetype="application/zip")
+    if RUNNER_VERSION and request.if_none_match.contains(RUNNER_VERSION):
+        return "", 304
+    resp = send_file(open(RUNNER, "rb"), mimetype="application/zip")
+    if RUNNER_VERSION:
+        resp.set_etag(RUNNER_VERSION)
+    return resp
 
 
 @blueprint.route("worker", methods=("GET",))
@@ -18,6 +18,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from jobserv.flask import create_app
 from jobserv.git_poller import run
 from jobserv.models import (
+    Artifact,
     Build,
     BuildEvents,
     BuildStatus,
@@ -346,7 +347,9 @@ def run_status(project, build, run, status=None):
         db.session.commit()
         if run.status in (BuildStatus.FAILED, BuildStatus.PASSED):
             # The run is finished, move logs from disk to GCS
-            Storage().copy_log(run)
+            storage = Storage()
+            storage.copy_log(run)
+            Artifact.index(storage, run)
         click.echo("Run is now: %r" % run)
 
 
@@ -406,3 +409,31 @@ def prune_builds(project, cutoff_days, dryrun):
                 pass
             db.session.delete(b)
             db.session.commit()
+    if not dryrun and storage.CONTENT_ADDRESSED:
+        storage.prune_blobs(project)
+
+
+@app.cli.command("index-artifacts")
+@click.argument("project", required=True)
+@click.option("--build", type=int, help="Only index this build")
+@click.option("--reconcile", is_flag=True, help="Also re-check indexed runs")
+def index_artifacts(project, build=None, reconcile=False):
+    """Backfill the artifact index of a project's completed runs"""
+    complete = (BuildStatus.PASSED, BuildStatus.FAILED, BuildStatus.PROMOTED)
+    runs = (
+        Run.query.join(Build)
+        .join(Project)
+        .filter(Project.name == project, Run.status.in_(complete))
+        .order_by(Run.id)
+    )
+    if build:
+        runs = runs.filter(Build.build_id == build)
+    storage = Storage()
+    for r in runs:
+        if r.artifacts_indexed and not reconcile:
+            continue
+        changed = Artifact.reconcile(r, storage.list_artifacts(r))
+        r.artifacts_indexed = True
+        db.session.commit()
+        if changed:
+            click.echo(f"{r.build.build_id}/{r.name}: {changed} changes")
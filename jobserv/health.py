@@ -0,0 +1,92 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import datetime
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import func
+
+from jobserv.models import Build, BuildStatus, Project, Run, db
+from jobserv.settings import HEALTH_SNAPSHOT_SECONDS, WORKER_DIR
+
+SNAPSHOT_FILE = os.path.join(WORKER_DIR, "health-runs.json")
+
+ACTIVE = (
+    BuildStatus.QUEUED,
+    BuildStatus.RUNNING,
+    BuildStatus.UPLOADING,
+    BuildStatus.CANCELLING,
+)
+
+
+def _isoformat(ts):
+    # the same format the API's JSON encoder gives datetimes
+    return ts.isoformat() + "+00:00"
+
+
+def snapshot():
+    """Return a snapshot of the run queue. Items don't include a "url" so
+    that the snapshot can be made outside of a request."""
+    health = {"generated": _isoformat(datetime.datetime.utcnow())}
+    # get an overall count for each run state
+    vals = db.session.query(Run.status, func.count(Run.status)).group_by(Run.status)
+    health["statuses"] = {BuildStatus(status).name: count for status, count in vals}
+
+    # now give some details about what's queued and what's running
+    health["RUNNING"] = {}
+    health["QUEUED"] = []
+    runs = (
+        db.session.query(
+            Project.name,
+            Build.build_id,
+            Build.created,
+            Run.name,
+            Run._status,
+            Run.worker_name,
+            Run.host_tag,
+        )
+        .join(Build, Run.build_id == Build.id)
+        .join(Project, Build.proj_id == Project.id)
+        .filter(Run.status.in_(ACTIVE))
+        .order_by(Run.queue_priority.asc(), Run.build_id.asc(), Run.id.asc())
+    )
+    for proj, build_id, created, name, status, worker, host_tag in runs:
+        item = {
+            "project": proj,
+            "build": build_id,
+            "run": name,
+            "created": _isoformat(created) if created else None,
+            "host_tag": host_tag,
+        }
+        if status == BuildStatus.QUEUED.value:
+            health["QUEUED"].append(item)
+        else:
+            health["RUNNING"].setdefault(worker or "?", []).append(item)
+    return health
+
+
+def write_snapshot():
+    """Called periodically by the worker monitor so that the API can serve
+    the health of runs without querying for it."""
+    tmp = SNAPSHOT_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot(), f)
+    os.rename(tmp, SNAPSHOT_FILE)
+
+
+def read_snapshot():
+    """Return the worker monitor's snapshot or None if it's missing or
+    older than HEALTH_SNAPSHOT_SECONDS."""
+    try:
+        if time.time() - os.stat(SNAPSHOT_FILE).st_mtime > HEALTH_SNAPSHOT_SECONDS:
+            return None
+        with open(SNAPSHOT_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    except Exception:
+        logging.exception("Unable to read health snapshot")
+        return None
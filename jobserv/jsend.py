@@ -1,8 +1,23 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
+import base64
+from collections import OrderedDict
+import hashlib
+from itertools import islice
+import json
 from math import ceil
+import threading
+from types import GeneratorType
 
-from flask import jsonify, request
+from flask import current_app, jsonify, request, stream_with_context
+
+from jobserv.settings import RESPONSE_CACHE_SIZE
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# Streamed responses are written out in pieces of about this many bytes
+STREAM_CHUNK = 64 * 1024
 
 
 def _status_str(status_code):
@@ -25,6 +40,56 @@ def jsendify(data, status_code=200):
     return resp
 
 
+def _iterencode(data, dumps):
+    """Encode `data` the way jsonify does, but expand generators one item
+    at a time so the whole document is never in memory."""
+    if isinstance(data, GeneratorType):
+        # items are encoded a batch at a time which is much quicker than
+        # calling dumps for each one
+        sep = "["
+        while True:
+            batch = list(islice(data, 100))
+            if not batch:
+                break
+            yield sep + dumps(batch)[1:-1]
+            sep = ", "
+        yield "[]" if sep == "[" else "]"
+    elif isinstance(data, dict):
+        sep = "{"
+        for k, v in data.items():
+            yield sep + dumps(k) + ": "
+            yield from _iterencode(v, dumps)
+            sep = ", "
+        yield "{}" if sep == "{" else "}"
+    else:
+        yield dumps(data)
+
+
+def jsendify_stream(data, status_code=200):
+    """Like jsendify, but `data` may contain generators which are encoded
+    as lists while the response is being sent. Anything that may fail
+    with an ApiError has to be done before calling this."""
+
+    def generate():
+        buf = []
+        size = 0
+        rv = {"status": _status_str(status_code), "data": data}
+        for chunk in _iterencode(rv, current_app.json.dumps):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        yield "".join(buf)
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        status=status_code,
+        mimetype="application/json",
+    )
+
+
 class ApiError(Exception):
     def __init__(self, status_code, data):
         super(ApiError, self).__init__()
@@ -34,6 +99,39 @@ class ApiError(Exception):
         return self.resp.data.decode()
 
 
+def jsendify_cached(version, render):
+    """Return jsendify(render()) for a document that can't change until
+    `version` does. `version` is None for documents that are still changing.
+
+    The response gets a strong ETag so a client that has the document gets
+    a 304. The body is kept in an LRU so other clients don't rebuild it.
+    """
+    if version is None:
+        return jsendify(render())
+
+    key = (request.endpoint, request.url) + tuple(version)
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    with _response_cache_lock:
+        body = _response_cache.get(key)
+        if body is not None:
+            _response_cache.move_to_end(key)
+    if body is None:
+        body = jsendify(render()).get_data()
+        with _response_cache_lock:
+            _response_cache[key] = body
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+
+    resp = current_app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    return resp
+
+
 def get_or_404(query):
     rv = query.first()
     if rv is None:
@@ -41,11 +139,83 @@ def get_or_404(query):
     return rv
 
 
-def paginate_custom(item_type, query, cb_func):
+def _get_limit():
     try:
-        limit = int(request.args.get("limit", "25"))
+        return int(request.args.get("limit", "25"))
     except ValueError:
         raise ApiError(400, 'Invalid pagination. "limit" must be numeric')
+
+
+def _next_url(query_string):
+    url = request.host_url
+    if url[-1] == "/":
+        url = url[:-1]
+    return url + request.path + "?" + query_string
+
+
+def _encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if isinstance(value, (int, str)):
+            return value
+    except ValueError:
+        pass
+    raise ApiError(400, 'Invalid pagination. "cursor" is not valid')
+
+
+def _paginate_cursor(
+    item_type, query, cb_func, column, descending, approx_total, stream
+):
+    """Keyset pagination: rather than counting the query and skipping to an
+    offset, each page picks up after the `column` value the last one ended
+    on. The cost of a page is then the same no matter how deep it is."""
+    limit = _get_limit()
+    cursor = request.args["cursor"]
+    query = query.order_by(None).order_by(column.desc() if descending else column)
+    if cursor:
+        last = _decode_cursor(cursor)
+        query = query.filter(column < last if descending else column > last)
+
+    items = query.limit(limit + 1).all()
+    rendered = (cb_func(x) for x in items[:limit])
+    data = {"limit": limit, item_type: rendered if stream else list(rendered)}
+    if approx_total:
+        data["total_approx"] = approx_total()
+    if len(items) > limit:
+        cursor = _encode_cursor(getattr(items[limit - 1], column.key))
+        data["next_cursor"] = cursor
+        data["next"] = _next_url(f"cursor={cursor}&limit={limit}")
+    return jsendify_stream(data) if stream else jsendify(data)
+
+
+def paginate_custom(
+    item_type,
+    query,
+    cb_func,
+    cursor_column=None,
+    descending=True,
+    approx_total=None,
+    stream=False,
+):
+    """Render a page of `query` with `cb_func`.
+
+    Pages are picked with ?page= by default. Listings that give a
+    `cursor_column` also support ?cursor=, which is keyset based and
+    returns an opaque "next_cursor". `approx_total` is an optional callable
+    returning a cheap estimate of the total for that mode. With `stream`
+    the items are encoded as they are sent rather than all up front.
+    """
+    if cursor_column is not None and "cursor" in request.args:
+        return _paginate_cursor(
+            item_type, query, cb_func, cursor_column, descending, approx_total, stream
+        )
+
+    limit = _get_limit()
     try:
         page = int(request.args.get("page", "0"))
     except ValueError:
@@ -56,22 +226,21 @@ def paginate_custom(item_type, query, cb_func):
     next_page = page + 1
 
     items = query.limit(limit).offset(offset)
+    rendered = (cb_func(x) for x in items)
     data = {
         "limit": limit,
         "page": page,
         "pages": pages,
         "total": total,
-        item_type: [cb_func(x) for x in items],
+        item_type: rendered if stream else list(rendered),
     }
     if next_page < pages:
-        url = request.host_url
-        if url[-1] == "/":
-            url = url[:-1]
-        url += request.path
-        data["next"] = f"{url}?page={next_page}&limit={limit}"
+        data["next"] = _next_url(f"page={next_page}&limit={limit}")
 
-    return jsendify(data)
+    return jsendify_stream(data) if stream else jsendify(data)
 
 
-def paginate(item_type, query):
-    return paginate_custom(item_type, query, lambda x: x.as_json(detailed=False))
+def paginate(item_type, query, **kwargs):
+    return paginate_custom(
+        item_type, query, lambda x: x.as_json(detailed=False), **kwargs
+    )
@@ -9,6 +9,7 @@ import fcntl
 import fnmatch
 import json
 import logging
+import mimetypes
 import os
 import random
 import re
@@ -21,7 +22,6 @@ import bcrypt
 import sqlalchemy.dialects.mysql.mysqldb as mysqldb
 
 from cryptography.fernet import Fernet
-from flask import url_for
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.mysql import MEDIUMTEXT
 from sqlalchemy.exc import IntegrityError
@@ -36,6 +36,7 @@ from jobserv.settings import (
     WORKER_DIR,
 )
 from jobserv.stats import StatsClient
+from jobserv.urls import external_url
 
 VALID_SECRET_PATTERN = r"^[a-zA-Z0-9_\-\.]+$"
 
@@ -115,15 +116,13 @@ class Project(db.Model):
         data = {
             "name": self.name,
             "synchronous-builds": self.synchronous_builds,
-            "url": url_for("api_project.project_get", proj=self.name, _external=True),
+            "url": external_url("api_project.project_get", proj=self.name),
         }
         allowed_host_tags = self.allowed_host_tags
         if allowed_host_tags:
             data["allowed-host-tags"] = allowed_host_tags
         if detailed:
-            data["builds_url"] = url_for(
-                "api_build.build_list", proj=self.name, _external=True
-            )
+            data["builds_url"] = external_url("api_build.build_list", proj=self.name)
         return data
 
     def __repr__(self):
@@ -260,14 +259,16 @@ class StatusMixin(object):
         else:
             self._status = status.value
 
+    COMPLETE = (
+        BuildStatus.PASSED.value,
+        BuildStatus.FAILED.value,
+        BuildStatus.PROMOTED.value,
+        BuildStatus.SKIPPED.value,
+    )
+
     @property
     def complete(self):
-        return self._status in (
-            BuildStatus.PASSED.value,
-            BuildStatus.FAILED.value,
-            BuildStatus.PROMOTED.value,
-            BuildStatus.SKIPPED.value,
-        )
+        return self._status in self.COMPLETE
 
     @contextlib.contextmanager
     def locked(self):
@@ -299,6 +300,16 @@ class Build(db.Model, StatusMixin):
     name = db.Column(db.String(256))
     annotation = db.Column(ANNOTATION_COLUMN_TYPE())
 
+    # Bumped on any change to what the API shows for a build or its runs.
+    # Cached API responses are keyed by it.
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Copies of the status_events times listings need so they don't have
+    # to load the events
+    created = db.Column(db.DateTime)
+    started = db.Column(db.DateTime)
+    completed = db.Column(db.DateTime)
+
     project = db.relationship(Project, back_populates="builds")
     runs = db.relationship(
         "Run", order_by="Run.id", cascade="save-update, merge, delete"
@@ -319,11 +330,10 @@ class Build(db.Model, StatusMixin):
             self.trigger_name = trigger_name
 
     def as_json(self, detailed=False):
-        url = url_for(
+        url = external_url(
             "api_build.build_get",
             proj=self.project.name,
             build_id=self.build_id,
-            _external=True,
         )
         data = {
             "build_id": self.build_id,
@@ -339,19 +349,20 @@ class Build(db.Model, StatusMixin):
             data["name"] = self.name
         if self.trigger_name:
             data["trigger_name"] = self.trigger_name
-        if self.status_events:
-            data["created"] = self.status_events[0].time
-            if self.complete:
-                data["completed"] = self.status_events[-1].time
+        if self.created:
+            data["created"] = self.created
+        if self.started:
+            data["started"] = self.started
+        if self.completed and self.complete:
+            data["completed"] = self.completed
         if detailed:
             data["status_events"] = [
                 {"time": x.time, "status": x.status.name} for x in self.status_events
             ]
-            data["runs_url"] = url_for(
+            data["runs_url"] = external_url(
                 "api_run.run_list",
                 proj=self.project.name,
                 build_id=self.build_id,
-                _external=True,
             )
             data["reason"] = self.reason
             data["annotation"] = self.annotation
@@ -361,7 +372,33 @@ class Build(db.Model, StatusMixin):
         status = get_cumulative_status(self.runs)
         if self.status != status:
             self.status = status
-            db.session.add(BuildEvents(self, status))
+            self.bump_version()
+            event = BuildEvents(self, status)
+            db.session.add(event)
+            self._set_times(event)
+
+    def _set_times(self, event):
+        if self.created is None:
+            self.created = event.time
+        running = (BuildStatus.RUNNING, BuildStatus.RUNNING_WITH_FAILURES)
+        if self.started is None and event.status in running:
+            self.started = event.time
+        self.completed = event.time if self.complete else None
+
+    def bump_version(self):
+        # done in SQL so concurrent updates can't lose a bump
+        self.version = Build.version + 1
+
+    @classmethod
+    def cache_version(clazz, proj, build_id):
+        """Return what API responses for a build can be cached by: None
+        while the build is running or (id, version) once it's complete."""
+        q = db.session.query(clazz.id, clazz._status, clazz.version)
+        q = q.join(Project).filter(Project.name == proj, clazz.build_id == build_id)
+        row = q.first()
+        if row and row._status in clazz.COMPLETE:
+            return row.id, row.version
+        return None
 
     def __repr__(self):
         return "<Build %d/%d: %s>" % (self.proj_id, self.build_id, self.status.name)
@@ -389,7 +426,11 @@ class Build(db.Model, StatusMixin):
                 b = Build(project, build_id, reason, trigger_name)
                 db.session.add(b)
                 db.session.flush()
-                db.session.add(BuildEvents(b, init_event_status))
+                event = BuildEvents(b, init_event_status)
+                db.session.add(event)
+                b.created = event.time
+                if init_event_status.value in clazz.COMPLETE:
+                    b.completed = event.time
                 db.session.commit()
                 return b
             except IntegrityError as e:
@@ -402,7 +443,7 @@ class BuildEvents(db.Model, StatusMixin):
     __tablename__ = "build_events"
 
     id = db.Column(db.Integer, primary_key=True)
-    time = db.Column(db.DateTime)
+    time = db.Column(db.DateTime, index=True)
     _status = db.Column(db.Integer)
     build_id = db.Column(db.Integer, db.ForeignKey(Build.id), nullable=False)
 
@@ -431,6 +472,24 @@ class Run(db.Model, StatusMixin):
     queue_priority = db.Column(db.Integer)  # bigger is more important
 
     host_tag = db.Column(db.String(1024))
+    container = db.Column(db.String(1024))
+    # A QUEUED run can be reserved for worker_name until this time so the
+    # worker can prefetch it while its current run is uploading
+    staged_until = db.Column(db.DateTime, index=True)
+
+    # Resource usage of the run's container as sampled by the runner
+    cpu_usec = db.Column(db.BigInteger)
+    mem_peak_bytes = db.Column(db.BigInteger)
+    io_read_bytes = db.Column(db.BigInteger)
+    io_write_bytes = db.Column(db.BigInteger)
+
+    # Set once the artifacts table holds what the completed run uploaded
+    artifacts_indexed = db.Column(db.Boolean, default=False)
+
+    # When the run was queued, last went RUNNING, and completed
+    created = db.Column(db.DateTime)
+    started = db.Column(db.DateTime)
+    completed = db.Column(db.DateTime)
 
     build = db.relationship(Build, back_populates="runs")
     status_events = db.relationship(
@@ -440,6 +499,9 @@ class Run(db.Model, StatusMixin):
     tests = db.relationship(
         "Test", order_by="Test.id", cascade="save-update, merge, delete"
     )
+    artifacts = db.relationship(
+        "Artifact", order_by="Artifact.path", cascade="save-update, merge, delete"
+    )
     worker = db.relationship("Worker")
 
     __table_args__ = (
@@ -447,12 +509,15 @@ class Run(db.Model, StatusMixin):
         db.UniqueConstraint("build_id", "name", name="run_name_uc"),
     )
 
+    RESOURCES = ("cpu_usec", "mem_peak_bytes", "io_read_bytes", "io_write_bytes")
+
     def __init__(self, build, name, trigger=None, queue_priority=0):
         self.build_id = build.id
         self.name = name
         self.trigger = trigger
         self.status = BuildStatus.QUEUED
         self.queue_priority = queue_priority
+        self.created = datetime.datetime.utcnow()
         self.api_key = "".join(
             random.SystemRandom().choice(
                 string.ascii_lowercase + string.ascii_uppercase + string.digits
@@ -463,20 +528,18 @@ class Run(db.Model, StatusMixin):
     def as_json(self, detailed=False):
         b = self.build
         p = b.project
-        url = url_for(
+        url = external_url(
             "api_run.run_get",
             proj=p.name,
             build_id=b.build_id,
             run=self.name,
-            _external=True,
         )
-        log = url_for(
+        log = external_url(
             "api_run.run_get_artifact",
             proj=p.name,
             build_id=b.build_id,
             run=self.name,
             path="console.log",
-            _external=True,
         )
         data = {
             "name": self.name,
@@ -488,22 +551,27 @@ class Run(db.Model, StatusMixin):
             data["web_url"] = RUN_URL_FMT.format(
                 project=p.name, build=b.build_id, run=self.name
             )
-        if self.status_events:
-            data["created"] = self.status_events[0].time
-            if self.complete:
-                data["completed"] = self.status_events[-1].time
+        if self.created:
+            data["created"] = self.created
+        if self.started:
+            data["started"] = self.started
+        if self.completed and self.complete:
+            data["completed"] = self.completed
         if self.host_tag:
             data["host_tag"] = self.host_tag
         if self.tests:
-            data["tests"] = url_for(
+            data["tests"] = external_url(
                 "api_test.test_list",
                 proj=p.name,
                 build_id=b.build_id,
                 run=self.name,
-                _external=True,
             )
         if detailed:
             data["worker_name"] = self.worker_name
+            if self.status == BuildStatus.QUEUED and self.staged_until:
+                data["staged_until"] = self.staged_until
+            if self.cpu_usec is not None:
+                data["resources"] = {x: getattr(self, x) for x in self.RESOURCES}
             data["status_events"] = []
             for event in self.status_events:
                 e = {"time": event.time, "status": event.status.name}
@@ -556,25 +624,48 @@ class Run(db.Model, StatusMixin):
             if status == BuildStatus.QUEUED:
                 self.running_acked = 0
             db.session.flush()
+            self.build.bump_version()
             self.build.refresh_status()
-            db.session.add(RunEvents(self, status))
+            event = RunEvents(self, status)
+            db.session.add(event)
+            if status == BuildStatus.QUEUED:
+                self.started = None
+                self.artifacts_indexed = False
+            elif status == BuildStatus.RUNNING:
+                self.started = event.time
+            self.completed = event.time if self.complete else None
 
     def __repr__(self):
         return "<Run %s: %s>" % (self.name, self.status.name)
 
     @staticmethod
-    def pop_queued(worker):
-        # Forcing 2 queries seems bad, but we have to JOIN on another table
-        # and MySQL doesn't allow UPDATEs that do that.
-        # So we first find a suitable Run:
-        conn = db.session.connection().connection
-        cursor = conn.cursor()
+    def image_hints(worker, limit):
+        """Return the containers of queued runs this worker is likely to be
+        given next so that it can pull them ahead of time."""
+        tags = [worker.name] + [x.strip() for x in worker.host_tags.split(",")]
+        queued = (
+            db.session.query(Run.host_tag, Run.container)
+            .filter(Run.status == BuildStatus.QUEUED, Run.container.isnot(None))
+            .order_by(Run.queue_priority.desc(), Run.build_id, Run.id)
+            .limit(100)
+        )
+        hints = []
+        for tag, container in queued:
+            if container not in hints:
+                if any(fnmatch.fnmatch(t, tag) for t in tags):
+                    hints.append(container)
+                    if len(hints) == limit:
+                        break
+        return hints
 
+    @staticmethod
+    def _find_queued(cursor, worker):
         # Find queued(status=1), running(status=2), and uploading(status=6) runs
         cursor.execute("""
             SELECT
               runs.id, runs.build_id, runs._status,
-              projects.id, projects.synchronous_builds, runs.host_tag
+              projects.id, projects.synchronous_builds, runs.host_tag,
+              runs.worker_name, runs.staged_until
             FROM runs
             JOIN builds on builds.id = runs.build_id
             JOIN projects on projects.id = builds.proj_id
@@ -594,12 +685,15 @@ class Run(db.Model, StatusMixin):
         okay_sync_builds = {}
         rows = cursor.fetchall()
         oldest_builds = {}
-        for run_id, build_id, status, proj_id, sync, tag in rows:
+        now = datetime.datetime.utcnow()
+        for run_id, build_id, status, proj_id, sync, tag, staged_by, until in rows:
             oldest_builds.setdefault(proj_id, build_id)
             if status in (2, 6) and sync:
                 sync_projects[proj_id] = True
                 okay_sync_builds[build_id] = True
             elif status == 1:
+                if until and until > now and staged_by != worker.name:
+                    continue  # reserved by another worker
                 for t in tags:
                     if fnmatch.fnmatch(t, tag):
                         # if its a sync build, we have to make sure this worker
@@ -614,8 +708,74 @@ class Run(db.Model, StatusMixin):
                     or build_id in okay_sync_builds
                     or proj_id not in sync_projects
                 ):
-                    break
-        else:
+                    return run_id
+
+    @staticmethod
+    def _release_staged(cursor):
+        """Expired reservations would otherwise leave the run looking like
+        it's assigned to the worker that staged it. _find_queued already
+        ignores them, so this is only done when staging rather than on
+        every check-in."""
+        rows = cursor.execute(
+            """
+            UPDATE runs
+            SET
+                worker_name = NULL, staged_until = NULL
+            WHERE
+                staged_until IS NOT NULL AND staged_until < %s AND _status = 1
+            """,
+            (datetime.datetime.utcnow(),),
+        )
+        if rows:
+            db.session.commit()
+
+    @staticmethod
+    def stage_queued(worker, seconds):
+        """Reserve the run this worker would be given next for `seconds`.
+        The run stays QUEUED, but no other worker will be given it until
+        the reservation expires."""
+        conn = db.session.connection().connection
+        cursor = conn.cursor()
+        Run._release_staged(cursor)
+        run_id = Run._find_queued(cursor, worker)
+        if not run_id:
+            return
+        now = datetime.datetime.utcnow()
+        until = now + datetime.timedelta(seconds=seconds)
+        rows = cursor.execute(
+            """
+            UPDATE runs
+            SET
+                worker_name = %s, staged_until = %s
+            WHERE
+                id = %s AND _status = 1
+                AND (staged_until IS NULL OR staged_until < %s)
+            """,
+            (worker.name, until, run_id, now),
+        )
+        db.session.commit()
+        if rows == 1:
+            return Run.query.get(run_id)
+
+    @staticmethod
+    def pop_queued(worker):
+        # Forcing 2 queries seems bad, but we have to JOIN on another table
+        # and MySQL doesn't allow UPDATEs that do that.
+        # So we first find a suitable Run. One this worker staged comes first.
+        conn = db.session.connection().connection
+        cursor = conn.cursor()
+
+        cursor.execute(
+            """
+            SELECT id FROM runs
+            WHERE _status = 1 AND worker_name = %s AND staged_until > %s
+            ORDER BY id LIMIT 1
+            """,
+            (worker.name, datetime.datetime.utcnow()),
+        )
+        row = cursor.fetchone()
+        run_id = row[0] if row else Run._find_queued(cursor, worker)
+        if not run_id:
             # No run found to schedule
             return
 
@@ -628,7 +788,7 @@ class Run(db.Model, StatusMixin):
         rows = cursor.execute("""
             UPDATE runs
             SET
-                _status = 2
+                _status = 2, staged_until = NULL
             WHERE
                 id = {run_id}
             """.format(run_id=run_id))
@@ -647,6 +807,8 @@ class Run(db.Model, StatusMixin):
                     event = RunEvents(r, BuildStatus.RUNNING)
                     event.worker_name = worker.name
                     db.session.add(event)
+                    r.started = event.time
+                    r.completed = None
                     r.build.refresh_status()
                     db.session.commit()
                     return r
@@ -664,7 +826,7 @@ class RunEvents(db.Model, StatusMixin):
     __tablename__ = "run_events"
 
     id = db.Column(db.Integer, primary_key=True)
-    time = db.Column(db.DateTime)
+    time = db.Column(db.DateTime, index=True)
     _status = db.Column(db.Integer)
     run_id = db.Column(db.Integer, db.ForeignKey(Run.id), nullable=False)
 
@@ -679,6 +841,92 @@ class RunEvents(db.Model, StatusMixin):
         return "<Status %s: %s>" % (self.time, self.status.name)
 
 
+class Artifact(db.Model):
+    """An index of what's in storage for a run so that listing a run's
+    artifacts doesn't have to ask the storage backend."""
+
+    __tablename__ = "artifacts"
+
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey(Run.id), nullable=False, index=True)
+    path = db.Column(db.String(1024), nullable=False)
+    # None until the upload has been confirmed to be in storage
+    size_bytes = db.Column(db.BigInteger)
+    content_type = db.Column(db.String(256))
+    sha256 = db.Column(db.String(64))
+
+    def __init__(self, run, path, size_bytes=None, content_type=None, sha256=None):
+        self.run_id = run.id
+        self.path = path
+        self.size_bytes = size_bytes
+        self.content_type = content_type
+        self.sha256 = sha256
+
+    def as_json(self):
+        return {"name": self.path, "size_bytes": self.size_bytes}
+
+    def __repr__(self):
+        return "<Artifact %s: %s>" % (self.path, self.size_bytes)
+
+    @staticmethod
+    def record_signed(run, urls, hashes=None):
+        """Record the artifacts a runner was given upload URLs for."""
+        known = {x.path: x for x in run.artifacts}
+        for path, item in urls.items():
+            a = known.get(path)
+            if a is None:
+                a = Artifact(run, path)
+                db.session.add(a)
+                run.artifacts.append(a)
+            a.content_type = item.get("content-type") or a.content_type
+            digest = hashes and hashes.get(path)
+            if isinstance(digest, dict) and isinstance(digest.get("sha256"), str):
+                a.sha256 = digest["sha256"]
+
+    @staticmethod
+    def reconcile(run, listing):
+        """Make the run's index match `listing`, the result of the storage
+        backend's list_artifacts. Returns the number of rows changed."""
+        known = {x.path: x for x in run.artifacts}
+        changed = 0
+        for item in listing:
+            a = known.pop(item["name"], None)
+            if a is None:
+                a = Artifact(run, item["name"])
+                a.content_type = mimetypes.guess_type(item["name"])[0]
+                db.session.add(a)
+                run.artifacts.append(a)
+            if a.size_bytes != item.get("size_bytes"):
+                a.size_bytes = item.get("size_bytes")
+                changed += 1
+        for a in known.values():
+            # a URL was signed but nothing was uploaded
+            run.artifacts.remove(a)
+            db.session.delete(a)
+            changed += 1
+        return changed
+
+    @staticmethod
+    def index(storage, run):
+        """Confirm what a completed run uploaded. This is one listing of
+        storage for the life of the run rather than one per API request."""
+        try:
+            Artifact.reconcile(run, storage.list_artifacts(run))
+            run.artifacts_indexed = True
+            db.session.commit()
+        except Exception:
+            logging.exception("Unable to index artifacts of run %d", run.id)
+            db.session.rollback()
+
+    @staticmethod
+    def listing(storage, run):
+        """Return the run's artifacts like storage.list_artifacts does. Runs
+        that haven't been indexed fall back to asking storage."""
+        if run.complete and run.artifacts_indexed:
+            return [x.as_json() for x in run.artifacts]
+        return storage.list_artifacts(run)
+
+
 class Test(db.Model, StatusMixin):
     __tablename__ = "tests"
 
@@ -705,13 +953,12 @@ class Test(db.Model, StatusMixin):
         r = self.run
         b = r.build
         p = b.project
-        url = url_for(
+        url = external_url(
             "api_test.test_get",
             proj=p.name,
             build_id=b.build_id,
             run=self.run.name,
             test=self.name,
-            _external=True,
         )
         data = {
             "name": self.name,
@@ -721,19 +968,22 @@ class Test(db.Model, StatusMixin):
             "created": self.created,
         }
         if detailed:
-            results = []
-            data["results"] = results
-            for x in self.results:
-                results.append(
-                    {
-                        "name": x.name,
-                        "context": x.context,
-                        "status": x.status.name,
-                        "output": x.output,
-                    }
-                )
+            data["results"] = list(self.results_json())
         return data
 
+    def results_json(self, results=None):
+        """Yield the json of each result. `results` can be a query to
+        avoid loading all of a big test's results at once."""
+        if results is None:
+            results = self.results
+        for x in results:
+            yield {
+                "name": x.name,
+                "context": x.context,
+                "status": x.status.name,
+                "output": x.output,
+            }
+
     def set_status(self, status):
         if isinstance(status, str):
             status = BuildStatus[status]
@@ -831,7 +1081,7 @@ class Worker(db.Model):
         return "<Worker %s - %s/%s>" % (self.name, self.online, self.enlisted)
 
     def as_json(self, detailed=False):
-        url = url_for("api_worker.worker_get", name=self.name, _external=True)
+        url = external_url("api_worker.worker_get", name=self.name)
         return {
             "name": self.name,
             "url": url,
@@ -172,6 +172,7 @@ class ProjectDefinition(object):
         rundef["env"]["H_BUILD"] = str(dbrun.build.build_id)
         rundef["env"]["H_RUN"] = dbrun.name
         dbrun.host_tag = rundef["host-tag"]
+        dbrun.container = rundef["container"]
         return rundef
 
     @classmethod
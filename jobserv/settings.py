@@ -26,6 +26,14 @@ PERMISSIONS_MODULE = os.environ.get("PERMISSIONS_MODULE", "jobserv.permissions")
 JOBS_DIR = os.environ.get("JOBS_DIR", "/data/ci_jobs")
 WORKER_DIR = os.environ.get("WORKER_DIR", "/data/workers")
 
+# Console logs are written to JOBS_DIR while a run is executing. Once a log
+# grows past this many bytes, completed segments are shipped to the storage
+# backend in the background so that completing a run only has to upload the
+# tail of the log. Set to 0 to upload the whole log at completion.
+CONSOLE_SEGMENT_BYTES = int(
+    os.environ.get("CONSOLE_SEGMENT_BYTES", str(16 * 1024 * 1024))
+)
+
 LOCAL_ARTIFACTS_DIR = os.environ.get("LOCAL_ARTIFACTS_DIR", "/data/artifacts")
 GCE_BUCKET = os.environ.get("GCE_BUCKET")
 STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "jobserv.storage.gce_storage")
@@ -92,6 +100,13 @@ WORKER_LOGS_THRESHOLD_DAYS = int(os.environ.get("WORKER_LOGS_THRESHOLD_DAYS", "4
 RUNNER = os.path.join(
     os.path.dirname(__file__), "../runner/dist/jobserv_runner-0.1-py3-none-any.whl"
 )
+# Workers cache the runner by this version (its also the ETag)
+RUNNER_VERSION = None
+if os.path.exists(RUNNER):
+    with open(RUNNER, "rb") as f:
+        h = hashlib.md5()
+        h.update(f.read())
+        RUNNER_VERSION = h.hexdigest()
 
 SIMULATOR_SCRIPT = os.path.join(os.path.dirname(__file__), "../simulator.py")
 with open(SIMULATOR_SCRIPT, "rb") as f:
@@ -109,3 +124,23 @@ with open(WORKER_SCRIPT, "rb") as f:
 WORKER_DISK_FREE_THRESHOLD_BYTES = int(
     os.environ.get("WORKER_DISK_FREE_THRESHOLD_BYTES", "30_000_000_000")
 )
+
+# How long a run stays reserved for a worker prefetching it while its
+# current run uploads. After this the run is up for grabs again.
+WORKER_STAGING_SECONDS = int(os.environ.get("WORKER_STAGING_SECONDS", "300"))
+
+# How many API responses of completed builds each server process keeps
+# in memory. 0 disables the cache, but ETags are still served.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2000"))
+
+# The worker monitor writes a snapshot of run health that /health/runs/
+# serves while it's younger than this. 0 always queries the database.
+HEALTH_SNAPSHOT_SECONDS = int(os.environ.get("HEALTH_SNAPSHOT_SECONDS", "60"))
+
+# The longest a /build-status/events/ request waits for new events. Event
+# stream (SSE) connections are closed after EVENT_STREAM_SECONDS and the
+# client reconnects with its Last-Event-ID. Both tie up one of gunicorn's
+# sync workers, so they must stay well under its 30 second timeout (see
+# docker_run.sh).
+EVENT_FEED_MAX_WAIT = int(os.environ.get("EVENT_FEED_MAX_WAIT", "15"))
+EVENT_STREAM_SECONDS = int(os.environ.get("EVENT_STREAM_SECONDS", "15"))
@@ -1,22 +1,61 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import datetime
+import fcntl
+import hashlib
 import json
 import os
 import logging
 import mimetypes
+import re
+import threading
 
 from cryptography.fernet import Fernet
 
-from jobserv.settings import JOBS_DIR
+from jobserv.settings import CONSOLE_SEGMENT_BYTES, JOBS_DIR
 
 log = logging.getLogger("jobserv.flask")
 
+# Console log segments and content-addressed blobs are stored by a small
+# thread pool so that runner requests aren't blocked by object storage.
+# Its created lazily so that gunicorn can fork before threads exist.
+_segment_shipper = None
+
+# The console logs with an upload queued, so that a burst of run_updates
+# while one is in flight doesn't pile up more
+_segments_queued = set()
+_segments_lock = threading.Lock()
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+MD5_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _get_segment_shipper():
+    global _segment_shipper
+    if _segment_shipper is None:
+        _segment_shipper = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="storage-bg"
+        )
+    return _segment_shipper
+
 
 class BaseStorage(object):
     LINK_FILE = None
+    # Set by backends that implement _compose and _delete so that console
+    # logs can be shipped in segments while a run is executing
+    LOG_SEGMENTS = False
+    LOG_SEGMENTS_DIR = ".console.log.d/"
+    # Set by backends that implement _generate_resumable_url
+    RESUMABLE_UPLOADS = False
+    # Set by backends that implement _exists, _copy, _open_raw, and _list so
+    # that artifacts already stored for a project aren't uploaded again.
+    # <project>/.blobs/<sha256>-<md5> holds the path of a verified copy of
+    # that content, which new uploads of it are copied from.
+    CONTENT_ADDRESSED = False
+    BLOBS_DIR = ".blobs/"
     blueprint = None
 
     def __init__(self):
@@ -37,6 +76,42 @@ class BaseStorage(object):
     def _generate_put_url(self, run, path, expiration, content_type):
         raise NotImplementedError()
 
+    def _generate_resumable_url(self, run, path, expiration, content_type):
+        """Return a signed URL that can be POST'ed to with the header
+        "x-goog-resumable: start" to begin a resumable upload session."""
+        raise NotImplementedError()
+
+    def _compose(self, storage_path, sources, content_type):
+        """Concatenate the "sources" objects into a new object."""
+        raise NotImplementedError()
+
+    def _delete(self, storage_path):
+        raise NotImplementedError()
+
+    def _exists(self, storage_path):
+        raise NotImplementedError()
+
+    def _copy(self, src_path, dst_path):
+        raise NotImplementedError()
+
+    def _open_raw(self, storage_path):
+        raise NotImplementedError()
+
+    def _list(self, prefix):
+        """Yield the (storage_path, size) of each object under prefix."""
+        raise NotImplementedError()
+
+    def _verify_blob(self, storage_path, sha256, md5):
+        """Does the object's content have these hashes? Backends that keep
+        an md5 of each object can check that instead of reading it back."""
+        h = hashlib.sha256()
+        m = hashlib.md5()
+        with self._open_raw(storage_path) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+                m.update(chunk)
+        return h.hexdigest() == sha256 and m.hexdigest() == md5
+
     def list_artifacts(self, run):
         raise NotImplementedError()
 
@@ -112,37 +187,225 @@ class BaseStorage(object):
                 pass
         return open(path, mode)
 
-    def copy_log(self, run):
+    def _log_segments_state(self, run):
+        """Return the local console.log and the file used to record how many
+        segments of it have been shipped to storage."""
         src = os.path.join(JOBS_DIR, self._get_run_path(run, "console.log"))
+        return src, src + ".segments"
+
+    @staticmethod
+    def _segments_shipped(state):
+        try:
+            with open(state) as f:
+                return int(f.read() or "0")
+        except FileNotFoundError:
+            return 0
+
+    def _ship_segments(self, src, state, base, final=False):
+        """Upload each complete CONSOLE_SEGMENT_BYTES chunk of the console
+        log that hasn't been shipped yet. When `final` is set, the trailing
+        partial chunk is uploaded as well. The caller must hold the flock on
+        the console log."""
+        shipped = self._segments_shipped(state)
+        with open(src, "rb") as f:
+            f.seek(shipped * CONSOLE_SEGMENT_BYTES)
+            while True:
+                buf = f.read(CONSOLE_SEGMENT_BYTES)
+                if not buf or (len(buf) < CONSOLE_SEGMENT_BYTES and not final):
+                    break
+                path = base + self.LOG_SEGMENTS_DIR + "%05d" % shipped
+                self._create_from_string(path, buf)
+                shipped += 1
+                with open(state + ".tmp", "w") as s:
+                    s.write(str(shipped))
+                os.rename(state + ".tmp", state)
+        return shipped
+
+    def _ship_log_segments_bg(self, src, state, base):
+        with _segments_lock:
+            _segments_queued.discard(src)
+        try:
+            with open(src, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    return  # copy_log completed while we waited for the lock
+                self._ship_segments(src, state, base)
+        except FileNotFoundError:
+            pass  # copy_log completed before we got started
+        except Exception:
+            log.exception("Unable to ship console log segments for %s", base)
+
+    def ship_log_segments(self, run):
+        """Called as a run's console log grows. Once it has a segment's worth
+        of data that hasn't been shipped, queue an upload of it. This keeps
+        the work left for copy_log small regardless of the log's size."""
+        if not self.LOG_SEGMENTS or not CONSOLE_SEGMENT_BYTES:
+            return
+        src, state = self._log_segments_state(run)
+        try:
+            size = os.stat(src).st_size
+        except FileNotFoundError:
+            return
+        if size // CONSOLE_SEGMENT_BYTES > self._segments_shipped(state):
+            with _segments_lock:
+                if src in _segments_queued:
+                    return
+                _segments_queued.add(src)
+            base = self._get_run_path(run)
+            _get_segment_shipper().submit(self._ship_log_segments_bg, src, state, base)
+
+    def _compose_log(self, run, src, state):
+        base = self._get_run_path(run)
+        shipped = self._ship_segments(src, state, base, final=True)
+        segments = [base + self.LOG_SEGMENTS_DIR + "%05d" % i for i in range(shipped)]
+        self._compose(self._get_run_path(run, "console.log"), segments, "text/plain")
+        for path in segments:
+            self._delete(path)
+
+    @staticmethod
+    def _content_key(digest):
+        """Return the blob key for a runner's {"sha256": .., "md5": ..} or
+        None if it isn't one. The md5 is what gets verified on backends that
+        store it. Keying by both means a runner would need an md5 second
+        preimage of another artifact to have its upload stand in for it."""
+        if not isinstance(digest, dict):
+            return None
+        sha256 = digest.get("sha256")
+        md5 = digest.get("md5")
+        if not isinstance(sha256, str) or not isinstance(md5, str):
+            return None
+        if not SHA256_RE.match(sha256) or not MD5_RE.match(md5):
+            return None
+        return "%s-%s" % (sha256, md5)
+
+    def _blob_path(self, run, key):
+        return "%s/%s%s" % (run.build.project.name, self.BLOBS_DIR, key)
+
+    def _pending_blobs(self, run):
+        return os.path.join(JOBS_DIR, self._get_run_path(run, ".pending-blobs"))
+
+    def _blob_source(self, index):
+        """The path of the verified copy this blob index entry points at."""
+        try:
+            return self._get_as_string(index)
+        except FileNotFoundError:
+            return None
+
+    def _link_blob(self, run, path, key):
+        """Copy the project's verified copy of this content to the run's
+        artifact. Returns False if there isn't one, in which case the run's
+        copy will be indexed once the run completes."""
+        src = self._blob_source(self._blob_path(run, key))
+        if src:
+            try:
+                self._copy(src, self._get_run_path(run, path))
+                return True
+            except FileNotFoundError:
+                pass  # its build was deleted, this run's copy replaces it
+        pending = self._pending_blobs(run)
+        os.makedirs(os.path.dirname(pending), exist_ok=True)
+        with open(pending, "a") as f:
+            f.write("%s %s\n" % (key, path))
+        return False
+
+    def _store_blobs(self, base, blobs_dir, pending):
+        for key, path in pending:
+            index = blobs_dir + key
+            try:
+                src = self._blob_source(index)
+                if src and self._exists(src):
+                    continue
+                # The runner's word isn't enough to point other runs at it
+                if not self._verify_blob(base + path, *key.split("-")):
+                    log.warning("Hash mismatch for %s%s, not storing", base, path)
+                    continue
+                self._create_from_string(index, base + path)
+            except FileNotFoundError:
+                log.warning("Artifact %s%s was never uploaded", base, path)
+            except Exception:
+                log.exception("Unable to store blob for %s%s", base, path)
+
+    def prune_blobs(self, project):
+        """Remove the project's blob index entries that point at deleted
+        builds. Entries keyed by sha256 alone are from older versions, which
+        stored whole copies of the content, and are removed as well."""
+        for path, _ in list(self._list("%s/%s" % (project, self.BLOBS_DIR))):
+            if "-" not in os.path.basename(path):
+                self._delete(path)
+                continue
+            src = self._blob_source(path)
+            if not src or not self._exists(src):
+                self._delete(path)
+
+    def store_blobs(self, run):
+        """Queue the run's newly uploaded, hashed artifacts to be added to
+        the project's blob store."""
+        pending = self._pending_blobs(run)
+        try:
+            with open(pending) as f:
+                blobs = [line.split(" ", 1) for line in f.read().splitlines()]
+            os.unlink(pending)
+        except FileNotFoundError:
+            return
+        base = self._get_run_path(run)
+        blobs_dir = self._blob_path(run, "")
+        _get_segment_shipper().submit(self._store_blobs, base, blobs_dir, blobs)
+
+    def copy_log(self, run):
+        if self.CONTENT_ADDRESSED:
+            self.store_blobs(run)
+        src, state = self._log_segments_state(run)
 
         if not os.path.exists(src):
             log.warn("Run had no console output")
             return
 
-        self._create_from_file(
-            self._get_run_path(run, "console.log"), src, "text/plain"
-        )
-
-        # try and clean up our runs on disk
-        os.unlink(src)
+        with open(src, "rb") as f:
+            # wait for any segments being shipped in the background
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if self.LOG_SEGMENTS and os.path.exists(state):
+                self._compose_log(run, src, state)
+                os.unlink(state)
+            else:
+                self._create_from_file(
+                    self._get_run_path(run, "console.log"), src, "text/plain"
+                )
+
+            # try and clean up our runs on disk
+            os.unlink(src)
         os.rmdir(os.path.dirname(src))
         try:
             os.rmdir(os.path.dirname(os.path.dirname(src)))
         except Exception:
             pass  # another run is still in progress
 
-    def generate_signed(self, run, paths, expiration):
+    def generate_signed(self, run, paths, expiration, resumable=False, hashes=None):
         urls = {}
         expiration = datetime.timedelta(seconds=expiration)
+        resumable = resumable and self.RESUMABLE_UPLOADS
+        if not self.CONTENT_ADDRESSED:
+            hashes = None
         for p in paths:
+            key = self._content_key(hashes and hashes.get(p))
+            if key and p != self.LINK_FILE:
+                if self._link_blob(run, p, key):
+                    urls[p] = {"stored": True}
+                    continue
             ct = mimetypes.guess_type(p)[0]
             if not ct:
                 ct = ""
-            url = self._generate_put_url(run, p, expiration=expiration, content_type=ct)
+            if resumable:
+                url = self._generate_resumable_url(run, p, expiration, ct)
+            else:
+                url = self._generate_put_url(
+                    run, p, expiration=expiration, content_type=ct
+                )
             urls[p] = {
                 "url": url,
                 "content-type": ct,
             }
+            if resumable:
+                urls[p]["resumable"] = True
         return urls
 
     @contextlib.contextmanager
@@ -38,3 +38,8 @@ class Storage(GcpStorage):
             # Linked storage should only be used when creating external builds
             raise ValueError(f"Invalid file name: {path}")
         return super()._generate_put_url(run, path, expiration, content_type)
+
+    def _generate_resumable_url(self, run, path, expiration, content_type):
+        if path == self.LINK_FILE:
+            raise ValueError(f"Invalid file name: {path}")
+        return super()._generate_resumable_url(run, path, expiration, content_type)
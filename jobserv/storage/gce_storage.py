@@ -1,6 +1,7 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import base64
 from concurrent.futures import ProcessPoolExecutor
 import os
 import datetime
@@ -38,6 +39,10 @@ def retry():
 
 
 class Storage(BaseStorage):
+    LOG_SEGMENTS = True
+    RESUMABLE_UPLOADS = True
+    CONTENT_ADDRESSED = True
+
     def __init__(self):
         super().__init__()
         creds_file = os.environ.get("GCE_CREDS")
@@ -65,6 +70,59 @@ class Storage(BaseStorage):
         with open(filename, "rb") as f:
             b.upload_from_file(f, content_type=content_type)
 
+    @retry()
+    def _compose(self, storage_path, sources, content_type):
+        # GCS can only compose 32 objects at a time, so larger logs are built
+        # up by appending to the destination in chunks
+        b = self.bucket.blob(storage_path)
+        b.content_type = content_type
+        blobs = [self.bucket.blob(x) for x in sources]
+        b.compose(blobs[:32])
+        for i in range(32, len(blobs), 31):
+            b.compose([b] + blobs[i : i + 31])
+
+    def _delete(self, storage_path):
+        try:
+            self.bucket.blob(storage_path).delete()
+        except NotFound:
+            pass
+
+    def _exists(self, storage_path):
+        return self.bucket.blob(storage_path).exists()
+
+    @retry()
+    def _copy(self, src_path, dst_path):
+        # A server side copy. Large objects can take several rewrite calls
+        src = self.bucket.blob(src_path)
+        dst = self.bucket.blob(dst_path)
+        try:
+            token, _, _ = dst.rewrite(src)
+            while token:
+                token, _, _ = dst.rewrite(src, token=token)
+        except NotFound:
+            raise FileNotFoundError(src_path)
+
+    def _open_raw(self, storage_path):
+        b = self.bucket.blob(storage_path)
+        try:
+            # open() doesn't fetch anything until the first read
+            b.reload()
+        except NotFound:
+            raise FileNotFoundError(storage_path)
+        return b.open("rb")
+
+    def _verify_blob(self, storage_path, sha256, md5):
+        # GCS has the object's md5, so it doesn't have to be read back
+        b = self.bucket.get_blob(storage_path)
+        if b is None:
+            raise FileNotFoundError(storage_path)
+        # composite objects only have a crc32c
+        return bool(b.md5_hash) and base64.b64decode(b.md5_hash).hex() == md5
+
+    def _list(self, prefix):
+        for x in self.bucket.list_blobs(prefix=prefix):
+            yield x.name, x.size
+
     def _get_raw(self, storage_path):
         try:
             return self.bucket.blob(storage_path).download_as_string()
@@ -83,6 +141,7 @@ class Storage(BaseStorage):
             }
             for x in self.bucket.list_blobs(prefix=name)
             if not x.name.endswith(".rundef.json")
+            and not x.name[len(name) :].startswith(self.LOG_SEGMENTS_DIR)
         ]
 
     def delete_build(self, build):
@@ -97,6 +156,12 @@ class Storage(BaseStorage):
             expiration=expiration, method="PUT", content_type=content_type
         )
 
+    def _generate_resumable_url(self, run, path, expiration, content_type):
+        b = self.bucket.blob(self._get_run_path(run, path))
+        return b.generate_signed_url(
+            expiration=expiration, method="RESUMABLE", content_type=content_type
+        )
+
     def get_download_response(self, request, run, path):
         expiration = int(request.headers.get("X-EXPIRATION", "90"))
         b = self.bucket.blob(self._get_run_path(run, path))
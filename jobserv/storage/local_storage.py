@@ -21,6 +21,8 @@ blueprint = Blueprint("local_storage", __name__, url_prefix="/local-storage")
 
 class Storage(BaseStorage):
     blueprint = blueprint
+    LOG_SEGMENTS = True
+    CONTENT_ADDRESSED = True
 
     def __init__(self):
         super().__init__()
@@ -36,7 +38,8 @@ class Storage(BaseStorage):
 
     def _create_from_string(self, storage_path, contents):
         path = self._get_local(storage_path)
-        with open(path, "w") as f:
+        mode = "wb" if isinstance(contents, bytes) else "w"
+        with open(path, mode) as f:
             f.write(contents)
 
     def _create_from_file(self, storage_path, filename, content_type):
@@ -44,6 +47,50 @@ class Storage(BaseStorage):
         with open(filename, "rb") as fin, open(path, "wb") as fout:
             shutil.copyfileobj(fin, fout)
 
+    def _compose(self, storage_path, sources, content_type):
+        path = self._get_local(storage_path)
+        with open(path, "wb") as fout:
+            for src in sources:
+                with open(os.path.join(self.artifacts, src), "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+
+    def _delete(self, storage_path):
+        assert storage_path[0] != "/"
+        path = os.path.join(self.artifacts, storage_path)
+        os.unlink(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass  # directory still has content
+
+    def _exists(self, storage_path):
+        assert storage_path[0] != "/"
+        return os.path.exists(os.path.join(self.artifacts, storage_path))
+
+    def _copy(self, src_path, dst_path):
+        assert src_path[0] != "/"
+        src = os.path.join(self.artifacts, src_path)
+        dst = self._get_local(dst_path)
+        if os.path.exists(dst):
+            os.unlink(dst)
+        try:
+            # blobs are never modified in place, so they can share an inode
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def _open_raw(self, storage_path):
+        assert storage_path[0] != "/"
+        return open(os.path.join(self.artifacts, storage_path), "rb")
+
+    def _list(self, prefix):
+        assert prefix[0] != "/"
+        path = os.path.join(self.artifacts, prefix)
+        if os.path.isdir(path):
+            for entry in os.scandir(path):
+                if entry.is_file():
+                    yield prefix + entry.name, entry.stat().st_size
+
     def _get_raw(self, storage_path):
         assert storage_path[0] != "/"
         path = os.path.join(self.artifacts, storage_path)
@@ -60,6 +107,8 @@ class Storage(BaseStorage):
         path = "%s/%s/%s/" % (run.build.project.name, run.build.build_id, run.name)
         path = os.path.join(self.artifacts, path)
         for base, _, names in os.walk(path):
+            if base[len(path) :].startswith(self.LOG_SEGMENTS_DIR[:-1]):
+                continue  # console.log segments of a run in progress
             for name in names:
                 if name != ".rundef.json":
                     name = os.path.join(base, name)
@@ -134,7 +183,10 @@ def run_upload_artifact(sig, proj, build_id, run, path):
     except FileExistsError:
         pass
 
-    # stream the contents to disk
+    # stream the contents to disk. The old file is unlinked rather than
+    # truncated in case its a hard link to a stored blob.
+    if os.path.exists(p):
+        os.unlink(p)
     with open(p, "wb") as f:
         chunk_size = 4096
         while True:
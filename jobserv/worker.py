@@ -8,6 +8,7 @@ import time
 
 import requests
 
+from jobserv.health import write_snapshot
 from jobserv.models import db, BuildStatus, Run, Worker, WORKER_DIR
 from jobserv.notify import (
     notify_run_terminated,
@@ -276,6 +277,13 @@ def _check_acked():
             db.session.commit()
 
 
+def _write_health_snapshot():
+    try:
+        write_snapshot()
+    except Exception:
+        log.exception("Unable to write run health snapshot")
+
+
 def run_monitor_workers():
     log.info("worker monitor has started")
     try:
@@ -288,6 +296,8 @@ def run_monitor_workers():
                     db.session.rollback()  # required so we see db updates between loops
                     log.debug("checking for acked runs")
                     _check_acked()
+                    log.debug("writing run health snapshot")
+                    _write_health_snapshot()
                     time.sleep(10)
 
                 # Every 2 minutes check this other stuff:
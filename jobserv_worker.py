@@ -8,9 +8,11 @@ from base64 import b64decode
 import contextlib
 import datetime
 import fcntl
+import functools
 from gzip import compress as gzip_compress
 import hashlib
 import importlib
+import itertools
 import json
 import logging
 import os
@@ -24,6 +26,7 @@ import tempfile
 import time
 import traceback
 import urllib.parse
+import zipfile
 
 from configparser import ConfigParser, NoOptionError
 from multiprocessing import cpu_count
@@ -45,6 +48,14 @@ if "linux" not in sys.platform:
     log.error("worker only supported on the linux platform")
     sys.exit(1)
 
+# Set to the ".worker-lock" file when "loop --agent" is checking in from its
+# own process rather than spawning "check" each time
+_agent_lock = None
+
+# Matches the runner's JOBSERV_IMAGE_FRESH_SECONDS so a pre-pulled image isn't
+# pulled again by the run that needs it
+IMAGE_FRESH_SECONDS = int(os.environ.get("JOBSERV_IMAGE_FRESH_SECONDS", "600"))
+
 
 def _host_from_jwt(jwt):
     _, payload, _ = jwt.split(".")
@@ -146,6 +157,8 @@ class HostProps(object):
             json.dump(self.data, f)
 
     def update_if_needed(self, server):
+        if getattr(self, "_synced", False):
+            return  # the agent loop has already done this
         try:
             with open(self.CACHE) as f:
                 cached = json.load(f)
@@ -155,6 +168,7 @@ class HostProps(object):
             log.info("updating host properies on server: %s", self.data)
             server.update_host(self.data)
             self.cache()
+        self._synced = True
 
     @staticmethod
     def get_available_space(path):
@@ -200,10 +214,11 @@ class JobServ(object):
             headers["Authorization"] = "Token " + config["jobserv"]["host_api_key"]
         return headers
 
-    def _get(self, resource, params=None, json=None):
+    def _get(self, resource, params=None, json=None, headers=None):
         url = urllib.parse.urljoin(config["jobserv"]["server_url"], resource)
+        headers = dict(headers or {}, **self._auth_headers())
         r = self.requests.get(
-            url, params=params, json=json, headers=self._auth_headers(), timeout=15
+            url, params=params, json=json, headers=headers, timeout=15
         )
         if r.status_code != 200:
             log.error("Failed to issue request to %s: %s\n", r.url, r.text)
@@ -268,8 +283,14 @@ class JobServ(object):
                 "load_avg_5": load_avg_5,
                 "load_avg_15": load_avg_15,
             }
+            headers = {}
+            prepull = int(config.get("jobserv", "image_prepull", fallback="0"))
+            if prepull:
+                headers["X-IMAGE-HINTS"] = str(prepull)
+            if int(config.get("jobserv", "prefetch", fallback="0")):
+                headers["X-PREFETCH"] = "1"
             data = self._get(
-                "/workers/%s/" % config["jobserv"]["hostname"], params
+                "/workers/%s/" % config["jobserv"]["hostname"], params, headers=headers
             ).json()
             yield data, locks
 
@@ -390,17 +411,81 @@ def _upgrade_worker(args, version):
     config["jobserv"]["version"] = version
     with open(config_file, "w") as f:
         config.write(f, True)
+    if _agent_lock:
+        # Runs in progress are children of this PID and will still get
+        # reaped after the exec. The worker lock is close-on-exec.
+        log.info("Restarting agent with new worker script")
+        os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+
+
+def _runner_cache_get(cache, version):
+    path = os.path.join(cache, version)
+    if os.path.isdir(path):
+        os.utime(path)  # keeps it from being pruned
+        return path
+
+
+def _runner_cache_put(cache, version, wheel):
+    """Extract the runner wheel into the cache. Runs starting at the same
+    time may race to do this, so its extracted to a temp dir first."""
+    tmp = tempfile.mkdtemp(dir=cache)
+    with zipfile.ZipFile(wheel) as zf:
+        zf.extractall(tmp)
+    try:
+        os.rename(tmp, os.path.join(cache, version))
+    except OSError:
+        shutil.rmtree(tmp)  # someone else beat us to it
+
+    # only keep the few most recently used versions around
+    versions = [os.path.join(cache, x) for x in os.listdir(cache)]
+    versions = [x for x in versions if os.path.isdir(x) and x != tmp]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for path in versions[3:]:
+        shutil.rmtree(path, ignore_errors=True)
+    return os.path.join(cache, version)
 
 
 def _download_runner(url, rundir, retries=3):
+    """Return a path to add to sys.path for importing the runner. Runners
+    are cached by version so only the first run after an upgrade has to
+    download and extract it."""
+    cache = os.path.join(os.path.dirname(script), "runner-cache")
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    version = query.get("version", [None])[0]
+    if version:
+        path = _runner_cache_get(cache, version)
+        if path:
+            return path
+
+    headers = {}
+    latest = os.path.join(cache, "latest")
+    if os.path.exists(latest):
+        with open(latest) as f:
+            headers["If-None-Match"] = '"%s"' % f.read().strip()
+
     for i in range(1, retries + 1):
-        r = requests.get(url, stream=True)
+        r = requests.get(url, stream=True, headers=headers)
+        if r.status_code == 304:
+            path = _runner_cache_get(cache, headers["If-None-Match"][1:-1])
+            if path:
+                return path
+            del headers["If-None-Match"]
+            continue
         if r.status_code == 200:
             runner = os.path.join(rundir, "runner.whl")
             with open(runner, "wb") as f:
-                for chunk in r.iter_content(4096):
+                for chunk in r.iter_content(65536):
                     f.write(chunk)
-            return runner
+            version = r.headers.get("ETag", "").strip('"')
+            if not version:
+                return runner  # an older server that doesn't version runners
+            path = _runner_cache_put(cache, version, runner)
+            with open(latest + ".tmp", "w") as f:
+                f.write(version)
+            os.rename(latest + ".tmp", latest)
+            return path
         else:
             if i == retries:
                 raise RuntimeError(
@@ -564,16 +649,9 @@ def _handle_run(jobserv, rundef, rundir=None):
             rundir = tempfile.mkdtemp(dir=runsdir)
         try:
             if os.fork() == 0:
-                sys.path.insert(0, _download_runner(rundef["runner_url"], rundir))
-                m = importlib.import_module(
-                    "jobserv_runner.handlers." + rundef["trigger_type"]
-                )
-                try:
-                    m.handler.execute(os.path.dirname(script), rundir, rundef)
-                    _run_callback("RUN_COMPLETE", rundef)
-                except m.handler.RebootAndContinue as e:
-                    _handle_reboot(rundir, jobserv, rundef, e.cold)
-                _delete_rundir(rundir)
+                _run_forked_child(jobserv, rundef, rundir)
+            elif rundef.get("flock"):
+                rundef["flock"].close()  # the child holds the run's lock now
         except SystemExit:
             raise
     except Exception:
@@ -583,6 +661,41 @@ def _handle_run(jobserv, rundef, rundir=None):
         jobserv.update_run(rundef, "FAILED", msg)
 
 
+def _run_child(jobserv, rundef, rundir):
+    # Held until this process exits so DiskGC knows the directory is in use
+    in_use = open(os.path.join(rundir, DiskGC.RUN_LOCK), "a")
+    fcntl.flock(in_use, fcntl.LOCK_EX)
+    sys.path.insert(0, _download_runner(rundef["runner_url"], rundir))
+    m = importlib.import_module("jobserv_runner.handlers." + rundef["trigger_type"])
+    try:
+        m.handler.execute(os.path.dirname(script), rundir, rundef)
+        _run_callback("RUN_COMPLETE", rundef)
+    except m.handler.RebootAndContinue as e:
+        _handle_reboot(rundir, jobserv, rundef, e.cold)
+    _delete_rundir(rundir)
+
+
+def _run_forked_child(jobserv, rundef, rundir):
+    """The forked process executing a run must never return into cmd_check
+    or the agent loop. Anything after the run there, like checking for
+    upgrades or prefetching, is the parent's job and would be stale by the
+    time the run finishes."""
+    try:
+        if _agent_lock:
+            _agent_lock.close()  # don't keep the worker locked after an upgrade
+            jobserv.requests = requests.Session()  # don't share the agent's sockets
+        _run_child(jobserv, rundef, rundir)
+    except Exception:
+        stack = traceback.format_exc().strip().replace("\n", "\n | ")
+        msg = "Unexpected runner error:\n | " + stack
+        log.error(msg)
+        jobserv.update_run(rundef, "FAILED", msg)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
 def _handle_rebooted_run(jobserv):
     reboot_run = os.path.join(os.path.dirname(script), "rebooted-run")
     if os.path.exists(reboot_run):
@@ -607,12 +720,94 @@ def _handle_rebooted_run(jobserv):
         return True
 
 
+def _image_state(ref):
+    """The lock and state files the runner's ImageManager uses to share
+    pulls between runs on this worker."""
+    images = os.path.join(os.path.dirname(script), "images")
+    if not os.path.exists(images):
+        os.mkdir(images)
+    path = os.path.join(images, hashlib.sha256(ref.encode()).hexdigest())
+    return path + ".lock", path + ".json"
+
+
+def _prepull_image(ref):
+    lock, state = _image_state(ref)
+    with open(lock, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            with open(state) as sf:
+                pulled = json.load(sf)["pulled"]
+            if time.time() - pulled < IMAGE_FRESH_SECONDS:
+                return  # a run or an earlier pre-pull just got it
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        log.info("Pre-pulling container: %s", ref)
+        r = subprocess.run(["docker", "pull", "-q", ref], stdout=subprocess.DEVNULL)
+        if r.returncode != 0:
+            log.info("Unable to pre-pull %s, the run will try again", ref)
+            return
+        out = subprocess.check_output(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", ref]
+        )
+        with open(state + ".tmp", "w") as sf:
+            json.dump(
+                {"ref": ref, "pulled": time.time(), "id": out.decode().strip()}, sf
+            )
+        os.rename(state + ".tmp", state)
+
+
+def _prepull_images(hints):
+    """Pull the containers the server says we're likely to need next in a
+    child process so that it doesn't hold up checking in."""
+    lockfile = os.path.join(os.path.dirname(script), ".prepull-lock")
+    if os.fork() != 0:
+        return
+    try:
+        if _agent_lock:
+            _agent_lock.close()
+        with open(lockfile, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            for ref in hints:
+                _prepull_image(ref)
+    except BlockingIOError:
+        pass  # the last pre-pull is still going
+    except Exception:
+        log.exception("Unable to pre-pull images")
+    finally:
+        os._exit(0)
+
+
+def _prefetch_run(rundef):
+    """The server has reserved our next run while the current one uploads.
+    Fill the image and git caches it will use from a child process so the
+    run can start quickly once a slot frees up."""
+    if os.fork() != 0:
+        return
+    try:
+        if _agent_lock:
+            _agent_lock.close()
+        log.info("Prefetching run: %s", rundef.get("run_url"))
+        with tempfile.TemporaryDirectory() as rundir:
+            sys.path.insert(0, _download_runner(rundef["runner_url"], rundir))
+            name = "jobserv_runner.handlers." + rundef["trigger_type"]
+            handler = importlib.import_module(name).handler
+            if hasattr(handler, "prefetch"):
+                handler.prefetch(os.path.dirname(script), rundir, rundef)
+    except Exception:
+        log.exception("Unable to prefetch run")
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
 def cmd_check(args):
     """Check in with server for work"""
     if _handle_rebooted_run(args.server):
         return
 
-    HostProps().update_if_needed(args.server)
+    hostprops = getattr(args, "hostprops", None) or HostProps()
+    hostprops.update_if_needed(args.server)
     rundefs = []
     with args.server.check_in() as (data, locks):
         for rd in data["data"]["worker"].get("run-defs") or []:
@@ -625,6 +820,17 @@ def cmd_check(args):
         log.info("Executing run: %s", rundef.get("run_url"))
         _handle_run(args.server, rundef)
 
+    # Only the process that checked in gets here, the runs' processes exit
+    # when they're done, so the reservation and hints are still fresh
+    staged = data["data"]["worker"].get("staged-run-def")
+    if staged:
+        _prefetch_run(json.loads(staged))
+
+    hints = data["data"]["worker"].get("image-hints")
+    if hints:
+        DiskGC.set_hot_images(hints)
+        _prepull_images(hints)
+
     ver = data["data"]["worker"]["version"]
     if ver != config["jobserv"]["version"]:
         log.warning("Upgrading client to: %s", ver)
@@ -638,6 +844,150 @@ def _docker_clean():
         log.exception(e)
 
 
+class DiskGC(object):
+    """Frees disk space before the server stops scheduling runs on us.
+
+    The server won't hand out runs once disk_free drops below its
+    WORKER_DISK_FREE_THRESHOLD_BYTES. When free space gets within reach of
+    that, the least recently used images, persistent volumes, and leftover
+    run directories are evicted until it's back above `free_bytes`. Images
+    the server's pre-pull hints say are needed soon are kept.
+    """
+
+    RUN_LOCK = ".worker-run-lock"
+    HOT_IMAGES = os.path.join(os.path.dirname(script), "images", "hot.json")
+
+    def __init__(self, free_bytes, path="/var/lib"):
+        self.free_bytes = free_bytes
+        self.path = path
+        self.base = os.path.dirname(script)
+
+    @classmethod
+    def set_hot_images(cls, refs):
+        os.makedirs(os.path.dirname(cls.HOT_IMAGES), exist_ok=True)
+        with open(cls.HOT_IMAGES + ".tmp", "w") as f:
+            json.dump(refs, f)
+        os.rename(cls.HOT_IMAGES + ".tmp", cls.HOT_IMAGES)
+
+    def _hot_images(self):
+        try:
+            with open(self.HOT_IMAGES) as f:
+                return set(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return set()
+
+    def _same_disk(self, path):
+        # evicting things on another filesystem won't help
+        try:
+            return os.stat(path).st_dev == os.stat(self.path).st_dev
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _rmtree(path):
+        try:
+            shutil.rmtree(path)
+        except PermissionError:
+            # containers leave behind files owned by root
+            subprocess.check_call(["sudo", "/bin/rm", "-rf", path])
+
+    def _evict_locked(self, lockfile, evict):
+        with open(lockfile, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False  # in use
+            return evict()
+
+    def _images(self):
+        """Images the runs have pulled with the time they were last used.
+        Untagged images and ones we haven't seen a run use go first."""
+        hot = self._hot_images()
+        try:
+            out = subprocess.check_output(
+                ["docker", "image", "ls", "--format", "{{.Repository}}:{{.Tag}}"]
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.error("Unable to list docker images: %s", e)
+            return
+        for ref in set(out.decode().split()):
+            # runs usually leave off the tag
+            untagged = ref[: -len(":latest")] if ref.endswith(":latest") else None
+            if ref.endswith(":<none>") or ref in hot or untagged in hot:
+                continue
+            lock, state = _image_state(ref)
+            if not os.path.exists(state) and untagged:
+                lock, state = _image_state(untagged)
+
+            def evict(ref=ref, state=state):
+                if subprocess.call(["docker", "image", "rm", ref]) != 0:
+                    return False  # a container is still using it
+                if os.path.exists(state):
+                    os.unlink(state)
+                return True
+
+            yield self._mtime(lock), "image", ref, lock, evict
+
+    def _volumes(self):
+        vols = os.path.join(self.base, "volumes")
+        if not self._same_disk(vols):
+            return
+        for project in os.scandir(vols):
+            if not project.is_dir() or project.name == "lost+found":
+                continue
+            for vol in os.scandir(project.path):
+                if vol.is_dir():
+                    lock = vol.path + ".lock"
+                    evict = functools.partial(self._rmtree, vol.path)
+                    yield self._mtime(lock), "volume", vol.path, lock, evict
+
+    def _rundirs(self):
+        runs = os.path.join(self.base, "runs")
+        if not self._same_disk(runs):
+            return
+        for run in os.scandir(runs):
+            lock = os.path.join(run.path, self.RUN_LOCK)
+            if not run.is_dir():
+                continue
+            if not os.path.exists(lock) and time.time() - self._mtime(run.path) < 3600:
+                continue  # a run that hasn't started its child yet
+            evict = functools.partial(self._rmtree, run.path)
+            # a run dir nothing holds the lock on was left behind by a crash
+            yield 0, "run directory", run.path, lock, evict
+
+    def collect(self):
+        free = HostProps.get_available_space(self.path)
+        if free >= self.free_bytes:
+            return
+        log.warning("Low disk space(%d bytes free), evicting old items", free)
+        for cmd in (
+            ["docker", "volume", "prune", "-f"],
+            ["docker", "image", "prune", "-f"],
+        ):
+            subprocess.call(cmd, stdout=subprocess.DEVNULL)
+
+        items = itertools.chain(self._rundirs(), self._images(), self._volumes())
+        for used, kind, name, lock, evict in sorted(items, key=lambda x: x[0]):
+            free = HostProps.get_available_space(self.path)
+            if free >= self.free_bytes:
+                break
+            try:
+                if self._evict_locked(lock, evict) is not False:
+                    log.info("Evicted %s %s", kind, name)
+            except Exception:
+                log.exception("Unable to evict %s %s", kind, name)
+        free = HostProps.get_available_space(self.path)
+        if free < self.free_bytes:
+            log.error("Unable to free enough disk space: %d bytes free", free)
+
+
 def _handle_expiring_token(args):
     log.info("JWT is expiring soon. Starting shutdown")
     # We need to unregister with server while we have permission. Howerver,
@@ -658,6 +1008,41 @@ def _handle_expiring_token(args):
     sys.exit(0)
 
 
+def _reap_children():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+
+
+def _agent_check(args):
+    """Perform a "check" from inside the loop's process. This avoids paying
+    for a new interpreter, config parse, and HTTPS connection each time."""
+    try:
+        _reap_children()
+        mtime = os.stat(config_file).st_mtime
+        if mtime != getattr(args, "config_mtime", None):
+            config.read([config_file])
+            args.config_mtime = mtime
+            args.hostprops = HostProps()
+        cmd_check(args)
+    except SystemExit as e:
+        # JobServ._get exits on a failed request
+        return e.code if isinstance(e.code, int) else 1
+    except (ConnectionError, TimeoutError, requests.RequestException):
+        log.exception("Unable to check in with server")
+        return 1
+    except Exception:
+        # A check used to get its own process, so a failure here mustn't
+        # take down the loop
+        log.exception("Unexpected error checking in with server")
+        return 1
+    return 0
+
+
 def cmd_loop(args):
     # Ensure no other copy of this script is running
     try:
@@ -679,13 +1064,20 @@ def cmd_loop(args):
         if _is_rebooting():
             log.warning("Reboot lock from previous run detected, deleting")
             os.unlink("/tmp/jobserv_rebooting")
+        if args.agent:
+            global _agent_lock
+            _agent_lock = f
+            args.server.requests = requests.Session()
         try:
             idle_threshold = args.idle_threshold * 60
             last_busy = time.time()
             next_clean = time.time() + (args.docker_rm * 3600)
             while True:
                 log.debug("Calling check")
-                rc = subprocess.call(cmd_args)
+                if args.agent:
+                    rc = _agent_check(args)
+                else:
+                    rc = subprocess.call(cmd_args)
                 if rc:
                     log.error("Last call exited with rc: %d", rc)
 
@@ -698,6 +1090,12 @@ def cmd_loop(args):
                 else:
                     last_busy = now
 
+                if args.disk_gc_free:
+                    try:
+                        DiskGC(args.disk_gc_free).collect()
+                    except Exception:
+                        log.exception("Unable to free disk space")
+
                 if now > next_clean:
                     log.info("Running docker container cleanup")
                     _docker_clean()
@@ -847,6 +1245,16 @@ def get_args(args=None):
         help="""Interval in hours to run to run "dock rm" on containers that
                 have exited. default is every %(default)d hours""",
     )
+    p.add_argument(
+        "--disk-gc-free",
+        type=int,
+        default=0,
+        metavar="bytes",
+        help="""Evict the least recently used images, volumes, and run
+                directories when free space drops below this. It should be
+                above the server's WORKER_DISK_FREE_THRESHOLD_BYTES.
+                default=%(default)d (disabled)""",
+    )
     p.add_argument(
         "--idle-threshold",
         type=int,
@@ -859,6 +1267,12 @@ def get_args(args=None):
         "--idle-command",
         help="Command to call when worker has been idle --idle-threshold minutes",
     )
+    p.add_argument(
+        "--agent",
+        action="store_true",
+        help="""Check in from this process with a persistent connection
+                rather than spawning the "check" command each interval""",
+    )
 
     p = sub.add_parser(
         "cronwrap",
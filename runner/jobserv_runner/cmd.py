@@ -9,9 +9,24 @@ import time
 
 HANG_DETECT_SECONDS = 300
 
+# Reads start small so a quiet command's output shows up promptly and grow
+# up to READ_MAX while the command keeps filling them.
+READ_MIN = 4096
+READ_MAX = 1024 * 1024
+
+# Output is handed to the stream callback once FLUSH_BYTES have built up or
+# the oldest output is FLUSH_SECONDS old.
+FLUSH_BYTES = 64 * 1024
+FLUSH_SECONDS = 1
+
 
 def _cmd_output(cmd, cwd=None, env=None, hung_cb=None):
-    """Simple non-blocking way to stream the output of a command"""
+    """Simple non-blocking way to stream the output of a command.
+
+    The chunks yielded are views into a buffer that's reused by the next
+    read, so they must be consumed before asking for the next one. An empty
+    chunk is yielded each FLUSH_SECONDS the command is quiet.
+    """
     poller = select.poll()
     p = subprocess.Popen(
         cmd,
@@ -26,23 +41,32 @@ def _cmd_output(cmd, cwd=None, env=None, hung_cb=None):
     for fd in fds:
         poller.register(fd, select.POLLIN)
 
-    timeouts = 0
+    view = memoryview(bytearray(READ_MAX))
+    size = READ_MIN
+    last_output = time.monotonic()
     while len(fds) > 0:
-        ready = poller.poll(1000)
-        if len(ready) > 0:
-            timeouts = 0
-        else:
-            timeouts += 1
-            if timeouts == HANG_DETECT_SECONDS:
+        hang_in = last_output + HANG_DETECT_SECONDS - time.monotonic()
+        timeout = max(0, min(FLUSH_SECONDS, hang_in))
+        ready = poller.poll(timeout * 1000)
+        if not ready:
+            if time.monotonic() - last_output >= HANG_DETECT_SECONDS:
                 if hung_cb:
                     hung_cb()
                 else:
                     msg = "== %s: cmd seems hung\n" % datetime.datetime.utcnow()
                     yield msg.encode()
-                timeouts = 0  # give a chance to warn again in another 5
+                last_output = time.monotonic()  # warn again in another 5
+            yield b""
+            continue
+        last_output = time.monotonic()
         for fd, event in ready:
             if event & select.POLLIN:
-                yield os.read(fd, 4096)
+                n = os.readv(fd, [view[:size]])
+                if n == size and size < READ_MAX:
+                    size *= 2
+                elif n < size // 4 and size > READ_MIN:
+                    size //= 2
+                yield view[:n]
             elif event & select.POLLHUP:
                 poller.unregister(fd)
                 fds.remove(fd)
@@ -59,22 +83,25 @@ def _cmd_output(cmd, cwd=None, env=None, hung_cb=None):
 
 
 def stream_cmd(stream_cb, cmd, cwd=None, env=None, hung_cb=None):
-    last_update = 0
-    last_buff = b""
+    pending = bytearray()
+    oldest = None
     try:
-        for buff in _cmd_output(cmd, cwd, env, hung_cb):
-            now = time.time()
-            # stream data every 10s or if we have a 1k of data
-            if now - last_update > 10 or len(buff) >= 1024:
-                if not stream_cb(last_buff + buff):
-                    last_buff += buff
-                else:
-                    last_buff = b""
-                    last_update = now
-            else:
-                last_buff += buff
+        for chunk in _cmd_output(cmd, cwd, env, hung_cb):
+            if chunk:
+                pending += chunk
+                if oldest is None:
+                    oldest = time.monotonic()
+            if pending and (
+                len(pending) >= FLUSH_BYTES
+                or time.monotonic() - oldest >= FLUSH_SECONDS
+            ):
+                # If the callback fails the output stays pending and is
+                # tried again with the next flush
+                if stream_cb(bytes(pending)):
+                    pending.clear()
+                    oldest = None
     finally:
-        if last_buff:
-            if not stream_cb(last_buff):
+        if pending:
+            if not stream_cb(bytes(pending)):
                 # Unable to stream part of command output
                 raise subprocess.CalledProcessError(0, cmd)
@@ -0,0 +1,142 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+# Total size the mirrors under a worker's cache directory can grow to before
+# the least recently used ones are deleted. 0 disables the cache.
+GIT_CACHE_BYTES = int(
+    os.environ.get("JOBSERV_GIT_CACHE_BYTES", str(20 * 1024 * 1024 * 1024))
+)
+
+
+def _du(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class GitMirrorCache(object):
+    """A directory of bare mirrors, one per clone URL, that runs on a worker
+    can borrow objects from so that a clone only has to download what's
+    changed since the last run that used the repository.
+
+    Each mirror has a lock file next to it. Fetches into the mirror take an
+    exclusive lock, clones borrowing from it hold a shared lock so that the
+    mirror can't be evicted out from underneath them. The lock file's mtime
+    records when the mirror was last used.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = GIT_CACHE_BYTES if max_bytes is None else max_bytes
+
+    def mirror_path(self, key):
+        # the key is hashed since it may be a URL with credentials in it
+        name = re.sub(r"[^\w.-]", "_", os.path.basename(key.rstrip("/")))
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "%s-%s.git" % (name[:64], digest))
+
+    @contextlib.contextmanager
+    def _locked(self, mirror, mode):
+        with open(mirror + ".lock", "a") as f:
+            fcntl.flock(f, mode)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _fetch(self, log, mirror, url, env):
+        if not os.path.exists(mirror):
+            tmp = mirror + ".tmp"
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)  # an earlier attempt died half way through
+            subprocess.check_call(["git", "init", "-q", "--bare", tmp])
+            # Objects only come in by fetching, so gc can't prune anything a
+            # clone borrowing from us needs
+            subprocess.check_call(["git", "config", "gc.pruneExpire", "never"], cwd=tmp)
+            os.rename(tmp, mirror)
+        # The URL is passed on the command line rather than saved as a remote
+        # so that credentials never get written into the cache
+        refspecs = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+        args = ["git", "fetch", "-q", "--prune", url] + refspecs
+        return log.exec(args, cwd=mirror, env=env)
+
+    @contextlib.contextmanager
+    def reference(self, log, url, key=None, env=None):
+        """Bring the mirror of `url` up to date and yield its path while
+        holding it locked for use as a `git clone --reference`. Yields None
+        if the cache is disabled or the mirror couldn't be updated, in which
+        case the caller should just clone normally.
+        """
+        if not self.max_bytes:
+            yield None
+            return
+
+        mirror = self.mirror_path(key or url)
+        try:
+            with contextlib.ExitStack() as stack:
+                fetched = False
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    lock = stack.enter_context(self._locked(mirror, fcntl.LOCK_EX))
+                    log.info("Updating git mirror: %s", os.path.basename(mirror))
+                    fetched = self._fetch(log, mirror, url, env)
+                except Exception as e:
+                    log.warn("Error updating git mirror: %s", e)
+                if fetched:
+                    # downgrade to a shared lock while the clone reads from it
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                    os.utime(lock.name)
+                    yield mirror
+                else:
+                    log.warn("Unable to update git mirror, cloning without it")
+                    yield None
+        finally:
+            try:
+                self.evict(keep=mirror)
+            except Exception:
+                logging.exception("Unable to evict git mirrors")
+
+    def evict(self, keep=None):
+        """Delete the least recently used mirrors until the cache fits
+        within max_bytes. Mirrors in use and `keep` are skipped."""
+        try:
+            names = [x for x in os.listdir(self.cache_dir) if x.endswith(".git")]
+        except FileNotFoundError:
+            return
+        mirrors = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                used = os.stat(path + ".lock").st_mtime
+            except FileNotFoundError:
+                used = 0
+            mirrors.append((used, path, _du(path)))
+        mirrors.sort()
+        total = sum(x[2] for x in mirrors)
+        for _, path, size in mirrors:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                with open(path + ".lock", "a") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    logging.info("Evicting git mirror %s (%d bytes)", path, size)
+                    shutil.rmtree(path)
+                total -= size
+            except BlockingIOError:
+                pass  # in use
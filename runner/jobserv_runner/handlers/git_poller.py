@@ -128,10 +128,33 @@ class GitPoller(SimpleHandler):
                 f.write('[http "%s"]\n' % clone_url)
                 f.write("  extraheader = " + header + "\n")
 
-    def _clone(self, log, dst):
-        clone_url = self.rundef["env"]["GIT_URL"]
-        log.info("Clone_url: %s", clone_url)
-
+    def _reference_submodules(self, log, dst, env):
+        """Check out the top level submodules using the worker's git mirrors.
+        Anything this can't handle is left for the recursive update."""
+        cmd = ["git", "config", "--get-regexp", r"^submodule\..*\.url$"]
+        p = subprocess.run(cmd, cwd=dst, env=env, stdout=subprocess.PIPE)
+        for line in p.stdout.decode().splitlines():
+            key, url = line.split(" ", 1)
+            name = key[len("submodule.") : -len(".url")]
+            cmd = ["git", "config", "-f", ".gitmodules", "submodule.%s.path" % name]
+            p = subprocess.run(cmd, cwd=dst, stdout=subprocess.PIPE)
+            path = p.stdout.decode().strip()
+            if not path:
+                continue
+            with self.git_cache.reference(log, url, env=env) as mirror:
+                if not mirror:
+                    continue
+                cmd = ["git", "submodule", "update", "--reference", mirror, path]
+                if not log.exec(cmd, cwd=dst, env=env):
+                    continue
+                # "git submodule update" has no --dissociate, so do it by hand
+                subdir = os.path.join(dst, path)
+                if log.exec(["git", "repack", "-a", "-d", "-q"], cwd=subdir):
+                    cmd = ["git", "rev-parse", "--git-path", "objects/info/alternates"]
+                    alternates = subprocess.check_output(cmd, cwd=subdir)
+                    os.unlink(os.path.join(subdir, alternates.decode().strip()))
+
+    def _clone_env(self, log, clone_url):
         gitconfig = os.path.join(self.run_dir, ".gitconfig")
         self._create_gitconfig(log, clone_url, gitconfig)
         # The env logic below is subtle: submodules might need
@@ -142,6 +165,19 @@ class GitPoller(SimpleHandler):
         # .gitconfig file we create
         env = os.environ.copy()
         env["HOME"] = self.run_dir
+        return env
+
+    def prefetch_repos(self, log):
+        super().prefetch_repos(log)
+        clone_url = self.rundef["env"]["GIT_URL"]
+        env = self._clone_env(log, clone_url)
+        with self.git_cache.reference(log, clone_url, env=env):
+            pass
+
+    def _clone(self, log, dst):
+        clone_url = self.rundef["env"]["GIT_URL"]
+        log.info("Clone_url: %s", clone_url)
+        env = self._clone_env(log, clone_url)
 
         if SUPPORTS_SUBMODULE:
             log.info("Git install supports submodules")
@@ -149,7 +185,9 @@ class GitPoller(SimpleHandler):
             log.info("Git install supports LFS")
             self._lfs_initialize(env)
 
-        if not log.exec_retriable(["git", "clone", clone_url, dst], env=env):
+        if not self._git_clone(
+            log, clone_url, dst, env=env, retriable=True, lfs=SUPPORTS_LFS
+        ):
             raise HandlerError("Unable to clone: " + clone_url)
 
         sha = self.rundef["env"].get("GIT_SHA")
@@ -157,11 +195,13 @@ class GitPoller(SimpleHandler):
             log.info("Checking out: %s", sha)
             if not log.exec(["git", "branch", "jobserv-run", sha], cwd=dst):
                 raise HandlerError("Unable to branch: " + sha)
-            if not log.exec(["git", "checkout", "jobserv-run"], cwd=dst):
+            # env has the LFS filters from _lfs_initialize
+            if not log.exec(["git", "checkout", "jobserv-run"], cwd=dst, env=env):
                 raise HandlerError("Unable to checkout: " + sha)
             if SUPPORTS_SUBMODULE:
                 if not log.exec(["git", "submodule", "init"], cwd=dst, env=env):
                     raise HandlerError("Unable to init submodule(s)")
+                self._reference_submodules(log, dst, env)
 
                 if not log.exec_retriable(
                     ["git", "submodule", "update", "--init", "--recursive"],
@@ -169,6 +209,8 @@ class GitPoller(SimpleHandler):
                     env=env,
                 ):
                     raise HandlerError("Unable to update submodule(s)")
+        if SUPPORTS_LFS:
+            self._lfs_dissociate(log, dst, env)
 
     def prepare_mounts(self):
         mounts = super().prepare_mounts()
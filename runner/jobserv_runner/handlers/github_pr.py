@@ -31,8 +31,8 @@ class GHStatusApi(JobServApi):
         }
         self.status_url = rundef["env"]["GH_STATUS_URL"]
 
-    def update_run(self, msg, status=None, retry=2, metadata=None):
-        rv = super().update_run(msg, status, retry, metadata)
+    def update_run(self, msg, status=None, retry=2, metadata=None, raise_error=False):
+        rv = super().update_run(msg, status, retry, metadata, raise_error)
         state = STATUS_MAP.get(status, "pending")
         if self.data.get("state") != state:
             self.data["state"] = state
@@ -30,8 +30,8 @@ class StatusApi(JobServApi):
         }
         self.status_url = rundef["env"]["GL_STATUS_URL"]
 
-    def update_run(self, msg, status=None, retry=2, metadata=None):
-        rv = super().update_run(msg, status, retry, metadata)
+    def update_run(self, msg, status=None, retry=2, metadata=None, raise_error=False):
+        rv = super().update_run(msg, status, retry, metadata, raise_error)
         state = STATUS_MAP.get(status)
         if state and self.data.get("state") != state:
             self.data["state"] = state
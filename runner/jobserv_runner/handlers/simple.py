@@ -11,14 +11,19 @@ import os
 import shutil
 import signal
 import subprocess
+import sys
 import time
 import traceback
 import urllib.parse
 import uuid
 
 from jobserv_runner.cmd import stream_cmd
+from jobserv_runner.git_cache import GitMirrorCache
+from jobserv_runner.images import ImageManager
 from jobserv_runner.jobserv import JobServApi, RunCancelledError
 from jobserv_runner.logging import ContextLogger
+from jobserv_runner.resources import ResourceSampler
+from jobserv_runner.sender import ConsoleSender
 
 passed_msg = r"""Runner has completed
             _  _
@@ -70,13 +75,32 @@ class JobServLogger(ContextLogger):
     def __init__(self, context, jobserv):
         super().__init__(context)
         self.jobserv = jobserv
+        self._sender = None
+
+    @property
+    def sender(self):
+        """The ConsoleSender used to ship output for this context. Its
+        created on first use so simulated runs never start a thread."""
+        if self._sender is None:
+            self._sender = ConsoleSender(self.jobserv)
+        return self._sender
 
     def __exit__(self, type, value, tb):
         if type == RunTimeoutError:
+            if self._sender:
+                self._sender.close()
             return  # we handle logging of this properly
 
         super().__exit__(type, value, tb)
-        self.jobserv.update_run(self.io.getvalue().encode(), retry=5)
+        if self._sender:
+            try:
+                if not self._sender.close():
+                    sys.stderr.write("Unable to send all console output\n")
+            except RunCancelledError:
+                if type is None:
+                    raise
+        if self.io.getvalue():
+            self.jobserv.update_run(self.io.getvalue().encode(), retry=5)
         if tb:
             # flag this so we know the stack trace was printed
             value.handler_logged = True
@@ -88,17 +112,27 @@ class JobServLogger(ContextLogger):
             self.jobserv.update_run(buf.encode())
             self.io = io.StringIO()
 
-        def cb(buff):
-            # dont stream this to local logs, just to server
-            if self.jobserv.SIMULATED:
+        if self.jobserv.SIMULATED:
+
+            def cb(buff):
                 # we are in simulator mode, dump to stdout
                 return os.write(1, buff)
-            return self.jobserv.update_run(buff)
+
+        else:
+            # dont stream this to local logs, just to server. The sender
+            # does this in the background so a slow server can't stall the
+            # command by leaving its stdout pipe full.
+            cb = self.sender.write
 
         try:
             stream_cmd(cb, cmd_args, cwd, env, hung_cb)
+            if not self.jobserv.SIMULATED and not self.sender.flush():
+                self.error("unable to send all command output to server")
+                return False
             return True
         except subprocess.CalledProcessError as e:
+            if not self.jobserv.SIMULATED:
+                self.sender.flush()
             if e.output:
                 if not self.jobserv.update_run(e.output, retry=8):
                     self.error("unable to update run output: %s", e.output)
@@ -115,25 +149,31 @@ class JobServLogger(ContextLogger):
 
     def _write(self, msg):
         if not self.jobserv.SIMULATED:
-            self.io.write(msg)
-            buf = self.io.getvalue()
-            try:
-                if buf and self.jobserv.update_run(buf.encode(), retry=1):
-                    self.io = io.StringIO()
-            except RunCancelledError as e:
-                # the call to self.jobserv.update_run, if successful, might
-                # get this exception. This means we've uploaded self.io to
-                # the server and should clear it here so that we don't send
-                # the buffer twice.
-                self.io = io.StringIO()
-                raise e
+            self.sender.write(msg.encode())
         else:
             self.io.write(msg)
 
 
+class LocalLogger(ContextLogger):
+    """Logs to the worker's console only. Used while prefetching a run that
+    could still end up on a different worker."""
+
+    def exec(self, cmd_args, cwd=None, env=None, hung_cb=None):
+        try:
+            stream_cmd(lambda buff: os.write(2, buff), cmd_args, cwd, env, hung_cb)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    exec_retriable = JobServLogger.exec_retriable
+
+
 class SimpleHandler(object):
     """Executes the steps needed to do a "simple" trigger-type rundef"""
 
+    # Max number of junit test results sent to the server per request
+    JUNIT_BATCH = 500
+
     class RebootAndContinue(Exception):
         """Tells the jobserv_worker script to save this run, reboot the system,
         and continue it after reboot."""
@@ -148,8 +188,11 @@ class SimpleHandler(object):
         self.jobserv = jobserv
         self.rundef = rundef
         self.container_cwd = "/"
+        self._volume_locks = []
 
     def log_context(self, context):
+        if self.jobserv is None:
+            return LocalLogger(context)  # see prefetch()
         return JobServLogger(context, self.jobserv)
 
     @contextlib.contextmanager
@@ -194,13 +237,18 @@ class SimpleHandler(object):
         logctx = self.log_context("Pulling container: " + container)
         login = self.docker_login()
         with logctx as log, login:
-            for x in (0, 2, 3, 5):  # try four times with back-off vals
-                if x:
-                    log.warn("Unable to pull container, retrying in %ds", x)
-                    time.sleep(x)
-                if log.exec(["docker", "pull", container]):
-                    return
-            raise HandlerError("Unable to pull container: " + container)
+
+            def pull():
+                for x in (0, 2, 3, 5):  # try four times with back-off vals
+                    if x:
+                        log.warn("Unable to pull container, retrying in %ds", x)
+                        time.sleep(x)
+                    if log.exec(["docker", "pull", container]):
+                        return True
+                return False
+
+            if not ImageManager(self.worker_dir).pull(log, container, pull):
+                raise HandlerError("Unable to pull container: " + container)
 
     def docker_run(self, mounts):
         env_file = os.path.join(self.run_dir, "docker-env")
@@ -261,12 +309,28 @@ class SimpleHandler(object):
                 cmd.extend(["--entrypoint", ep])
             cmd.extend(["-v" + ":".join(x) for x in mounts])
             cmd.extend([self.rundef["container"], self._container_command])
+            sampler = ResourceSampler(name)
+            sampler.start()
             try:
                 return log.exec(cmd, hung_cb=hung_cb)
             except RunTimeoutError:
                 log.error("Run has timed out, killing containter")
                 log.exec(["docker", "kill", name])
                 raise
+            finally:
+                sampler.stop()
+                self._report_resources(log, sampler)
+
+    def _report_resources(self, log, sampler):
+        # a reserved name so it can't overwrite one of the run's own artifacts
+        path = os.path.join(self.run_dir, "archive", ".jobserv-resources.json")
+        try:
+            summary = sampler.save(path)
+            if summary:
+                log.info("Container resource usage: %r", summary)
+                self.jobserv.update_resources(summary)
+        except Exception as e:
+            log.warn("Unable to report container resource usage: %s", e)
 
     def _prepare_secrets(self, log):
         """Create the /secrets folder that will be bind-mounted by docker."""
@@ -298,6 +362,12 @@ class SimpleHandler(object):
             p = os.path.join(self.worker_dir, "volumes", self.rundef["project"], v)
             if not os.path.exists(p):
                 os.makedirs(p)
+            # Held for the rest of the run so that the worker's disk GC
+            # won't evict the volume while it's mounted
+            lock = open(p + ".lock", "a")
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            os.utime(lock.name)
+            self._volume_locks.append(lock)
             log.info("Creating volume: %s", p)
             volumes.append((p, path))
 
@@ -376,9 +446,57 @@ class SimpleHandler(object):
             f.write("--netrcfile /root/.netrc")
         return (netrc, "/root/.netrc"), (curlrc, "/root/.curlrc")
 
-    def _clone_script_repo(self, log, repo, dst):
+    @property
+    def git_cache(self):
+        return GitMirrorCache(os.path.join(self.worker_dir, "git-mirrors"))
+
+    def _git_clone(self, log, url, dst, key=None, env=None, retriable=False, lfs=False):
+        """Clone url into dst, borrowing objects from the worker's mirror of
+        the repository when possible. `key` identifies the mirror when url
+        has credentials embedded in it.
+
+        With `lfs`, the clone's lfs.storage is pointed at the mirror so that
+        LFS objects are cached there too. The caller must check out what it
+        needs and then call `_lfs_dissociate`."""
+        execute = log.exec_retriable if retriable else log.exec
+        with self.git_cache.reference(log, url, key, env) as mirror:
+            args = ["git", "clone"]
+            if mirror:
+                if lfs:
+                    # saved in the clone's config so later checkouts use it
+                    args += ["-c", "lfs.storage=" + os.path.join(mirror, "lfs")]
+                # --dissociate copies the borrowed objects so the clone
+                # doesn't break if the mirror gets evicted
+                args += ["--reference", mirror, "--dissociate"]
+            return execute(args + [url, dst], env=env)
+
+    def _lfs_dissociate(self, log, dst, env=None):
+        """Copy the LFS objects dst has checked out from the mirror's
+        lfs.storage into dst and stop using the mirror."""
+        cmd = ["git", "config", "--local", "lfs.storage"]
+        p = subprocess.run(cmd, cwd=dst, stdout=subprocess.PIPE)
+        storage = p.stdout.decode().strip()
+        if not storage:
+            return
+        cmd = ["git", "lfs", "ls-files", "--long"]
+        p = subprocess.run(cmd, cwd=dst, env=env, stdout=subprocess.PIPE)
+        for line in p.stdout.decode().splitlines():
+            oid = line.split(" ", 1)[0]
+            path = os.path.join("objects", oid[:2], oid[2:4], oid)
+            src = os.path.join(storage, path)
+            obj = os.path.join(dst, ".git/lfs", path)
+            if not os.path.exists(src) or os.path.exists(obj):
+                continue
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                os.link(src, obj)
+            except OSError:
+                shutil.copyfile(src, obj)
+        if not log.exec(["git", "config", "--unset", "lfs.storage"], cwd=dst):
+            raise HandlerError("Unable to dissociate LFS objects")
+
+    def _script_repo_url(self, repo):
         url = repo["clone-url"]
-        log.info("Repo is: %s", url)
         token = repo.get("token")
         if token:
             parts = token.split(":")
@@ -391,10 +509,14 @@ class SimpleHandler(object):
                 token += ":" + self.rundef["secrets"][parts[1]]
                 p = urllib.parse.urlsplit(url)
                 url = p.scheme + "://" + token + "@" + p.netloc + p.path
+        return url
 
+    def _clone_script_repo(self, log, repo, dst):
+        log.info("Repo is: %s", repo["clone-url"])
+        url = self._script_repo_url(repo)
         if os.path.exists(dst):
             shutil.rmtree(dst)  # probably a rebooted run
-        if not log.exec(["git", "clone", url, dst]):
+        if not self._git_clone(log, url, dst, key=repo["clone-url"]):
             raise HandlerError("Unable to clone repo: " + repo["clone-url"])
 
         ref = repo.get("git-ref")
@@ -477,55 +599,126 @@ class SimpleHandler(object):
         signal.signal(signal.SIGALRM, self._on_alarm)
         signal.alarm(self.rundef["timeout"] * 60)
 
-    def _junit_errors(self, log, junit_xml):
+    @staticmethod
+    def _iter_junit(path):
+        """Walk a junit file yielding ("start", testsuite), ("testcase", tc),
+        and ("end", testsuite) events. Elements are dropped as soon as they
+        have been handled so memory use doesn't grow with the file."""
+        stack = []
+        for event, elem in ET.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                if elem.tag == "testsuite":
+                    yield "start", elem
+                continue
+            stack.pop()
+            parent = stack[-1] if stack else None
+            if elem.tag == "testsuite":
+                yield "end", elem
+            elif elem.tag == "testcase" and parent is not None:
+                if parent.tag == "testsuite":
+                    yield "testcase", elem
+            if parent is not None and parent.tag in ("testsuite", "testsuites"):
+                parent.remove(elem)
+            elif parent is None:
+                elem.clear()
+
+    @staticmethod
+    def _junit_status(tc):
+        child = tc[0] if len(tc) else None
+        if child is not None:
+            if child.tag in ("error", "failure"):
+                return "FAILED"
+            elif child.tag == "skipped":
+                return "SKIPPED"
+        return "PASSED"
+
+    def _junit_suites(self, path, names):
+        """The first pass over a junit file. This finds the name, context, and
+        result of each testsuite, in the order they start, so that results
+        can be streamed to the server on the second pass. Suites named the
+        same as one in `names` are given a numbered name, since later batches
+        find their Test by name."""
+        suites = []
+        counts = []
+        stack = []
+        for event, elem in self._iter_junit(path):
+            if event == "start":
+                stack.append(len(suites))
+                suites.append(None)
+                counts.append({"result": "PASSED", "skipped": 0})
+            elif event == "testcase":
+                status = self._junit_status(elem)
+                if status == "FAILED":
+                    counts[stack[-1]]["result"] = status
+                elif status == "SKIPPED":
+                    counts[stack[-1]]["skipped"] += 1
+            else:
+                idx = stack.pop()
+                # some runners like junit don't set the "skipped" attribute,
+                # so look at both values we've found and pick the biggest one
+                attr_skipped = int(elem.attrib.get("skipped", "0"))
+                skipped = max(attr_skipped, counts[idx]["skipped"])
+                name = elem.attrib.get("name") or "junit"
+                context = "junit.xml skipped=%d" % skipped
+                suites[idx] = [name, context, counts[idx]["result"]]
+        for suite in suites:
+            name = suite[0]
+            i = 1
+            while suite[0] in names:
+                i += 1
+                suite[0] = "%s-%d" % (name, i)
+            names.add(suite[0])
+        return suites
+
+    def _junit_errors(self, log, path, names):
         try:
-            root = ET.fromstring(junit_xml)
+            suites = self._junit_suites(path, names)
         except ET.ParseError as pe:
             log.warn("Unable to parse junit.xml: %s\n" % pe)
             return True
 
-        failed = False
-        skipped = 0
-        for ts in root.iter("testsuite"):
-            results = []
-            result = "PASSED"
+        def send(suite):
+            name, context, result = suite["info"]
+            if suite["sent"]:
+                r = self.jobserv.update_test(name, context, suite["results"])
+            else:
+                r = self.jobserv.add_test(name, context, result, suite["results"])
+            suite["sent"] = True
+            suite["results"] = []
+            if r:
+                log.error(
+                    "Unable to create test results on server: %d\n%s",
+                    r.status_code,
+                    r.text,
+                )
 
-            for tc in ts:
-                status = "PASSED"
+        # The second pass sends each testsuite's results in batches of
+        # JUNIT_BATCH. The first batch creates the Test, the rest append to it
+        failed = False
+        stack = []
+        suites = iter(suites)
+        for event, elem in self._iter_junit(path):
+            if event == "start":
+                stack.append({"info": next(suites), "results": [], "sent": False})
+            elif event == "testcase":
+                status = self._junit_status(elem)
                 output = None
-                child = list(tc)
-                if len(child):
-                    if child[0].tag in ("error", "failure"):
-                        status = "FAILED"
-                        result = status
-                        failed = True
-                        output = ET.tostring(tc, encoding="unicode")
-                    elif child[0].tag == "skipped":
-                        skipped += 1
-                        status = "SKIPPED"
-                results.append(
+                if status == "FAILED":
+                    failed = True
+                    output = ET.tostring(elem, encoding="unicode")
+                stack[-1]["results"].append(
                     {
-                        "name": tc.attrib["name"],
-                        "context": tc.attrib.get("classname"),
+                        "name": elem.attrib["name"],
+                        "context": elem.attrib.get("classname"),
                         "status": status,
                         "output": output,
                     }
                 )
-
-            # some runners like junit don't set the "skipped" attribute,
-            # so look at both values we've found and pick the biggest one
-            attr_skipped = int(ts.attrib.get("skipped", "0"))
-            context = "junit.xml skipped=%d" % max(attr_skipped, skipped)
-            name = ts.attrib.get("name")
-            if not name:
-                name = "junit"
-            r = self.jobserv.add_test(name, context, result, results)
-            if r:
-                log.error(
-                    "Unable to create test results on server: %d\n%s",
-                    r.status_code,
-                    r.text,
-                )
+                if len(stack[-1]["results"]) >= self.JUNIT_BATCH:
+                    send(stack[-1])
+            else:
+                send(stack.pop())
         if failed:
             log.error("Found failure(s)")
         return failed
@@ -535,11 +728,11 @@ class SimpleHandler(object):
         and TestResult objects for the Run."""
         pattern = os.path.join(self.run_dir, "archive/junit.xml*")
         errors = False
-        for path in glob.glob(pattern):
-            with open(path) as f:
-                msg = "Analyzing junit results(%s)" % path
-                with self.log_context(msg) as log:
-                    errors |= self._junit_errors(log, f.read())
+        names = set()
+        for path in sorted(glob.glob(pattern)):
+            msg = "Analyzing junit results(%s)" % path
+            with self.log_context(msg) as log:
+                errors |= self._junit_errors(log, path, names)
         return errors
 
     def upload_artifacts(self):
@@ -601,6 +794,27 @@ class SimpleHandler(object):
             rundef["api_key"] = "simulated"
         return JobServApi(rundef["run_url"], rundef["api_key"])
 
+    def prefetch_repos(self, log):
+        """Bring the worker's mirrors of the repositories this run clones up
+        to date."""
+        repo = self.rundef.get("script-repo")
+        if repo and not self.rundef.get("reboot-script"):
+            url = self._script_repo_url(repo)
+            with self.git_cache.reference(log, url, repo["clone-url"]):
+                pass
+
+    @classmethod
+    def prefetch(clazz, worker_dir, run_dir, rundef):
+        """Pull the container and update the git mirrors for a run that's
+        been reserved for this worker while its current run uploads.
+        Nothing is reported to the server since the reservation can expire
+        and the run go to another worker. The run still does each step, but
+        they find the caches warm."""
+        h = clazz(worker_dir, run_dir, None, rundef)
+        h.docker_pull()
+        with h.log_context("Updating git mirrors") as log:
+            h.prefetch_repos(log)
+
     @classmethod
     def execute(clazz, worker_dir, run_dir, rundef):
         jobserv = clazz.get_jobserv(rundef)
@@ -649,6 +863,9 @@ class SimpleHandler(object):
                 except Exception:
                     stack = traceback.format_exc()
                     print("Unable to fail job:\n" + stack)
+        finally:
+            if not JobServApi.SIMULATED:
+                jobserv.log_http_latency()
         return False
 
 
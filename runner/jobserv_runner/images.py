@@ -0,0 +1,83 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+# An image pulled this recently, that hasn't changed locally since, is
+# considered up to date and won't be pulled again.
+IMAGE_FRESH_SECONDS = int(os.environ.get("JOBSERV_IMAGE_FRESH_SECONDS", "600"))
+
+
+def local_image_id(ref):
+    try:
+        out = subprocess.check_output(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", ref],
+            stderr=subprocess.DEVNULL,
+        )
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ImageManager(object):
+    """Coordinates container pulls between the runs on a worker.
+
+    Each image reference has a lock file and a state file under
+    <worker_dir>/images. Only one run pulls a given reference at a time.
+    The others wait on the lock and then find that the image was just
+    pulled, so they don't pull it again. The worker's pre-pull uses the
+    same files, so the runs find its pulls too.
+    """
+
+    def __init__(self, worker_dir, fresh_seconds=None):
+        self.images_dir = os.path.join(worker_dir, "images")
+        self.fresh_seconds = fresh_seconds
+        if fresh_seconds is None:
+            self.fresh_seconds = IMAGE_FRESH_SECONDS
+
+    def _path(self, ref):
+        return os.path.join(self.images_dir, hashlib.sha256(ref.encode()).hexdigest())
+
+    @contextlib.contextmanager
+    def locked(self, ref):
+        os.makedirs(self.images_dir, exist_ok=True)
+        with open(self._path(ref) + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            os.utime(f.name)  # the worker's disk GC evicts by last use
+            yield
+
+    def is_fresh(self, ref):
+        try:
+            with open(self._path(ref) + ".json") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if time.time() - state["pulled"] > self.fresh_seconds:
+            return False
+        return state["id"] == local_image_id(ref)
+
+    def record(self, ref):
+        state = {"ref": ref, "pulled": time.time(), "id": local_image_id(ref)}
+        path = self._path(ref) + ".json"
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.rename(path + ".tmp", path)
+
+    def pull(self, log, ref, pull_cb):
+        """Pull `ref` by calling pull_cb unless another run on this worker
+        has just pulled it. Returns the result of pull_cb or True if the
+        pull was skipped."""
+        with self.locked(ref):
+            if self.is_fresh(ref):
+                log.info("Image is up to date from a recent pull, skipping")
+                return True
+            if pull_cb():
+                self.record(ref)
+                return True
+            return False
@@ -2,63 +2,89 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import datetime
+import gzip
+import hashlib
 import json
 import logging
 import mimetypes
 import os
 import time
-import urllib.error
-import urllib.request
 import urllib.parse
 
 from http.client import HTTPException
 from socket import timeout
 
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import requests
+from jobserv_runner.transport import get_pool
+
+# Payloads at least this big are gzip'd before being sent to the server
+GZIP_MIN_BYTES = 4096
+
+# Artifacts at least this big are sent with resumable uploads when the
+# storage backend supports them. They are sent in UPLOAD_CHUNK_BYTES pieces
+# so that a failure only requires re-sending the current chunk.
+RESUMABLE_MIN_BYTES = 64 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 16 * 1024 * 1024  # must be a multiple of 256KiB for GCS
+
+# Number of threads used to upload artifacts. 0 means to scale with the
+# number and size of the artifacts.
+UPLOAD_WORKERS = int(os.environ.get("JOBSERV_UPLOAD_WORKERS", "0"))
+
+# Artifacts at least this big are hashed so the server can skip uploading
+# ones it already has. 0 disables this.
+DEDUP_MIN_BYTES = int(os.environ.get("JOBSERV_DEDUP_MIN_BYTES", str(1024 * 1024)))
 
 
 def split(items, group_size):
     return [items[i : i + group_size] for i in range(0, len(items), group_size)]
 
 
+def gzip_body(data, headers):
+    """Compress data if its big enough to be worth it, setting the
+    Content-Encoding header to match."""
+    if data and len(data) >= GZIP_MIN_BYTES:
+        headers["Content-Encoding"] = "gzip"
+        return gzip.compress(data, 6)
+    return data
+
+
 class PostError(Exception):
-    pass
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status  # None when the server couldn't be reached
 
 
 class RunCancelledError(Exception):
     pass
 
 
-def urllib_error_str(e):
-    if hasattr(e, "code"):
-        error = "HTTP_%d" % e.code
-    else:
-        error = "HTTP Error"
-    if hasattr(e, "reason"):
-        error += ": %s" % e.reason
-    if hasattr(e, "read"):
-        error += "\n" + e.read().decode()
+def http_error_str(resp):
+    error = "HTTP_%d" % resp.status
+    if resp.reason:
+        error += ": %s" % resp.reason
+    if resp.data:
+        error += "\n" + resp.text
     return error
 
 
-def _post(url, data, headers, raise_error=False):
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+def _post(url, data, headers, raise_error=False, retries=0, name="post"):
     try:
-        resp = urllib.request.urlopen(req, timeout=15)
-        if resp.headers.get("X-JOBSERV-CANCEL"):
-            raise RunCancelledError()
-        return resp
-    except urllib.error.URLError as e:
-        error = urllib_error_str(e)
-        logging.error("%s: %s", url, error)
-        if raise_error:
-            raise PostError(error)
-    except (timeout, HTTPException) as e:
+        resp = get_pool().request("POST", url, data, headers, name, retries)
+    except (OSError, timeout, HTTPException) as e:
         logging.exception("Unable to post to: " + url)
         if raise_error:
             raise PostError(str(e))
+        return
+    if resp.status >= 400:
+        error = http_error_str(resp)
+        logging.error("%s: %s", url, error)
+        if raise_error:
+            raise PostError(error, resp.status)
+        return
+    if resp.headers.get("X-JOBSERV-CANCEL"):
+        raise RunCancelledError()
+    return resp
 
 
 class JobServApi(object):
@@ -69,18 +95,33 @@ class JobServApi(object):
         self._run_url = run_url
         self._api_key = api_key
 
-    def _post(self, data, headers, retry):
+    def _post(self, data, headers, retry, raise_error=False):
         if self.SIMULATED:
             if data:
                 return os.write(1, data)
             return True
-        for x in range(retry):
-            if _post(self._run_url, data, headers):
-                return True
-            time.sleep(2 * x + 1)  # try and give the server a moment
-        return False
+        # the pool handles the back-off between attempts
+        resp = _post(
+            self._run_url,
+            data,
+            headers,
+            raise_error,
+            retries=retry - 1,
+            name="update_run",
+        )
+        return resp is not None
 
-    def update_run(self, msg, status=None, retry=2, metadata=None):
+    def log_http_latency(self):
+        for name, (count, total, slowest) in sorted(get_pool().latency.items()):
+            logging.info(
+                "HTTP %s: %d calls, %.3fs avg, %.3fs max",
+                name,
+                count,
+                total / count,
+                slowest,
+            )
+
+    def update_run(self, msg, status=None, retry=2, metadata=None, raise_error=False):
         headers = {
             "content-type": "text/plain",
             "Authorization": "Token " + self._api_key,
@@ -89,7 +130,9 @@ class JobServApi(object):
             headers["X-RUN-STATUS"] = status
         if metadata:
             headers["X-RUN-METADATA"] = metadata
-        return self._post(msg, headers, retry=retry)
+        if not self.SIMULATED:
+            msg = gzip_body(msg, headers)
+        return self._post(msg, headers, retry=retry, raise_error=raise_error)
 
     def update_status(self, status, msg, metadata=None):
         msg = "== %s: %s\n" % (datetime.datetime.utcnow(), msg)
@@ -99,8 +142,22 @@ class JobServApi(object):
         if not self.update_run(msg.encode(), status, 8, metadata):
             logging.error("TODO HOW TO HANDLE?")
 
+    def update_resources(self, summary):
+        """Send the resource usage summary of the run's container."""
+        if self.SIMULATED:
+            return True
+        headers = {
+            "content-type": "text/plain",
+            "Authorization": "Token " + self._api_key,
+            "X-RUN-RESOURCES": json.dumps(summary),
+        }
+        return self._post(b"", headers, retry=2)
+
     def add_test(self, test_name, context, status, results=[]):
-        headers = {"Authorization": "Token " + self._api_key}
+        headers = {
+            "content-type": "application/json",
+            "Authorization": "Token " + self._api_key,
+        }
         test = {
             "context": context,
             "status": status,
@@ -112,14 +169,34 @@ class JobServApi(object):
             )
             return
         url = self._run_url + "tests/%s/" % test_name
-        for x in range(3):
-            r = requests.post(url, json=test, headers=headers)
-            if r.status_code == 200:
-                return
-            time.sleep(2 * x + 1)  # try and give the server a moment
+        data = gzip_body(json.dumps(test).encode(), headers)
+        r = get_pool().request("POST", url, data, headers, "add_test", retries=2)
+        if r.status == 200:
+            return
         return r
 
-    def _get_urls(self, uploads):
+    def update_test(self, test_name, context, results):
+        """Append results to a test created with add_test."""
+        headers = {
+            "content-type": "application/json",
+            "Authorization": "Token " + self._api_key,
+        }
+        if self.SIMULATED:
+            print(
+                "== %s: Test(%s) +%d results\n"
+                % (datetime.datetime.utcnow(), test_name, len(results))
+            )
+            return
+        url = self._run_url + "tests/%s/" % test_name
+        if context:
+            url += "?" + urllib.parse.urlencode({"context": context})
+        data = gzip_body(json.dumps({"results": results}).encode(), headers)
+        r = get_pool().request("PUT", url, data, headers, "update_test", retries=2)
+        if r.status == 200:
+            return
+        return r
+
+    def _get_urls(self, uploads, resumable=False):
         headers = {
             "content-type": "application/json",
             "Authorization": "Token " + self._api_key,
@@ -128,12 +205,24 @@ class JobServApi(object):
         if url[-1] != "/":
             url += "/"
         url += "create_signed"
+        if resumable:
+            url += "?resumable=1"
 
-        urls = [x["file"] for x in uploads]
+        if any(x.get("sha256") for x in uploads):
+            urls = {
+                x["file"]: (
+                    {"sha256": x["sha256"], "md5": x["md5"]}
+                    if x.get("sha256")
+                    else None
+                )
+                for x in uploads
+            }
+        else:
+            urls = [x["file"] for x in uploads]
         data = json.dumps(urls).encode()
         for i in range(1, 5):
             try:
-                resp = _post(url, data, headers)
+                resp = _post(url, data, headers, name="create_signed")
                 return json.loads(resp.read().decode())["data"]["urls"]
             except Exception:
                 if i == 4:
@@ -141,12 +230,84 @@ class JobServApi(object):
                 logging.exception("Unable to get urls, sleeping and retrying")
                 time.sleep(2 * i)
 
+    @staticmethod
+    def _hash(path):
+        """Return the sha256 and md5 of the file. The server can check the
+        md5 against what its storage backend recorded for the upload."""
+        h = hashlib.sha256()
+        m = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+                m.update(chunk)
+        return h.hexdigest(), m.hexdigest()
+
+    def _sign(self, artifacts_dir, uploads, resumable):
+        # hashing is done here so it overlaps with the previous group's upload
+        if DEDUP_MIN_BYTES:
+            for x in uploads:
+                if x["size"] >= DEDUP_MIN_BYTES and "sha256" not in x:
+                    path = os.path.join(artifacts_dir, x["file"])
+                    x["sha256"], x["md5"] = self._hash(path)
+        return self._get_urls(uploads, resumable)
+
+    def _upload_resumable(self, f, artifact, urldata):
+        """Perform a GCS style resumable upload: start a session with the
+        signed URL, then PUT the file in chunks. If a chunk fails, ask the
+        session how much it has and carry on from there."""
+        pool = get_pool()
+        headers = {"Content-Type": urldata["content-type"], "x-goog-resumable": "start"}
+        r = pool.request("POST", urldata["url"], b"", headers, "upload", retries=2)
+        if r.status not in (200, 201):
+            return "Unable to start upload of %s: %s" % (artifact, http_error_str(r))
+        session = r.headers["Location"]
+
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        failures = 0
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(UPLOAD_CHUNK_BYTES)
+            end = offset + len(chunk) - 1
+            headers = {"Content-Range": "bytes %d-%d/%d" % (offset, end, size)}
+            try:
+                r = pool.request("PUT", session, chunk, headers, "upload", retries=0)
+                if r.status in (200, 201):
+                    return
+                if r.status == 308:
+                    offset = end + 1
+                    continue
+                error = http_error_str(r)
+            except Exception as e:
+                error = str(e)
+
+            failures += 1
+            if failures > 4:
+                return "Unable to upload %s: %s" % (artifact, error)
+            logging.warning("Chunk upload of %s failed, resuming: %s", artifact, error)
+            time.sleep(2 * failures)
+            headers = {"Content-Range": "bytes */%d" % size}
+            try:
+                r = pool.request("PUT", session, b"", headers, "upload", retries=2)
+            except Exception:
+                continue  # try the same chunk again
+            if r.status in (200, 201):
+                return
+            if r.status == 308:
+                # Range is "bytes=0-N" for what the server has persisted
+                persisted = r.headers.get("Range")
+                offset = int(persisted.split("-")[1]) + 1 if persisted else 0
+
     def _upload_item(self, artifacts_dir, artifact, urldata):
         # http://stackoverflow.com/questions/2502596/
         with open(os.path.join(artifacts_dir, artifact), "rb") as f:
             try:
+                if urldata.get("resumable"):
+                    return self._upload_resumable(f, artifact, urldata)
                 headers = {"Content-Type": urldata["content-type"]}
-                r = requests.put(urldata["url"], data=f, headers=headers)
+                r = get_pool().request(
+                    "PUT", urldata["url"], f, headers, "upload", retries=0
+                )
                 if r.status_code not in (200, 201):
                     return "Unable to upload %s: HTTP_%d\n%s" % (
                         artifact,
@@ -156,31 +317,72 @@ class JobServApi(object):
             except Exception as e:
                 return "Unexpected error for %s: %s" % (artifact, str(e))
 
+    @staticmethod
+    def _upload_workers(uploads):
+        if UPLOAD_WORKERS:
+            return UPLOAD_WORKERS
+        total = sum(x["size"] for x in uploads)
+        workers = 4 + len(uploads) // 200 + total // (1024 * 1024 * 1024)
+        return min(workers, 16)
+
     def upload(self, artifacts_dir, uploads):
-        def _upload_cb(data):
+        def _upload_cb(artifact, urldata):
             e = None
+            if urldata.get("stored"):
+                return  # the server already has this content
             for i in range(1, 5):
-                e = self._upload_item(artifacts_dir, data[0], data[1])
+                e = self._upload_item(artifacts_dir, artifact, urldata)
                 if not e:
                     break
-                msg = "Error uploading %s, sleeping and retrying" % data[0]
+                msg = "Error uploading %s, sleeping and retrying" % artifact
                 self.update_status("UPLOADING", msg)
                 time.sleep(2 * i)  # try and give the server a moment
             return e
 
+        # Upload the biggest files first so that one doesn't get stuck being
+        # the long tail of the upload. Big files get resumable URLs.
+        uploads = sorted(uploads, key=lambda x: x["size"], reverse=True)
+        big = [x for x in uploads if x["size"] >= RESUMABLE_MIN_BYTES]
+        small = uploads[len(big) :]
+
         # it seems that 100 is about the most URLs you can sign in one HTTP
         # request, so we'll split up our uploads array into groups of 75 to
-        # be safe and upload them in bunches
-        errors = []
-        upload_groups = split(uploads, 75)
-        for i, upload_group in enumerate(upload_groups):
-            if self.SIMULATED:
+        # be safe and upload them in bunches. Big files are signed in
+        # smaller groups so their URLs don't expire before they are started.
+        workers = self._upload_workers(uploads)
+        upload_groups = [(x, True) for x in split(big, workers)]
+        upload_groups += [(x, False) for x in split(small, 75)]
+        if self.SIMULATED:
+            for upload_group, _ in upload_groups:
                 self.update_status("UPLOADING", "simulate %s" % upload_group)
-                continue
-            urls = self._get_urls(upload_group)
-            p = ThreadPool(4)
-            errors.extend([x for x in p.map(_upload_cb, urls.items()) if x])
-            if len(upload_groups) > 2:  # lets give some status messages
-                msg = "Uploading %d%% complete" % (100 * (i + 1) / len(upload_groups))
-                self.update_status("UPLOADING", msg)
+            return []
+
+        # The URLs for the next group are signed while the current group is
+        # uploading. We never sign more than one group ahead so the signed
+        # URLs don't expire while waiting in the queue.
+        errors = []
+        in_flight = []
+        with ThreadPoolExecutor(1) as signer, ThreadPoolExecutor(workers) as pool:
+            signing = signer.submit(self._sign, artifacts_dir, *upload_groups[0])
+            for i, (upload_group, _) in enumerate(upload_groups):
+                urls = signing.result()
+                in_flight.append(
+                    [
+                        pool.submit(_upload_cb, x["file"], urls[x["file"]])
+                        for x in upload_group
+                    ]
+                )
+                if len(in_flight) > 1:
+                    done = in_flight.pop(0)
+                    wait(done)
+                    errors.extend([x.result() for x in done if x.result()])
+                    if len(upload_groups) > 2:  # lets give some status messages
+                        pct = 100 * i / len(upload_groups)
+                        self.update_status("UPLOADING", "Uploading %d%% complete" % pct)
+                if i + 1 < len(upload_groups):
+                    group, resumable = upload_groups[i + 1]
+                    signing = signer.submit(self._sign, artifacts_dir, group, resumable)
+            for done in in_flight:
+                wait(done)
+                errors.extend([x.result() for x in done if x.result()])
         return errors
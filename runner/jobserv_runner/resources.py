@@ -0,0 +1,173 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import array
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# How often a run's container is sampled. 0 disables sampling.
+SAMPLE_SECONDS = float(os.environ.get("JOBSERV_RESOURCE_SECONDS", "5"))
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def _read_keyed(path):
+    """Parse files like cpu.stat made of "key value" lines."""
+    vals = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                vals[parts[0]] = int(parts[1])
+    return vals
+
+
+class ResourceSampler(object):
+    """Samples the cgroup of a run's container from a background thread.
+
+    Each counter is kept in its own array so that a long run's samples
+    stay small. The cpu and io counters are cumulative, so the last sample
+    is the total for the run. Both cgroup v1 and v2 hosts are supported.
+    """
+
+    COLUMNS = ("cpu_usec", "mem_bytes", "io_read_bytes", "io_write_bytes")
+
+    def __init__(self, container, interval=None, proc_root="/proc"):
+        self.container = container
+        self.interval = SAMPLE_SECONDS if interval is None else interval
+        self.proc_root = proc_root
+        self.times = array.array("d")
+        self.series = {x: array.array("Q") for x in self.COLUMNS}
+        self.mem_peak = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _container_pid(self):
+        fmt = "{{.State.Pid}}"
+        cmd = ["docker", "inspect", "--format", fmt, self.container]
+        try:
+            out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+            return int(out.strip())
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return 0  # not started yet
+
+    def _find_cgroup(self):
+        """Return the container's cgroup as ("v2", path) or
+        ("v1", {controller: path})."""
+        pid = self._container_pid()
+        if not pid:
+            return None
+        v1 = {}
+        unified = None
+        with open(os.path.join(self.proc_root, str(pid), "cgroup")) as f:
+            for line in f:
+                _, controllers, path = line.strip().split(":", 2)
+                if not controllers:
+                    unified = "/sys/fs/cgroup" + path
+                for c in controllers.split(","):
+                    v1[c] = os.path.join("/sys/fs/cgroup", controllers) + path
+        # hybrid hosts have both, but the controllers are all in v1
+        if "memory" in v1:
+            return "v1", v1
+        return "v2", unified
+
+    def _read_v2(self, path):
+        cpu = _read_keyed(os.path.join(path, "cpu.stat"))["usage_usec"]
+        mem = _read_int(os.path.join(path, "memory.current"))
+        try:
+            # memory.peak is only in newer kernels
+            self.mem_peak = max(_read_int(os.path.join(path, "memory.peak")), mem)
+        except FileNotFoundError:
+            pass
+        rbytes = wbytes = 0
+        try:
+            with open(os.path.join(path, "io.stat")) as f:
+                for line in f:
+                    stats = dict(x.split("=") for x in line.split()[1:])
+                    rbytes += int(stats.get("rbytes", 0))
+                    wbytes += int(stats.get("wbytes", 0))
+        except FileNotFoundError:
+            pass  # the io controller isn't enabled
+        return cpu, mem, rbytes, wbytes
+
+    def _read_v1(self, paths):
+        cpu = _read_int(os.path.join(paths["cpuacct"], "cpuacct.usage")) // 1000
+        mem = _read_int(os.path.join(paths["memory"], "memory.usage_in_bytes"))
+        peak = os.path.join(paths["memory"], "memory.max_usage_in_bytes")
+        self.mem_peak = max(_read_int(peak), mem)
+        rbytes = wbytes = 0
+        path = os.path.join(paths["blkio"], "blkio.throttle.io_service_bytes")
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[1] == "Read":
+                    rbytes += int(parts[2])
+                elif len(parts) == 3 and parts[1] == "Write":
+                    wbytes += int(parts[2])
+        return cpu, mem, rbytes, wbytes
+
+    def sample(self, cgroup, elapsed):
+        version, path = cgroup
+        vals = self._read_v2(path) if version == "v2" else self._read_v1(path)
+        self.times.append(elapsed)
+        for name, val in zip(self.COLUMNS, vals):
+            self.series[name].append(val)
+        self.mem_peak = max(self.mem_peak, vals[1])
+
+    def _run(self):
+        start = time.monotonic()
+        cgroup = None
+        # poll quickly until the container is up, then at the interval
+        while not self._stop.wait(self.interval if cgroup else 1):
+            try:
+                if cgroup is None:
+                    cgroup = self._find_cgroup()
+                    if cgroup is None:
+                        continue
+                self.sample(cgroup, time.monotonic() - start)
+            except FileNotFoundError:
+                return  # the container has exited
+            except Exception:
+                logging.exception("Unable to sample container resources")
+                return
+
+    def summary(self):
+        if not self.times:
+            return None
+        return {
+            "cpu_usec": self.series["cpu_usec"][-1],
+            "mem_peak_bytes": self.mem_peak,
+            "io_read_bytes": self.series["io_read_bytes"][-1],
+            "io_write_bytes": self.series["io_write_bytes"][-1],
+        }
+
+    def save(self, path):
+        """Write the time series to `path` and return the summary."""
+        summary = self.summary()
+        if summary:
+            data = {
+                "interval": self.interval,
+                "summary": summary,
+                "seconds": [round(x, 1) for x in self.times],
+            }
+            data.update({k: v.tolist() for k, v in self.series.items()})
+            with open(path, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+        return summary
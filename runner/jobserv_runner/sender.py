@@ -0,0 +1,202 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import collections
+import logging
+import tempfile
+import threading
+import time
+
+from jobserv_runner.jobserv import PostError, RunCancelledError
+
+# Client errors that can succeed if tried again later
+RETRY_4XX = (408, 429)
+
+
+class ConsoleSender(object):
+    """Ships console output to the JobServ from a background thread so that
+    a slow or flaky server never blocks the command producing the output.
+
+    Writes are queued in memory up to `max_queued` bytes. Beyond that,
+    output is spilled to a local temporary file rather than blocking the
+    writer. The spill file is drained once the in-memory queue has been
+    sent, so output is always delivered in the order it was written.
+
+    Batches are sent when `batch_bytes` have been queued or the oldest
+    queued data is `batch_seconds` old. The batch size adapts to how long
+    the server takes to accept a batch: slow posts grow it to cut down on
+    round trips, quick ones shrink it to keep the console interactive.
+    """
+
+    MIN_BATCH = 16 * 1024
+    MAX_BATCH = 1024 * 1024
+
+    def __init__(self, jobserv, max_queued=8 * 1024 * 1024, batch_seconds=2):
+        self.jobserv = jobserv
+        self.max_queued = max_queued
+        self.batch_seconds = batch_seconds
+        self.batch_bytes = 64 * 1024
+
+        self._queue = collections.deque()
+        self._queued = 0
+        self._oldest = None
+        self._spill = None
+        self._spill_read = 0
+        self._spill_write = 0
+        self._sending = 0
+        self._flushing = 0
+        self._closed = False
+        self._cancelled = False
+
+        self._cv = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _check_cancelled(self):
+        if self._cancelled:
+            self._cancelled = False  # only raise this once
+            raise RunCancelledError()
+
+    def write(self, buf):
+        """Queue `buf` to be sent. This never blocks on the network."""
+        with self._cv:
+            self._check_cancelled()
+            if not buf:
+                return True
+            if self._spill_write > self._spill_read or (
+                self._queued + len(buf) > self.max_queued
+            ):
+                # Once we've spilled, everything has to go through the spill
+                # file until its drained to keep the output in order.
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile(prefix="console-spill-")
+                self._spill.seek(self._spill_write)
+                self._spill.write(buf)
+                self._spill_write += len(buf)
+            else:
+                self._queue.append(buf)
+                self._queued += len(buf)
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._cv.notify()
+        return True
+
+    def _pending(self):
+        return self._queued + self._spill_write - self._spill_read
+
+    def _next_batch(self):
+        """Take the next batch of output off the queue, or the spill file
+        once the queue is empty."""
+        if self._queue:
+            bufs = []
+            size = 0
+            while self._queue and size < self.batch_bytes:
+                buf = self._queue.popleft()
+                bufs.append(buf)
+                size += len(buf)
+            self._queued -= size
+            return b"".join(bufs)
+        self._spill.flush()
+        self._spill.seek(self._spill_read)
+        buf = self._spill.read(self.batch_bytes)
+        self._spill_read += len(buf)
+        if self._spill_read == self._spill_write:
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spill_read = self._spill_write = 0
+        return buf
+
+    def _ready(self):
+        pending = self._pending()
+        if not pending:
+            return False
+        if self._closed or self._flushing or pending >= self.batch_bytes:
+            return True
+        return time.time() - self._oldest >= self.batch_seconds
+
+    def _send(self, buf):
+        delay = 1
+        while True:
+            start = time.time()
+            try:
+                if self.jobserv.update_run(buf, retry=1, raise_error=True):
+                    break
+            except RunCancelledError:
+                # The server accepted the data but wants the run stopped
+                with self._cv:
+                    self._cancelled = True
+                break
+            except PostError as e:
+                # Sending the same thing again won't change the server's mind
+                status = e.status or 0
+                if 400 <= status < 500 and status not in RETRY_4XX:
+                    logging.error(
+                        "Server rejected console output with HTTP_%d, "
+                        "dropping %d bytes",
+                        status,
+                        len(buf),
+                    )
+                    return
+            except Exception:
+                logging.exception("Unexpected error sending console output")
+            with self._cv:
+                if self._closed and self._flushing == 0:
+                    logging.error("Dropping %d bytes of console output", len(buf))
+                    return
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+        elapsed = time.time() - start
+        if elapsed > 1:
+            self.batch_bytes = min(self.batch_bytes * 2, self.MAX_BATCH)
+        elif elapsed < 0.2:
+            self.batch_bytes = max(self.batch_bytes // 2, self.MIN_BATCH)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._ready():
+                    if self._closed and not self._pending():
+                        return
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = self.batch_seconds
+                    self._cv.wait(timeout)
+                buf = self._next_batch()
+                self._sending += 1
+                if not self._pending():
+                    self._oldest = None
+            self._send(buf)
+            with self._cv:
+                self._sending -= 1
+                self._cv.notify_all()
+
+    def flush(self, timeout=300):
+        """Wait for everything written so far to be sent. Returns False if
+        that didn't happen within `timeout` seconds."""
+        deadline = time.time() + timeout
+        with self._cv:
+            self._flushing += 1
+            self._cv.notify_all()
+            try:
+                while self._pending() or self._sending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cv.wait(remaining)
+            finally:
+                self._flushing -= 1
+            self._check_cancelled()
+        return True
+
+    def close(self, timeout=300):
+        """Flush any remaining output and stop the sender thread."""
+        try:
+            return self.flush(timeout)
+        finally:
+            with self._cv:
+                self._closed = True
+                self._cv.notify_all()
+            self._thread.join(1)
+            if self._spill is not None:
+                self._spill.close()
@@ -0,0 +1,203 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import http.client
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# Status codes that are worth retrying. Anything else is returned to the
+# caller to deal with.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Requests taking longer than this are logged so slow servers are visible
+SLOW_REQUEST_SECONDS = 5
+
+
+class Response(object):
+    """The result of an HttpPool request. The body is read eagerly so that
+    the connection can be handed back to the pool. Attribute names mirror
+    both http.client (status, read) and requests (status_code, text) since
+    callers in the runner have used both."""
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    @property
+    def status_code(self):
+        return self.status
+
+    @property
+    def text(self):
+        return self.data.decode(errors="replace")
+
+    def read(self):
+        return self.data
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HttpPool(object):
+    """A small, thread-safe, keep-alive connection pool built on http.client
+    so that the runner doesn't need any third party packages.
+
+    Idle connections are kept per (scheme, host, port). Connection errors
+    and the statuses in RETRY_STATUSES are retried with an exponential
+    back-off. The time spent in each type of call is tracked in `latency`
+    which maps a name to [count, total seconds, max seconds].
+    """
+
+    def __init__(self, timeout=15, retries=3, backoff=1, max_idle=8):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.latency = {}
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = urllib.request.getproxies()
+
+    def _proxy_for(self, scheme, host):
+        proxy = self._proxies.get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            return urllib.parse.urlsplit(proxy)
+
+    def _new_conn(self, scheme, host, port):
+        proxy = self._proxy_for(scheme, host)
+        if scheme == "https":
+            ctx = ssl.create_default_context()
+            if proxy:
+                conn = http.client.HTTPSConnection(
+                    proxy.hostname, proxy.port, timeout=self.timeout, context=ctx
+                )
+                conn.set_tunnel(host, port)
+                return conn
+            return http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=ctx
+            )
+        if proxy:
+            # plain http proxies take the absolute URL as the request target
+            return http.client.HTTPConnection(
+                proxy.hostname, proxy.port, timeout=self.timeout
+            )
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _get_conn(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_conn(*key), False
+
+    def _put_conn(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    def _track(self, name, elapsed):
+        with self._lock:
+            stats = self.latency.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        if elapsed > SLOW_REQUEST_SECONDS:
+            logging.warning("Slow %s request: %.1fs", name, elapsed)
+
+    def _request_once(self, key, method, target, body, headers):
+        conn, reused = self._get_conn(key)
+        try:
+            conn.request(method, target, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection. This isn't a
+            # real failure, so try once more on a fresh connection
+            if hasattr(body, "seek"):
+                body.seek(0)
+            conn = self._new_conn(*key)
+            conn.request(method, target, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+        return Response(resp.status, resp.reason, resp.headers, data)
+
+    def request(self, method, url, body=None, headers=None, name=None, retries=None):
+        """Perform an HTTP request. `body` may be bytes or a file object.
+        Returns a Response or raises the last error seen after all retries
+        have been exhausted."""
+        p = urllib.parse.urlsplit(url)
+        port = p.port or (443 if p.scheme == "https" else 80)
+        key = (p.scheme, p.hostname, port)
+        target = p.path or "/"
+        if p.query:
+            target += "?" + p.query
+        if p.scheme == "http" and self._proxy_for(p.scheme, p.hostname):
+            target = url
+
+        headers = dict(headers or {})
+        if hasattr(body, "fileno"):
+            headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+        if retries is None:
+            retries = self.retries
+        name = name or method
+
+        for i in range(retries + 1):
+            if i:
+                time.sleep(self.backoff * 2 ** (i - 1))
+                if hasattr(body, "seek"):
+                    body.seek(0)
+            start = time.time()
+            try:
+                resp = self._request_once(key, method, target, body, headers)
+            except (http.client.HTTPException, OSError, socket.timeout) as e:
+                self._track(name, time.time() - start)
+                logging.warning("%s %s failed: %s", method, url, e)
+                if i == retries:
+                    raise
+                continue
+            self._track(name, time.time() - start)
+            if resp.status in RETRY_STATUSES and i < retries:
+                logging.warning("%s %s: HTTP_%d, retrying", method, url, resp.status)
+                continue
+            return resp
+
+
+_pool = None
+
+
+def get_pool():
+    """Return the HttpPool shared by everything in this runner process."""
+    global _pool
+    if _pool is None:
+        _pool = HttpPool()
+    return _pool
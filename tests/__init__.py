@@ -1,13 +1,15 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import contextlib
 import json
 
 from cryptography.fernet import Fernet
 from flask_testing import TestCase
+from sqlalchemy import event
 
 from jobserv import permissions, settings
-from jobserv.jsend import _status_str
+from jobserv.jsend import _response_cache, _status_str
 from jobserv.models import db, Project, ProjectTrigger
 from jobserv.flask import create_app
 from jobserv.storage import local_storage
@@ -25,11 +27,31 @@ class JobServTest(TestCase):
     def setUp(self):
         super().setUp()
         db.create_all()
+        # ids get reused by each test's database
+        _response_cache.clear()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
 
+    @contextlib.contextmanager
+    def assert_max_queries(self, limit):
+        """Fail if the block runs more than `limit` SQL statements. The
+        session is cleared first so objects created by the test can't hide
+        lazy loads. Those objects are detached afterwards."""
+        db.session.expunge_all()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertLessEqual(len(statements), limit, "\n\n".join(statements))
+
     def create_projects(self, *names):
         for n in names:
             db.session.add(Project(n))
@@ -0,0 +1,74 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+"""Serialize runs with and without URL templates to measure how much of
+the cost is URL building:
+
+  PYTHONPATH=. SQLALCHEMY_DATABASE_URI=sqlite:// python tests/bench_serializers.py
+
+The output of both is compared so this also checks they're identical.
+"""
+
+import argparse
+import sys
+import time
+
+from flask import url_for
+
+from jobserv import models, settings
+from jobserv.flask import create_app
+from jobserv.models import Build, Project, Run, db
+
+
+def _url_for(endpoint, **values):
+    return url_for(endpoint, _external=True, **values)
+
+
+def _serialize(app, runs, detailed):
+    with app.test_request_context("/", base_url="https://example.com/"):
+        start = time.perf_counter()
+        data = [r.as_json(detailed=detailed) for r in runs]
+        elapsed = time.perf_counter() - start
+        return elapsed, app.json.dumps(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10000)
+    parser.add_argument("--detailed", action="store_true")
+    args = parser.parse_args()
+
+    app = create_app(settings)
+    with app.app_context():
+        db.create_all()
+        p = Project("bench/project")
+        db.session.add(p)
+        db.session.commit()
+        builds = [Build.create(p) for _ in range(args.runs // 10)]
+        for b in builds:
+            for i in range(10):
+                db.session.add(Run(b, "run-%d" % i))
+        db.session.commit()
+        # keep lazy loads out of the timing
+        runs = Run.query.options(
+            db.joinedload(Run.build).joinedload(Build.project),
+            db.selectinload(Run.tests),
+            db.selectinload(Run.status_events),
+        ).all()
+
+        orig = models.external_url
+        models.external_url = _url_for
+        try:
+            url_for_secs, expected = _serialize(app, runs, args.detailed)
+        finally:
+            models.external_url = orig
+        template_secs, found = _serialize(app, runs, args.detailed)
+
+    if expected != found:
+        print("ERROR: output differs")
+        return 1
+    print("%d runs with url_for:       %.3fs" % (len(runs), url_for_secs))
+    print("%d runs with URL templates: %.3fs" % (len(runs), template_secs))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+"""Replay a build log through stream_cmd to measure the runner's own
+overhead on chatty commands:
+
+  PYTHONPATH=runner python tests/runner/bench_cmd.py [--log build.log]
+
+Without --log, a synthetic bitbake-like log of --size MB is generated.
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from jobserv_runner.cmd import stream_cmd
+
+LINE = (
+    b"NOTE: recipe %d: task do_compile: Started\n"
+    b"| arm-linux-gnueabihf-gcc -O2 -pipe -g -c foo%d.c -o foo%d.o\n"
+)
+
+
+def _synthetic_log(size_mb):
+    f = tempfile.NamedTemporaryFile(prefix="bench-log-", delete=False)
+    with f:
+        written = i = 0
+        while written < size_mb * 1024 * 1024:
+            chunk = b"".join(LINE % (x, x, x) for x in range(i, i + 1000))
+            f.write(chunk)
+            written += len(chunk)
+            i += 1000
+    return f.name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--log", help="A recorded build log to replay")
+    parser.add_argument("--size", type=int, default=512, help="MB to generate")
+    args = parser.parse_args()
+
+    log = args.log or _synthetic_log(args.size)
+    try:
+        size = os.stat(log).st_size
+        calls = [0]
+
+        def cb(buf):
+            calls[0] += 1
+            return True
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.monotonic()
+        stream_cmd(cb, ["cat", log])
+        elapsed = time.monotonic() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if not args.log:
+            os.unlink(log)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    mb = size / 1024 / 1024
+    print("replayed %.1f MB in %.2fs (%.1f MB/s)" % (mb, elapsed, mb / elapsed))
+    print("runner cpu: %.2fs, %d callbacks" % (cpu, calls[0]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import subprocess
+
+from unittest import TestCase, mock
+
+from jobserv_runner import cmd
+from jobserv_runner.cmd import stream_cmd
+
+
+class StreamCmdTest(TestCase):
+    def test_stream_large(self):
+        """Output bigger than the read buffer comes through intact in chunks
+        no smaller than the flush size."""
+        bufs = []
+        script = "head -c 3000000 /dev/zero | tr '\\0' x; echo done"
+        stream_cmd(lambda buf: bufs.append(buf) or True, ["/bin/sh", "-c", script])
+        self.assertEqual(b"x" * 3000000 + b"done\n", b"".join(bufs))
+        for buf in bufs[:-1]:
+            self.assertGreaterEqual(len(buf), cmd.FLUSH_BYTES)
+
+    @mock.patch("jobserv_runner.cmd.FLUSH_SECONDS", 0.1)
+    def test_stream_flush_time(self):
+        """Output is sent when it gets old even if the command is quiet."""
+        bufs = []
+        script = "echo one; sleep 0.5; echo two"
+        stream_cmd(lambda buf: bufs.append(buf) or True, ["/bin/sh", "-c", script])
+        self.assertEqual([b"one\n", b"two\n"], bufs)
+
+    @mock.patch("jobserv_runner.cmd.FLUSH_SECONDS", 0.1)
+    def test_stream_retry(self):
+        """Output the callback fails to take is retried with the next flush"""
+        bufs = []
+
+        def cb(buf):
+            bufs.append(buf)
+            return len(bufs) > 1
+
+        stream_cmd(cb, ["/bin/sh", "-c", "echo one; sleep 0.5; echo two"])
+        self.assertEqual([b"one\n", b"one\n", b"two\n"], bufs)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            stream_cmd(lambda buf: False, ["/bin/echo", "lost"])
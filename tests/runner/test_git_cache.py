@@ -0,0 +1,79 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from unittest import TestCase, mock
+
+from jobserv_runner.git_cache import GitMirrorCache
+
+
+class Log(object):
+    def __init__(self):
+        self.info = self.warn = mock.Mock()
+        self.cmds = []
+
+    def exec(self, cmd, cwd=None, env=None):
+        self.cmds.append(cmd)
+        return subprocess.call(cmd, cwd=cwd, env=env) == 0
+
+
+class GitMirrorCacheTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = GitMirrorCache(os.path.join(self.tmpdir, "mirrors"), 1 << 30)
+        self.log = Log()
+
+    def _create_repo(self, name):
+        repo = os.path.join(self.tmpdir, name)
+        os.mkdir(repo)
+        subprocess.check_call(["git", "init", "-q"], cwd=repo)
+        with open(os.path.join(repo, "file.txt"), "w") as f:
+            f.write(name)
+        subprocess.check_call(["git", "add", "."], cwd=repo)
+        subprocess.check_call(["git", "commit", "-q", "-m", "1"], cwd=repo)
+        return repo
+
+    def test_reference(self):
+        repo = self._create_repo("repo")
+        with self.cache.reference(self.log, repo) as mirror:
+            self.assertEqual(self.cache.mirror_path(repo), mirror)
+            refs = subprocess.check_output(["git", "show-ref"], cwd=mirror)
+            self.assertIn(b"refs/heads/", refs)
+
+        # credentials in the URL don't end up in the mirror
+        config = open(os.path.join(mirror, "config")).read()
+        self.assertNotIn(repo, config)
+
+        # the second use fetches into the same mirror
+        with self.cache.reference(self.log, repo) as mirror2:
+            self.assertEqual(mirror, mirror2)
+
+    def test_reference_failed(self):
+        with self.cache.reference(self.log, "/does/not/exist") as mirror:
+            self.assertIsNone(mirror)
+
+    def test_disabled(self):
+        self.cache.max_bytes = 0
+        with self.cache.reference(self.log, "/does/not/exist") as mirror:
+            self.assertIsNone(mirror)
+        self.assertEqual([], self.log.cmds)
+
+    def test_evict(self):
+        repos = [self._create_repo("repo%d" % i) for i in range(3)]
+        mirrors = []
+        for i, repo in enumerate(repos):
+            with self.cache.reference(self.log, repo) as mirror:
+                mirrors.append(mirror)
+            os.utime(mirror + ".lock", (i, i))
+
+        # everything but the mirror being kept has to go to fit in max_bytes
+        self.cache.max_bytes = 1
+        self.cache.evict(keep=mirrors[0])
+        found = [os.path.exists(x) for x in mirrors]
+        self.assertEqual([True, False, False], found)
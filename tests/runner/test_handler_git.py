@@ -6,9 +6,9 @@ import shutil
 import subprocess
 import tempfile
 
-from unittest import TestCase, mock
+from unittest import TestCase, mock, skipIf
 
-from jobserv_runner.handlers.git_poller import GitPoller, HandlerError
+from jobserv_runner.handlers.git_poller import SUPPORTS_LFS, GitPoller, HandlerError
 
 
 class GitPollerHandlerTest(TestCase):
@@ -207,3 +207,101 @@ class GitPollerHandlerTest(TestCase):
             self.assertEqual("content\ncontent\n", f.read())
         with open(os.path.join(repo, "repo-src/submod/file1.txt")) as f:
             self.assertEqual("content\ncontent\n", f.read())
+
+    def test_clone_mirror(self):
+        """Ensure clones borrow from the worker's git mirror but don't depend
+        on it afterwards."""
+        repo_src, repo_sha = self._create_repo()
+        sub_src, sub_sha = self._create_repo("submod")
+        subprocess.check_call(["git", "submodule", "add", sub_src], cwd=repo_src)
+        subprocess.check_call(["git", "commit", "-m", "addsub"], cwd=repo_src)
+        repo_sha = (
+            subprocess.check_output(["git", "log", "-1", "--format=%H"], cwd=repo_src)
+            .decode()
+            .strip()
+        )
+        self.handler.rundef = {
+            "script": "",
+            "persistent-volumes": None,
+            "run_url": "foo",
+            "env": {
+                "GIT_URL": repo_src,
+                "GIT_SHA": repo_sha,
+            },
+        }
+        self.handler.prepare_mounts()
+
+        mirrors = os.path.join(self.handler.worker_dir, "git-mirrors")
+        self.assertEqual(2, len([x for x in os.listdir(mirrors) if x[-4:] == ".git"]))
+        repo = os.path.join(self.tmpdir, "run/repo")
+        for gitdir in (".git", ".git/modules/submod"):
+            alternates = os.path.join(repo, gitdir, "objects/info/alternates")
+            self.assertFalse(os.path.exists(alternates))
+        shutil.rmtree(mirrors)
+        subprocess.check_call(["git", "fsck"], cwd=repo)
+        subprocess.check_call(["git", "fsck"], cwd=os.path.join(repo, "submod"))
+
+    @mock.patch("jobserv_runner.handlers.git_poller.GitPoller._needs_auth")
+    @mock.patch("jobserv_runner.handlers.git_poller.GitPoller.docker_pull")
+    def test_prefetch(self, docker_pull, needs_auth):
+        """Ensure a reserved run can warm the worker's mirror without
+        talking to the server."""
+        needs_auth.return_value = False
+        repo_src, repo_sha = self._create_repo()
+        rundef = {"env": {"GIT_URL": repo_src, "GIT_SHA": repo_sha}}
+        GitPoller.prefetch(self.handler.worker_dir, self.handler.run_dir, rundef)
+        docker_pull.assert_called_once_with()
+
+        mirror = self.handler.git_cache.mirror_path(repo_src)
+        refs = subprocess.check_output(["git", "show-ref"], cwd=mirror)
+        self.assertIn(b"refs/heads/", refs)
+
+    @skipIf(not SUPPORTS_LFS, "git-lfs not available")
+    def test_clone_mirror_lfs(self):
+        """Ensure LFS files are checked out through the mirror's LFS storage
+        and the clone keeps its own copy of the objects."""
+        repo_src = os.path.join(self.tmpdir, "repo-src")
+        os.mkdir(repo_src)
+        subprocess.check_call(["git", "init"], cwd=repo_src)
+        subprocess.check_call(["git", "lfs", "install", "--local"], cwd=repo_src)
+        subprocess.check_call(["git", "lfs", "track", "*.bin"], cwd=repo_src)
+        with open(os.path.join(repo_src, "blob.bin"), "w") as f:
+            f.write("lfs content 1\n")
+        subprocess.check_call(["git", "add", "."], cwd=repo_src)
+        subprocess.check_call(["git", "commit", "-m", "1"], cwd=repo_src)
+        repo_sha = (
+            subprocess.check_output(["git", "log", "-1", "--format=%H"], cwd=repo_src)
+            .decode()
+            .strip()
+        )
+        with open(os.path.join(repo_src, "blob.bin"), "w") as f:
+            f.write("lfs content 2\n")
+        subprocess.check_call(["git", "commit", "-a", "-m", "2"], cwd=repo_src)
+
+        self.handler.rundef = {
+            "script": "",
+            "persistent-volumes": None,
+            "run_url": "foo",
+            "env": {
+                "GIT_URL": repo_src,
+                "GIT_SHA": repo_sha,
+            },
+        }
+        self.handler.prepare_mounts()
+
+        repo = os.path.join(self.tmpdir, "run/repo")
+        with open(os.path.join(repo, "blob.bin")) as f:
+            self.assertEqual("lfs content 1\n", f.read())
+        p = subprocess.run(
+            ["git", "config", "--local", "lfs.storage"],
+            cwd=repo,
+            stdout=subprocess.PIPE,
+        )
+        self.assertEqual(b"", p.stdout)
+        mirrors = os.path.join(self.handler.worker_dir, "git-mirrors")
+        mirror = [x for x in os.listdir(mirrors) if x[-4:] == ".git"][0]
+        self.assertTrue(os.listdir(os.path.join(mirrors, mirror, "lfs/objects")))
+        shutil.rmtree(mirrors)
+        env = os.environ.copy()
+        env["HOME"] = self.handler.run_dir
+        subprocess.check_call(["git", "lfs", "fsck"], cwd=repo, env=env)
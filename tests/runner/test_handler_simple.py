@@ -102,7 +102,7 @@ class SimpleHandlerTest(TestCase):
     def test_exec(self):
         self.output = b""
 
-        def update_run(buf, retry=2):
+        def update_run(buf, retry=2, raise_error=False):
             self.output += buf
             return True
 
@@ -125,7 +125,7 @@ class SimpleHandlerTest(TestCase):
     def test_exec_retriable(self, sleep):
         self.output = b""
 
-        def update_run(buf, retry=2):
+        def update_run(buf, retry=2, raise_error=False):
             self.output += buf
             return True
 
@@ -151,7 +151,7 @@ class SimpleHandlerTest(TestCase):
         self.output = b""
         cmd.HANG_DETECT_SECONDS = 1
 
-        def update_run(buf, retry=2):
+        def update_run(buf, retry=2, raise_error=False):
             self.output += buf
             return True
 
@@ -321,7 +321,7 @@ class SimpleHandlerTest(TestCase):
         """See if we enforce the --memory flag"""
         self.output = b""
 
-        def update_run(buf, retry=2):
+        def update_run(buf, retry=2, raise_error=False):
             self.output += buf
             return True
 
@@ -379,3 +379,77 @@ class SimpleHandlerTest(TestCase):
         self.assertEqual(7, skips)
         self.assertEqual(389, passes)
         self.assertIn("Booting Zephyr", results[87]["output"])
+
+    def test_junit_tests_batched(self):
+        archive = os.path.join(self.rdir, "archive")
+        os.mkdir(archive)
+        shutil.copy(os.path.join(os.path.dirname(__file__), "junit.xml"), archive)
+        self.handler.jobserv.add_test.return_value = None
+        self.handler.jobserv.update_test.return_value = None
+        self.handler.JUNIT_BATCH = 100
+        self.assertTrue(self.handler.test_suite_errors())
+
+        # The first batch creates the test with the suite's overall status
+        self.assertEqual(1, len(self.handler.jobserv.add_test.call_args_list))
+        name, context, status, results = self.handler.jobserv.add_test.call_args[0]
+        self.assertEqual("Sanitycheck", name)
+        self.assertEqual("junit.xml skipped=7", context)
+        self.assertEqual("FAILED", status)
+        self.assertEqual(100, len(results))
+
+        calls = self.handler.jobserv.update_test.call_args_list
+        self.assertEqual([100, 100, 97], [len(x[0][2]) for x in calls])
+        for call in calls:
+            self.assertEqual(("Sanitycheck", "junit.xml skipped=7"), call[0][:2])
+
+    def test_junit_nested(self):
+        archive = os.path.join(self.rdir, "archive")
+        os.mkdir(archive)
+        with open(os.path.join(archive, "junit.xml"), "w") as f:
+            f.write("""<testsuites>
+                  <testsuite name="outer">
+                    <properties><property name="a" value="b"/></properties>
+                    <testcase name="t1"/>
+                    <testsuite name="inner">
+                      <testcase name="t2"><skipped/></testcase>
+                    </testsuite>
+                    <testcase name="t3"><failure>boom</failure></testcase>
+                  </testsuite>
+                </testsuites>""")
+        self.handler.jobserv.add_test.return_value = None
+        self.assertTrue(self.handler.test_suite_errors())
+        calls = self.handler.jobserv.add_test.call_args_list
+        inner = ("inner", "junit.xml skipped=1", "PASSED")
+        self.assertEqual(inner, calls[0][0][:3])
+        self.assertEqual(["t2"], [x["name"] for x in calls[0][0][3]])
+        outer = ("outer", "junit.xml skipped=0", "FAILED")
+        self.assertEqual(outer, calls[1][0][:3])
+        self.assertEqual(["t1", "t3"], [x["name"] for x in calls[1][0][3]])
+        self.assertIn("boom", calls[1][0][3][1]["output"])
+
+    def test_junit_same_name(self):
+        archive = os.path.join(self.rdir, "archive")
+        os.mkdir(archive)
+        for name in ("junit.xml", "junit.xml.1"):
+            with open(os.path.join(archive, name), "w") as f:
+                f.write("""<testsuites>
+                      <testsuite name="pytest">
+                        <testcase name="t1"/>
+                        <testcase name="t2"/>
+                        <testcase name="t3"/>
+                      </testsuite>
+                      <testsuite>
+                        <testcase name="t4"/>
+                      </testsuite>
+                    </testsuites>""")
+        self.handler.jobserv.add_test.return_value = None
+        self.handler.jobserv.update_test.return_value = None
+        self.handler.JUNIT_BATCH = 2
+        self.assertFalse(self.handler.test_suite_errors())
+
+        # each suite gets its own Test so batches can't land in another one
+        calls = self.handler.jobserv.add_test.call_args_list
+        names = ["pytest", "junit", "pytest-2", "junit-2"]
+        self.assertEqual(names, [x[0][0] for x in calls])
+        calls = self.handler.jobserv.update_test.call_args_list
+        self.assertEqual(["pytest", "pytest-2"], [x[0][0] for x in calls])
@@ -0,0 +1,69 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import shutil
+import tempfile
+import threading
+import time
+
+from unittest import TestCase, mock
+
+from jobserv_runner.images import ImageManager
+
+
+@mock.patch("jobserv_runner.images.local_image_id", return_value="sha256:1")
+class ImageManagerTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.images = ImageManager(self.tmpdir, fresh_seconds=60)
+        self.log = mock.Mock()
+
+    def test_pull_fresh(self, image_id):
+        pull = mock.Mock(return_value=True)
+        self.assertTrue(self.images.pull(self.log, "alpine", pull))
+        self.assertTrue(self.images.pull(self.log, "alpine", pull))
+        self.assertEqual(1, pull.call_count)
+
+        # a different image still gets pulled
+        self.assertTrue(self.images.pull(self.log, "debian", pull))
+        self.assertEqual(2, pull.call_count)
+
+    def test_pull_stale(self, image_id):
+        pull = mock.Mock(return_value=True)
+        self.images.pull(self.log, "alpine", pull)
+        self.images.fresh_seconds = 0
+        self.images.pull(self.log, "alpine", pull)
+        self.assertEqual(2, pull.call_count)
+
+        # the image changed locally since the last pull
+        self.images.fresh_seconds = 60
+        image_id.return_value = "sha256:2"
+        self.images.pull(self.log, "alpine", pull)
+        self.assertEqual(3, pull.call_count)
+
+    def test_pull_failed(self, image_id):
+        pull = mock.Mock(return_value=False)
+        self.assertFalse(self.images.pull(self.log, "alpine", pull))
+        self.assertFalse(self.images.pull(self.log, "alpine", pull))
+        self.assertEqual(2, pull.call_count)
+
+    def test_pull_concurrent(self, image_id):
+        pulls = []
+
+        def pull():
+            pulls.append(1)
+            time.sleep(0.1)
+            return True
+
+        # the threads each open their own lock file so flock serializes them
+        threads = [
+            threading.Thread(target=self.images.pull, args=(self.log, "alpine", pull))
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(pulls))
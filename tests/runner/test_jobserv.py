@@ -0,0 +1,117 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase, mock
+
+from jobserv_runner import jobserv
+from jobserv_runner.jobserv import JobServApi
+from jobserv_runner.transport import Response
+
+
+class JobServApiUploadTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.api = JobServApi("http://localhost/run/", "key")
+        self.api.update_status = mock.Mock()
+
+    def _create(self, name, size):
+        with open(os.path.join(self.tmpdir, name), "wb") as f:
+            f.write(b"1" * size)
+        return {"file": name, "size": size}
+
+    @mock.patch("jobserv_runner.jobserv.split")
+    def test_upload_pipelined(self, split):
+        split.side_effect = lambda items, size: [[x] for x in items]
+        uploads = [self._create("f%d" % i, i) for i in range(5)]
+
+        lock = threading.Lock()
+        signed = []
+        uploaded = []
+
+        def get_urls(group, resumable):
+            with lock:
+                signed.append(group[0]["file"])
+            return {x["file"]: {"url": "u", "content-type": ""} for x in group}
+
+        def upload_item(artifacts_dir, artifact, urldata):
+            with lock:
+                uploaded.append(artifact)
+            if artifact == "f2":
+                return "f2 failed"
+
+        self.api._get_urls = get_urls
+        self.api._upload_item = upload_item
+        with mock.patch("time.sleep"):
+            errors = self.api.upload(self.tmpdir, uploads)
+        self.assertEqual(["f2 failed"], errors)
+        # largest first
+        self.assertEqual(["f4", "f3", "f2", "f1", "f0"], signed)
+        self.assertEqual(8, len(uploaded))  # f2 gets tried 4 times
+
+    @mock.patch("jobserv_runner.jobserv.UPLOAD_CHUNK_BYTES", 4)
+    @mock.patch("jobserv_runner.jobserv.get_pool")
+    @mock.patch("time.sleep")
+    def test_upload_resumable(self, sleep, get_pool):
+        self._create("big", 10)
+        sent = []
+
+        def request(method, url, body, headers, name, retries=None):
+            if method == "POST":
+                self.assertEqual("start", headers["x-goog-resumable"])
+                return Response(201, "", {"Location": "session"}, b"")
+            sent.append(headers["Content-Range"])
+            if headers["Content-Range"] == "bytes 4-7/10" and len(sent) == 2:
+                raise ConnectionResetError()
+            if headers["Content-Range"] == "bytes */10":
+                return Response(308, "", {"Range": "bytes=0-5"}, b"")
+            if headers["Content-Range"].endswith("9/10"):
+                return Response(200, "", {}, b"")
+            return Response(308, "", {}, b"")
+
+        get_pool().request = request
+        urldata = {"url": "signed", "content-type": "", "resumable": True}
+        self.assertIsNone(self.api._upload_item(self.tmpdir, "big", urldata))
+        expected = [
+            "bytes 0-3/10",
+            "bytes 4-7/10",
+            "bytes */10",
+            "bytes 6-9/10",
+        ]
+        self.assertEqual(expected, sent)
+
+    def test_upload_workers(self):
+        self.assertEqual(4, JobServApi._upload_workers([{"size": 1}]))
+        big = [{"size": 1024 * 1024 * 1024}] * 40
+        self.assertEqual(16, JobServApi._upload_workers(big))
+        with mock.patch.object(jobserv, "UPLOAD_WORKERS", 2):
+            self.assertEqual(2, JobServApi._upload_workers(big))
+
+    @mock.patch("jobserv_runner.jobserv.DEDUP_MIN_BYTES", 3)
+    def test_upload_dedup(self):
+        uploads = [self._create("small", 2), self._create("big", 4)]
+        sent = {}
+        big_md5 = []
+        uploaded = []
+
+        def get_urls(group, resumable):
+            sent.update({x["file"]: x.get("sha256") for x in group})
+            big_md5.extend(x["md5"] for x in group if x["file"] == "big")
+            urls = {x["file"]: {"url": "u", "content-type": ""} for x in group}
+            urls["big"] = {"stored": True}
+            return urls
+
+        self.api._get_urls = get_urls
+        self.api._upload_item = lambda d, artifact, urldata: uploaded.append(artifact)
+        self.assertEqual([], self.api.upload(self.tmpdir, uploads))
+        self.assertIsNone(sent["small"])
+        self.assertEqual(hashlib.sha256(b"1111").hexdigest(), sent["big"])
+        self.assertEqual(hashlib.md5(b"1111").hexdigest(), big_md5[0])
+        self.assertEqual(["small"], uploaded)
@@ -0,0 +1,103 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import json
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase, mock
+
+from jobserv_runner.resources import ResourceSampler
+
+
+class ResourceSamplerTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sampler = ResourceSampler("container", proc_root=self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_find_cgroup(self):
+        self._write("42/cgroup", "0::/system.slice/docker-abc.scope\n")
+        with mock.patch.object(self.sampler, "_container_pid", return_value=42):
+            found = self.sampler._find_cgroup()
+        expected = ("v2", "/sys/fs/cgroup/system.slice/docker-abc.scope")
+        self.assertEqual(expected, found)
+
+        # hybrid hierarchy
+        self._write(
+            "42/cgroup",
+            "4:cpu,cpuacct:/docker/abc\n3:memory:/docker/abc\n0::/docker/abc\n",
+        )
+        with mock.patch.object(self.sampler, "_container_pid", return_value=42):
+            version, paths = self.sampler._find_cgroup()
+        self.assertEqual("v1", version)
+        self.assertEqual("/sys/fs/cgroup/cpu,cpuacct/docker/abc", paths["cpuacct"])
+        self.assertEqual("/sys/fs/cgroup/memory/docker/abc", paths["memory"])
+
+        with mock.patch.object(self.sampler, "_container_pid", return_value=0):
+            self.assertIsNone(self.sampler._find_cgroup())
+
+    def test_sample_v2(self):
+        self._write("cg/cpu.stat", "usage_usec 100\nuser_usec 60\n")
+        self._write("cg/memory.current", "2048\n")
+        self._write(
+            "cg/io.stat",
+            "8:0 rbytes=10 wbytes=20 rios=1 wios=2\n8:16 rbytes=1 wbytes=2\n",
+        )
+        cgroup = ("v2", os.path.join(self.tmpdir, "cg"))
+        self.sampler.sample(cgroup, 0.0)
+        self._write("cg/cpu.stat", "usage_usec 300\n")
+        self._write("cg/memory.current", "1024\n")
+        self.sampler.sample(cgroup, 5.0)
+
+        expected = {
+            "cpu_usec": 300,
+            "mem_peak_bytes": 2048,
+            "io_read_bytes": 11,
+            "io_write_bytes": 22,
+        }
+        self.assertEqual(expected, self.sampler.summary())
+
+    def test_sample_v1(self):
+        self._write("cpuacct/cpuacct.usage", "5000\n")
+        self._write("memory/memory.usage_in_bytes", "10\n")
+        self._write("memory/memory.max_usage_in_bytes", "99\n")
+        self._write(
+            "blkio/blkio.throttle.io_service_bytes",
+            "8:0 Read 7\n8:0 Write 8\n8:0 Total 15\nTotal 15\n",
+        )
+        paths = {x: os.path.join(self.tmpdir, x) for x in ("cpuacct", "memory")}
+        paths["blkio"] = os.path.join(self.tmpdir, "blkio")
+        self.sampler.sample(("v1", paths), 0.0)
+
+        expected = {
+            "cpu_usec": 5,
+            "mem_peak_bytes": 99,
+            "io_read_bytes": 7,
+            "io_write_bytes": 8,
+        }
+        self.assertEqual(expected, self.sampler.summary())
+
+    def test_save(self):
+        path = os.path.join(self.tmpdir, "resources.json")
+        self.assertIsNone(self.sampler.save(path))
+        self.assertFalse(os.path.exists(path))
+
+        self._write("cg/cpu.stat", "usage_usec 100\n")
+        self._write("cg/memory.current", "2048\n")
+        for i in range(3):
+            self.sampler.sample(("v2", os.path.join(self.tmpdir, "cg")), i * 5.0)
+        summary = self.sampler.save(path)
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(summary, data["summary"])
+        self.assertEqual([0.0, 5.0, 10.0], data["seconds"])
+        self.assertEqual([2048] * 3, data["mem_bytes"])
@@ -0,0 +1,91 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import threading
+
+from unittest import TestCase, mock
+
+from jobserv_runner.jobserv import PostError, RunCancelledError
+from jobserv_runner.sender import ConsoleSender
+
+
+class ConsoleSenderTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = b""
+        self.posts = 0
+        self.fail = 0
+        self.fail_status = None
+        self.gate = threading.Event()
+        self.gate.set()
+        self.jobserv = mock.Mock()
+        self.jobserv.update_run = self.update_run
+
+    def update_run(self, buf, retry=2, raise_error=False):
+        self.gate.wait()
+        self.posts += 1
+        if self.fail:
+            self.fail -= 1
+            if self.fail_status:
+                raise PostError("HTTP_%d" % self.fail_status, self.fail_status)
+            return False
+        self.output += buf
+        return True
+
+    def test_batching(self):
+        sender = ConsoleSender(self.jobserv, batch_seconds=60)
+        for i in range(100):
+            sender.write(b"line %d\n" % i)
+        self.assertTrue(sender.close())
+        expected = b"".join(b"line %d\n" % i for i in range(100))
+        self.assertEqual(expected, self.output)
+        self.assertEqual(1, self.posts)
+
+    def test_spill_in_order(self):
+        """A stalled server shouldn't block writes or reorder output."""
+        self.gate.clear()
+        sender = ConsoleSender(self.jobserv, max_queued=10, batch_seconds=0)
+        for i in range(50):
+            sender.write(b"%d," % i)
+        self.assertIsNotNone(sender._spill)
+        self.gate.set()
+        self.assertTrue(sender.close())
+        self.assertEqual(b"".join(b"%d," % i for i in range(50)), self.output)
+
+    @mock.patch("jobserv_runner.sender.time.sleep")
+    def test_retry(self, sleep):
+        self.fail = 2
+        sender = ConsoleSender(self.jobserv)
+        sender.write(b"foo")
+        self.assertTrue(sender.close())
+        self.assertEqual(b"foo", self.output)
+        self.assertEqual(3, self.posts)
+
+    @mock.patch("jobserv_runner.sender.time.sleep")
+    def test_permanent_error(self, sleep):
+        self.fail = 1
+        self.fail_status = 403
+        sender = ConsoleSender(self.jobserv)
+        sender.write(b"foo")
+        self.assertTrue(sender.flush())
+        self.assertEqual(1, self.posts)
+        sender.write(b"bar")
+        self.assertTrue(sender.close())
+        self.assertEqual(b"bar", self.output)
+
+        # rate limiting is retried
+        self.fail = 1
+        self.fail_status = 429
+        self.output = b""
+        sender = ConsoleSender(self.jobserv)
+        sender.write(b"foo")
+        self.assertTrue(sender.close())
+        self.assertEqual(b"foo", self.output)
+
+    def test_cancelled(self):
+        self.jobserv.update_run = mock.Mock(side_effect=RunCancelledError())
+        sender = ConsoleSender(self.jobserv)
+        sender.write(b"foo")
+        with self.assertRaises(RunCancelledError):
+            sender.flush()
+        sender.close()
@@ -0,0 +1,76 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from jobserv_runner.transport import HttpPool
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = self.rfile.read(length)
+        status = 200
+        if self.server.failures:
+            self.server.failures -= 1
+            status = 503
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop:
+            # close without telling the client, like an idle timeout would
+            self.server.drop = False
+            self.close_connection = True
+
+
+class HttpPoolTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.connections = 0
+        self.server.failures = 0
+        self.server.drop = False
+        t = threading.Thread(target=self.server.serve_forever, daemon=True)
+        t.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:%d/foo/" % self.server.server_port
+        self.pool = HttpPool(backoff=0)
+        self.pool._proxies = {}
+        self.addCleanup(self.pool.close)
+
+    def test_keep_alive(self):
+        for i in range(5):
+            r = self.pool.request("POST", self.url, b"msg%d" % i, name="test")
+            self.assertEqual((200, b"msg%d" % i), (r.status, r.read()))
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(5, self.pool.latency["test"][0])
+
+    def test_retry(self):
+        self.server.failures = 2
+        r = self.pool.request("POST", self.url, b"msg", retries=2)
+        self.assertEqual(200, r.status_code)
+
+        self.server.failures = 2
+        r = self.pool.request("POST", self.url, b"msg", retries=1)
+        self.assertEqual(503, r.status_code)
+
+    def test_stale_connection(self):
+        self.server.drop = True
+        self.pool.request("POST", self.url, b"msg")
+        r = self.pool.request("POST", self.url, b"msg2", retries=0)
+        self.assertEqual(b"msg2", r.read())
+        self.assertEqual(2, self.server.connections)
@@ -48,6 +48,76 @@ class BuildAPITest(JobServTest):
         for i, b in enumerate(builds):
             self.assertEqual(3 - i, b["build_id"])
 
+    def _create_builds(self, builds, runs):
+        for _ in range(builds):
+            b = Build.create(self.project)
+            for i in range(runs):
+                r = Run(b, "run%d" % i)
+                db.session.add(r)
+                db.session.flush()
+                db.session.add(Test(r, "test", "ctx"))
+                r.set_status(BuildStatus.PASSED)
+        db.session.commit()
+
+    def test_build_list_queries(self):
+        """The queries a page of builds takes shouldn't grow with the number
+        of builds or runs on it."""
+        self._create_builds(5, 5)
+        with self.assert_max_queries(5):
+            builds = self.get_json(self.urlbase)["builds"]
+        self.assertEqual(5, len(builds))
+        self.assertEqual(5, len(builds[0]["runs"]))
+        self.assertIn("tests", builds[0]["runs"][0])
+
+        with self.assert_max_queries(6):
+            self.get_json(self.urlbase + "5/")
+        with self.assert_max_queries(5):
+            self.get_json(self.urlbase + "5/runs/")
+
+        # the build is complete, so its now served from the cache
+        with self.assert_max_queries(1):
+            self.get_json(self.urlbase + "5/")
+
+    def test_build_get_etag(self):
+        self._create_builds(1, 2)
+        url = self.urlbase + "1/"
+        r = self.client.get(url)
+        self.assertEqual(200, r.status_code)
+        etag = r.headers["ETag"]
+        data = r.data
+
+        r = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(etag, r.headers["ETag"])
+
+        # the response changes with an annotation
+        headers = {"Content-type": "application/json"}
+        _sign("http://localhost" + url, headers, "PATCH")
+        body = json.dumps({"annotation": "foo"})
+        r = self.client.patch(url, headers=headers, data=body)
+        self.assertEqual(200, r.status_code, r.data)
+        r = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, r.status_code)
+        self.assertNotEqual(etag, r.headers["ETag"])
+        self.assertNotEqual(data, r.data)
+        self.assertEqual("foo", json.loads(r.data)["data"]["build"]["annotation"])
+
+        # and when a run is re-queued
+        etag = r.headers["ETag"]
+        Run.query.first().set_status(BuildStatus.QUEUED)
+        db.session.commit()
+        r = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(200, r.status_code)
+        self.assertNotIn("ETag", r.headers)
+
+    def test_build_get_running_not_cached(self):
+        b = Build.create(self.project)
+        db.session.add(Run(b, "run0"))
+        db.session.commit()
+        r = self.client.get(self.urlbase + "1/")
+        self.assertEqual(200, r.status_code)
+        self.assertNotIn("ETag", r.headers)
+
     def test_build_list_paginate(self):
         for x in range(8):
             Build.create(self.project)
@@ -58,6 +128,24 @@ class BuildAPITest(JobServTest):
         data = self.get_json(self.urlbase + "?limit=4&page=2")
         self.assertEqual([], data["builds"])
 
+    def test_build_list_cursor(self):
+        for x in range(8):
+            Build.create(self.project)
+        data = self.get_json(self.urlbase + "?cursor=&limit=3")
+        self.assertEqual([8, 7, 6], [x["build_id"] for x in data["builds"]])
+        self.assertEqual(8, data["total_approx"])
+        self.assertNotIn("page", data)
+
+        seen = [x["build_id"] for x in data["builds"]]
+        while "next" in data:
+            data = self.get_json(data["next"])
+            seen.extend(x["build_id"] for x in data["builds"])
+        self.assertEqual(list(range(8, 0, -1)), seen)
+        self.assertNotIn("next_cursor", data)
+
+        r = self.client.get(self.urlbase + "?cursor=garbage!")
+        self.assertEqual(400, r.status_code)
+
     def test_build_get(self):
         Build.create(self.project)
         b = Build.create(self.project)
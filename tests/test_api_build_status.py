@@ -0,0 +1,217 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+import datetime
+import json
+import time
+
+from unittest.mock import patch
+
+from jobserv import settings
+from jobserv.api import build_status
+from jobserv.models import Build, BuildEvents, BuildStatus, Project, Run, db
+
+from tests import JobServTest
+
+
+class BuildStatusAPITest(JobServTest):
+    def setUp(self):
+        super().setUp()
+        build_status._gaps.clear()
+        self.create_projects("proj-1", "proj-2")
+        self.projects = Project.query.order_by(Project.name).all()
+        self.builds = []
+        for p in self.projects:
+            for _ in range(3):
+                b = Build.create(p)
+                db.session.add(Run(b, "run0"))
+                db.session.add(Run(b, "run1"))
+                self.builds.append(b)
+        db.session.commit()
+
+    def _post(self, data, status_code=200):
+        resp = self.client.post(
+            "/build-status/",
+            data=json.dumps(data),
+            content_type="application/json",
+        )
+        self.assertEqual(status_code, resp.status_code, resp.data)
+        return json.loads(resp.data.decode()).get("data")
+
+    def test_query(self):
+        self.builds[1].runs[1].set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        items = [
+            ["proj-1", 2],
+            ["proj-2", 1],
+            ["proj-2", 3, "run1"],
+            ["proj-2", 9],  # doesn't exist
+        ]
+        with self.assert_max_queries(4):
+            data = self._post({"builds": items})
+
+        self.assertEqual(["proj-1", "proj-2"], [x["project"] for x in data["builds"]])
+        self.assertEqual([2, 1], [x["build"] for x in data["builds"]])
+        build = data["builds"][0]
+        self.assertEqual("RUNNING", build["status"])
+        self.assertEqual({"run0": "QUEUED", "run1": "RUNNING"}, build["runs"])
+        self.assertEqual(
+            [{"project": "proj-2", "build": 3, "run": "run1", "status": "QUEUED"}],
+            data["runs"],
+        )
+
+    def test_query_invalid(self):
+        self._post({}, 400)
+        self._post({"builds": [["proj-1"]]}, 400)
+        self._post({"builds": [["proj-1", "1"]]}, 400)
+        self._post({"builds": [["proj-1", 1, 2]]}, 400)
+        self._post({"builds": [["proj-1", 1]] * 501}, 400)
+
+    def test_changed_since_event(self):
+        data = self.get_json("/build-status/", query_string={"since_event": "0.0"})
+        self.assertEqual(6, len(data["builds"]))
+
+        # nothing has changed
+        cursor = data["event_cursor"]
+        data = self.get_json("/build-status/", query_string={"since_event": cursor})
+        self.assertEqual([], data["builds"])
+        self.assertEqual(cursor, data["event_cursor"])
+
+        self.builds[4].runs[0].set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        with self.assert_max_queries(3):
+            data = self.get_json("/build-status/", query_string={"since_event": cursor})
+        self.assertEqual(1, len(data["builds"]))
+        self.assertEqual("proj-2", data["builds"][0]["project"])
+        self.assertEqual(2, data["builds"][0]["build"])
+        self.assertEqual("RUNNING", data["builds"][0]["runs"]["run0"])
+        self.assertNotEqual(cursor, data["event_cursor"])
+
+        resp = self.client.get("/build-status/", query_string={"since_event": "1"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual(400, self.client.get("/build-status/").status_code)
+
+    def test_changed_since_time(self):
+        now = datetime.datetime.utcnow()
+        since = (now + datetime.timedelta(seconds=1)).isoformat()
+        data = self.get_json("/build-status/", query_string={"since": since})
+        self.assertEqual([], data["builds"])
+
+        since = (now - datetime.timedelta(minutes=1)).isoformat() + "+00:00"
+        data = self.get_json("/build-status/", query_string={"since": since})
+        self.assertEqual(6, len(data["builds"]))
+
+        resp = self.client.get("/build-status/", query_string={"since": "yesterday"})
+        self.assertEqual(400, resp.status_code)
+
+    def test_events(self):
+        data = self.get_json(
+            "/build-status/events/", query_string={"since_event": "0.0"}
+        )
+        self.assertEqual(6, len(data["events"]))
+        event = data["events"][0]
+        self.assertEqual("build", event["type"])
+        self.assertEqual("proj-1", event["project"])
+        self.assertEqual(1, event["build"])
+        self.assertEqual("QUEUED", event["status"])
+
+        # the feed starts from now without a cursor
+        data = self.get_json("/build-status/events/")
+        self.assertEqual([], data["events"])
+        cursor = data["event_cursor"]
+
+        self.builds[4].runs[1].set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        qs = {"since_event": cursor}
+        with self.assert_max_queries(2):
+            data = self.get_json("/build-status/events/", query_string=qs)
+        events = [(x["type"], x["status"], x.get("run")) for x in data["events"]]
+        self.assertEqual(
+            [("build", "RUNNING", None), ("run", "RUNNING", "run1")], events
+        )
+        self.assertEqual("proj-2", data["events"][1]["project"])
+        self.assertEqual(2, data["events"][1]["build"])
+
+        qs = {"since_event": data["event_cursor"], "limit": 1}
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual([], data["events"])
+
+        qs = {"since_event": cursor, "limit": 1}
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual(["build"], [x["type"] for x in data["events"]])
+        qs["since_event"] = data["event_cursor"]
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual(["run"], [x["type"] for x in data["events"]])
+
+    def test_events_gap(self):
+        # an event that isn't committed yet leaves a gap in the ids. The
+        # cursors wait there until it's had time to show up
+        db.session.delete(BuildEvents.query.get(3))
+        db.session.commit()
+        qs = {"since_event": "0.0"}
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual([1, 2], [x["build"] for x in data["events"]])
+        self.assertEqual("2.0", data["event_cursor"])
+        self.assertEqual("2.0", self.get_json("/build-status/events/")["event_cursor"])
+        data = self._post({"builds": [["proj-1", 1]]})
+        self.assertEqual("2.0", data["event_cursor"])
+
+        with patch("jobserv.api.build_status.EVENT_GAP_SECONDS", 0):
+            data = self.get_json("/build-status/events/", query_string=qs)
+            self.assertEqual(5, len(data["events"]))
+            self.assertEqual("6.0", data["event_cursor"])
+
+        # gaps behind old events aren't transactions still being committed
+        with patch("jobserv.api.build_status.EVENT_GAP_MAX_AGE", -1):
+            data = self.get_json("/build-status/events/", query_string=qs)
+            self.assertEqual("6.0", data["event_cursor"])
+
+    @patch("jobserv.api.build_status.EVENT_POLL_SECONDS", 0.1)
+    def test_events_wait(self):
+        qs = {"wait": 1}
+        start = datetime.datetime.now()
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual([], data["events"])
+        self.assertGreaterEqual(
+            datetime.datetime.now() - start, datetime.timedelta(seconds=1)
+        )
+
+        qs = {"since_event": "0.0", "limit": -1}
+        data = self.get_json("/build-status/events/", query_string=qs)
+        self.assertEqual(1, len(data["events"]))
+
+        resp = self.client.get("/build-status/events/", query_string={"wait": "x"})
+        self.assertEqual(400, resp.status_code)
+
+    @patch("jobserv.api.build_status.EVENT_STREAM_SECONDS", 0.5)
+    @patch("jobserv.api.build_status.EVENT_FEED_MAX_WAIT", 0.5)
+    @patch("jobserv.api.build_status.EVENT_POLL_SECONDS", 0.1)
+    def test_events_caps(self):
+        # neither a long-poll nor a stream can outlast gunicorn's timeout
+        self.assertLess(settings.EVENT_FEED_MAX_WAIT, 30)
+        self.assertLess(settings.EVENT_STREAM_SECONDS, 30)
+
+        start = time.monotonic()
+        data = self.get_json("/build-status/events/", query_string={"wait": 3600})
+        self.assertEqual([], data["events"])
+        headers = {"Accept": "text/event-stream"}
+        resp = self.client.get("/build-status/events/", headers=headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.data.startswith(b"retry: "))
+        self.assertLess(time.monotonic() - start, 5)
+
+    @patch("jobserv.api.build_status.EVENT_STREAM_SECONDS", 0.5)
+    @patch("jobserv.api.build_status.EVENT_POLL_SECONDS", 0.1)
+    def test_events_stream(self):
+        headers = {"Accept": "text/event-stream", "Last-Event-ID": "3.0"}
+        resp = self.client.get("/build-status/events/", headers=headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("text/event-stream", resp.mimetype)
+        messages = resp.data.decode().split("\n\n")
+        self.assertEqual("retry: 100", messages[0])
+        self.assertEqual(["id: 4.0", "event: build"], messages[1].split("\n")[:2])
+        data = json.loads(messages[1].split("data: ")[1])
+        self.assertEqual(
+            {"proj-2", 1, "QUEUED"}, {data["project"], data["build"], data["status"]}
+        )
+        self.assertEqual("id: 6.0", messages[3].split("\n")[0])
+        self.assertEqual("", messages[4])
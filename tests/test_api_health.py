@@ -1,8 +1,16 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import datetime
 import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
 
+from flask import url_for
+
+from jobserv import health
 from jobserv.models import Build, BuildStatus, Project, Run, Worker, db
 
 from tests import JobServTest
@@ -53,3 +61,45 @@ class HealthApiTest(JobServTest):
         self.assertEqual(3, len(d["health"]["RUNNING"]["worker2"]))
 
         self.assertEqual(2, len(d["health"]["QUEUED"]))
+
+        item = d["health"]["QUEUED"][0]
+        self.assertEqual("queued-1", item["run"])
+        self.assertEqual(1, item["build"])
+        self.assertEqual(b.created.isoformat() + "+00:00", item["created"])
+        datetime.datetime.fromisoformat(d["health"]["generated"])
+        with self.app.test_request_context():
+            url = url_for(
+                "api_run.run_get",
+                proj="proj-1",
+                build_id=1,
+                run="queued-1",
+                _external=True,
+            )
+        self.assertEqual(url, item["url"])
+
+    def test_run_health_snapshot(self):
+        self.create_projects("proj-1")
+        b = Build.create(Project.query.first())
+        db.session.add(Run(b, "queued-1"))
+        db.session.commit()
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot = os.path.join(tmpdir, "health-runs.json")
+        with patch.object(health, "SNAPSHOT_FILE", snapshot):
+            health.write_snapshot()
+
+            # the API serves what the monitor wrote, not what's in the DB
+            db.session.add(Run(b, "queued-2"))
+            db.session.commit()
+            with self.assert_max_queries(0):
+                r = self.client.get("/health/runs/")
+            d = json.loads(r.data.decode())["data"]["health"]
+            self.assertEqual(["queued-1"], [x["run"] for x in d["QUEUED"]])
+            self.assertIn("url", d["QUEUED"][0])
+
+            # until it gets too old
+            os.utime(snapshot, (0, 0))
+            r = self.client.get("/health/runs/")
+            d = json.loads(r.data.decode())["data"]["health"]
+            self.assertEqual(2, len(d["QUEUED"]))
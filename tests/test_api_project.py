@@ -142,6 +142,15 @@ class ProjectAPITest(JobServTest):
         expected = ["run0", "run0", "run0", "run0"]
         self.assertEqual(expected, [x["name"] for x in r["runs"]])
 
+        with self.assert_max_queries(5):
+            r = self.get_json("/projects/proj-1/history/run0/")
+        self.assertEqual(4, len(r["runs"]))
+
+        r = self.get_json("/projects/proj-1/history/run0/?cursor=&limit=3")
+        self.assertEqual([4, 3, 2], [x["build"] for x in r["runs"]])
+        r = self.get_json(r["next"])
+        self.assertEqual([1], [x["build"] for x in r["runs"]])
+
     def test_project_trigger_create(self):
         self.create_projects("proj-1")
         url = "http://localhost/projects/proj-1/triggers/"
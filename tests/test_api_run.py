@@ -2,6 +2,7 @@
 # Author: Andy Doan <andy.doan@linaro.org>
 
 import contextlib
+import gzip
 import hmac
 import json
 import os
@@ -17,7 +18,16 @@ import jobserv.models
 import jobserv.storage.base
 
 from jobserv.storage import Storage
-from jobserv.models import Build, BuildStatus, Project, Run, Test, TestResult, db
+from jobserv.models import (
+    Artifact,
+    Build,
+    BuildStatus,
+    Project,
+    Run,
+    Test,
+    TestResult,
+    db,
+)
 
 from tests import JobServTest
 
@@ -81,6 +91,54 @@ class RunAPITest(JobServTest):
         self.assertEqual("FAILED", data["status"])
         self.assertEqual("FAILED", data["status_events"][0]["status"])
 
+    @patch("jobserv.api.run.Storage")
+    def test_run_artifacts_indexed(self, storage):
+        r = Run(self.build, "run0")
+        r.status = BuildStatus.RUNNING
+        db.session.add(r)
+        db.session.commit()
+        db.session.add(Artifact(r, "never-uploaded"))
+        db.session.commit()
+
+        storage().console_logfd.return_value = open("/dev/null", "w")
+        storage().get_run_definition.return_value = {}
+        storage().list_artifacts.return_value = [
+            {"name": "console.log", "size_bytes": 12},
+            {"name": "foo.bin", "size_bytes": 34},
+        ]
+        headers = [
+            ("Authorization", "Token %s" % r.api_key),
+            ("X-RUN-STATUS", "PASSED"),
+        ]
+        self._post(self.urlbase + "run0/", None, headers, 200)
+        self.assertEqual(1, storage().list_artifacts.call_count)
+
+        data = self.get_json(self.urlbase + "run0/?version=v2")["run"]
+        sizes = [x["size_bytes"] for x in data["artifacts"]]
+        self.assertEqual([12, 34], sizes)
+        self.assertTrue(data["artifacts"][1]["url"].endswith("/run0/foo.bin"))
+        # served from the index rather than storage
+        self.assertEqual(1, storage().list_artifacts.call_count)
+
+    @patch("jobserv.api.run.Storage")
+    def test_run_no_artifacts_indexed(self, storage):
+        r = Run(self.build, "run0")
+        r.status = BuildStatus.PASSED
+        db.session.add(r)
+        db.session.commit()
+        storage().list_artifacts.return_value = []
+
+        # not indexed yet, so storage is asked
+        self.get_json(self.urlbase + "run0/?version=v2")
+        self.assertEqual(1, storage().list_artifacts.call_count)
+
+        # an indexed run with no artifacts doesn't need to ask again
+        r.artifacts_indexed = True
+        db.session.commit()
+        data = self.get_json(self.urlbase + "run0/?version=v2")["run"]
+        self.assertEqual([], data["artifacts"])
+        self.assertEqual(1, storage().list_artifacts.call_count)
+
     @patch("jobserv.api.run.Storage")
     def test_run_get_definition(self, storage):
         """Ensure unauthenticated requests redact the secrets"""
@@ -164,6 +222,25 @@ class RunAPITest(JobServTest):
         db.session.refresh(r)
         self.assertEqual("RUNNING", r.status.name)
 
+    @patch("jobserv.storage.gce_storage.storage")
+    def test_run_stream_gzip(self, storage):
+        r = Run(self.build, "run0")
+        db.session.add(r)
+        db.session.commit()
+
+        headers = [
+            ("Authorization", "Token %s" % r.api_key),
+            ("Content-Encoding", "gzip"),
+        ]
+        msg = "line of output\n" * 10000
+        self._post(self.urlbase + "run0/", gzip.compress(msg.encode()), headers, 200)
+        with Storage().console_logfd(r, "r") as f:
+            self.assertEqual(msg, f.read())
+
+        self._post(self.urlbase + "run0/", b"not gzip", headers, 400)
+        headers[1] = ("Content-Encoding", "br")
+        self._post(self.urlbase + "run0/", b"foo", headers, 415)
+
     @patch("jobserv.storage.gce_storage.storage")
     def test_get_stream(self, storage):
         r = Run(self.build, "run0")
@@ -192,6 +269,29 @@ class RunAPITest(JobServTest):
         db.session.refresh(r)
         self.assertEqual("foobar-meta", r.meta)
 
+    @patch("jobserv.storage.gce_storage.storage")
+    def test_run_resources(self, storage):
+        r = Run(self.build, "run0")
+        db.session.add(r)
+        db.session.commit()
+
+        summary = {
+            "cpu_usec": 12,
+            "mem_peak_bytes": 1 << 33,
+            "io_read_bytes": 3,
+            "io_write_bytes": 4,
+        }
+        headers = [
+            ("Authorization", "Token %s" % r.api_key),
+            ("X-RUN-RESOURCES", json.dumps(summary)),
+        ]
+        self._post(self.urlbase + "run0/", "", headers, 200)
+        data = self.get_json(self.urlbase + "run0/")
+        self.assertEqual(summary, data["run"]["resources"])
+
+        headers[1] = ("X-RUN-RESOURCES", '{"cpu_usec": 1}')
+        self._post(self.urlbase + "run0/", "", headers, 400)
+
     @patch("jobserv.api.run.Storage")
     def test_upload(self, storage):
         r = Run(self.build, "run0")
@@ -204,13 +304,18 @@ class RunAPITest(JobServTest):
             ("Content-type", "application/json"),
         ]
         storage().generate_signed.return_value = {
-            "foo": "bar",
-            "blah": "bam",
+            "foo": {"url": "bar", "content-type": "text/plain"},
+            "blah": {"url": "bam", "content-type": ""},
         }
         url = self.urlbase + "run0/create_signed"
-        uploads = json.dumps(["foo", "bar"])
+        uploads = json.dumps(["foo", "blah"])
         self._post(url, uploads, headers, 200)
 
+        # the uploads are indexed but not confirmed until the run completes
+        r = Run.query.get(r.id)
+        found = [(x.path, x.content_type, x.size_bytes) for x in r.artifacts]
+        self.assertEqual([("blah", None, None), ("foo", "text/plain", None)], found)
+
     @patch("jobserv.api.run.Storage")
     @patch("jobserv.api.run.notify_build_complete_email")
     def test_run_complete_triggers(self, build_complete, storage):
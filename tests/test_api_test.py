@@ -1,6 +1,7 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import gzip
 import json
 import shutil
 import tempfile
@@ -64,6 +65,22 @@ class TestAPITest(JobServTest):
         db.session.refresh(self.test.run)
         self.assertEqual(["test1", "test2"], [x.name for x in self.test.run.tests])
 
+    def test_test_create_gzip(self):
+        headers = [
+            ("Authorization", "Token %s" % self.test.run.api_key),
+            ("Content-type", "application/json"),
+            ("Content-Encoding", "gzip"),
+        ]
+        test = {
+            "context": "junit",
+            "results": [{"name": "tr1", "status": "PASSED"}],
+        }
+        data = gzip.compress(json.dumps(test).encode())
+        self._post(self.urlbase + "test2/", data, headers)
+        t = Test.query.filter_by(name="test2").one()
+        self.assertEqual("junit", t.context)
+        self.assertEqual(["tr1"], [x.name for x in t.results])
+
     @patch("jobserv.api.run.Storage")
     def test_test_create_results(self, storage):
         headers = [
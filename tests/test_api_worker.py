@@ -1,6 +1,7 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 from gzip import compress, decompress
+import datetime
 import json
 import os
 import shutil
@@ -41,6 +42,16 @@ class WorkerAPITest(JobServTest):
         self.assertEqual(1, len(data["workers"]))
         self.assertEqual("w1", data["workers"][0]["name"])
 
+    def test_worker_list_cursor(self):
+        for x in range(3):
+            db.session.add(Worker("w%d" % x, "ubuntu", 12, 2, "aarch64", "k", 2, []))
+        db.session.commit()
+        data = self.get_json("/workers/?cursor=&limit=2")
+        self.assertEqual(["w0", "w1"], [x["name"] for x in data["workers"]])
+        data = self.get_json(data["next"])
+        self.assertEqual(["w2"], [x["name"] for x in data["workers"]])
+        self.assertNotIn("next", data)
+
     def test_worker_get(self):
         db.session.add(Worker("w1", "ubuntu", 12, 2, "aarch64", "key", 2, []))
         db.session.add(Worker("w2", "fedora", 14, 4, "amd64", "key", 1, []))
@@ -661,3 +672,131 @@ class WorkerAPITest(JobServTest):
         self.assertEqual(200, resp.status_code, resp.data)
         deletes = resp.json["data"]["volumes"]
         self.assertEqual(["proj4"], deletes)
+
+    def test_runner_download(self):
+        runner = os.path.join(jobserv.models.WORKER_DIR, "runner.whl")
+        with open(runner, "wb") as f:
+            f.write(b"wheel")
+        with patch("jobserv.api.worker.RUNNER", runner), patch(
+            "jobserv.api.worker.RUNNER_VERSION", "abc123"
+        ):
+            resp = self.client.get("/runner")
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(b"wheel", resp.data)
+            self.assertEqual('"abc123"', resp.headers["ETag"])
+
+            resp = self.client.get("/runner", headers={"If-None-Match": '"abc123"'})
+            self.assertEqual(304, resp.status_code)
+
+            resp = self.client.get("/runner", headers={"If-None-Match": '"old"'})
+            self.assertEqual(200, resp.status_code)
+
+    def test_worker_image_hints(self):
+        w = Worker("w1", "ubuntu", 12, 2, "aarch64", "key", 2, ["aarch64", "arm"])
+        w.enlisted = True
+        w.online = True
+        db.session.add(w)
+        self.create_projects("job-1")
+        b = Build.create(Project.query.all()[0])
+        for i, (tag, container) in enumerate(
+            [
+                ("aarch64", "alpine"),
+                ("amd64", "fedora"),
+                ("a*", "alpine"),
+                ("w1", "ubuntu"),
+                ("arm", None),
+                ("arm", "debian"),
+            ]
+        ):
+            r = Run(b, "run%d" % i)
+            r.host_tag = tag
+            r.container = container
+            db.session.add(r)
+        db.session.commit()
+
+        headers = [("Authorization", "Token key")]
+        data = self.get_json("/workers/w1/", headers=headers)
+        self.assertNotIn("image-hints", data["worker"])
+
+        headers.append(("X-IMAGE-HINTS", "2"))
+        data = self.get_json("/workers/w1/", headers=headers)
+        self.assertEqual(["alpine", "ubuntu"], data["worker"]["image-hints"])
+
+    @patch("jobserv.api.worker.Storage")
+    def test_worker_get_staged(self, storage):
+        if db.engine.dialect.name == "sqlite":
+            self.skipTest("Test requires MySQL")
+        rundef = {"run_url": "foo", "runner_url": "foo", "env": {}}
+        storage().get_run_definition.return_value = rundef
+        for name in ("w1", "w2"):
+            w = Worker(name, "ubuntu", 12, 2, "aarch64", "key", 2, ["aarch96"])
+            w.enlisted = True
+            w.online = True
+            db.session.add(w)
+
+        self.create_projects("job-1")
+        b = Build.create(Project.query.all()[0])
+        uploading = Run(b, "run0")
+        uploading.host_tag = "aarch96"
+        uploading.worker_name = "w1"
+        uploading.status = BuildStatus.UPLOADING
+        queued = Run(b, "run1")
+        queued.host_tag = "aarch96"
+        db.session.add(uploading)
+        db.session.add(queued)
+        db.session.commit()
+
+        headers = [("Authorization", "Token key"), ("X-PREFETCH", "1")]
+        qs = "available_runners=0&disk_free=40000000000"
+        data = self.get_json("/workers/w1/", headers=headers, query_string=qs)
+        self.assertNotIn("run-defs", data["worker"])
+        self.assertIn("staged-run-def", data["worker"])
+        run = Run.query.get(queued.id)
+        self.assertEqual(BuildStatus.QUEUED, run.status)
+        self.assertEqual("w1", run.worker_name)
+
+        # only one run gets staged at a time
+        data = self.get_json("/workers/w1/", headers=headers, query_string=qs)
+        self.assertNotIn("staged-run-def", data["worker"])
+
+        # other workers can't have it
+        qs = "available_runners=1&disk_free=40000000000"
+        data = self.get_json("/workers/w2/", headers=headers, query_string=qs)
+        self.assertNotIn("run-defs", data["worker"])
+
+        # the worker that staged it gets it when it has a slot free
+        data = self.get_json("/workers/w1/", headers=headers, query_string=qs)
+        self.assertEqual(1, len(data["worker"]["run-defs"]))
+        run = Run.query.get(queued.id)
+        self.assertEqual(BuildStatus.RUNNING, run.status)
+        self.assertIsNone(run.staged_until)
+
+    def test_worker_staged_expires(self):
+        if db.engine.dialect.name == "sqlite":
+            self.skipTest("Test requires MySQL")
+        w = Worker("w1", "ubuntu", 12, 2, "aarch64", "key", 2, ["aarch96"])
+        w.enlisted = True
+        w.online = True
+        db.session.add(w)
+        self.create_projects("job-1")
+        b = Build.create(Project.query.all()[0])
+        queued = Run(b, "run0")
+        queued.host_tag = "not-this-worker"
+        queued.worker_name = "w1"
+        queued.staged_until = datetime.datetime.utcnow() - datetime.timedelta(1)
+        db.session.add(queued)
+        # expired reservations are released when the worker stages its next run
+        uploading = Run(b, "run1")
+        uploading.status = BuildStatus.UPLOADING
+        uploading.worker_name = "w1"
+        db.session.add(uploading)
+        db.session.commit()
+
+        headers = [("Authorization", "Token key"), ("X-PREFETCH", "1")]
+        qs = "available_runners=0&disk_free=40000000000"
+        self.get_json("/workers/w1/", headers=headers, query_string=qs)
+        db.session.expire_all()
+        run = Run.query.get(queued.id)
+        self.assertEqual(BuildStatus.QUEUED, run.status)
+        self.assertIsNone(run.worker_name)
+        self.assertIsNone(run.staged_until)
@@ -0,0 +1,42 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+import datetime
+
+from unittest.mock import patch
+
+from jobserv.jsend import jsendify, jsendify_stream
+
+from tests import JobServTest
+
+
+class JsendStreamTest(JobServTest):
+    def _items(self, count):
+        for i in range(count):
+            yield {
+                "name": "item-%d" % i,
+                "ünï": i,
+                "created": datetime.datetime(2017, 1, 1, i % 24),
+            }
+
+    def test_matches_jsendify(self):
+        with self.app.test_request_context("/"):
+            for count in (0, 1, 3):
+                data = {"z": None, "items": list(self._items(count)), "a": {"b": []}}
+                expected = jsendify(data).get_data()
+                data["items"] = self._items(count)
+                resp = jsendify_stream(data)
+                self.assertTrue(resp.is_streamed)
+                self.assertEqual(expected, resp.get_data())
+
+            expected = jsendify(list(self._items(2))).get_data()
+            self.assertEqual(expected, jsendify_stream(self._items(2)).get_data())
+
+    @patch("jobserv.jsend.STREAM_CHUNK", 1024)
+    def test_chunks(self):
+        with self.app.test_request_context("/"):
+            resp = jsendify_stream({"items": self._items(300)})
+            chunks = list(resp.response)
+            self.assertGreater(len(chunks), 2)
+            data = jsendify({"items": list(self._items(300))}).get_data()
+            self.assertEqual(data.decode(), "".join(chunks))
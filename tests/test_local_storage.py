@@ -1,6 +1,7 @@
 # Copyright (C) 2017 Linaro Limited
 # Author: Andy Doan <andy.doan@linaro.org>
 
+import hashlib
 import json
 import os
 import shutil
@@ -101,3 +102,113 @@ class LocalStorageTest(JobServTest):
         db.session.commit()
         r = self.client.get("/projects/local-1/builds/1/runs/run1/foo.txt")
         self.assertEqual((200, b"foo-content"), (r.status_code, r.data))
+
+    @mock.patch("jobserv.storage.base.CONSOLE_SEGMENT_BYTES", 4)
+    def test_copy_log_segments(self):
+        jobs_dir = os.path.join(self.tmpdir, "jobs")
+        with mock.patch("jobserv.storage.base.JOBS_DIR", jobs_dir):
+            with self.storage.console_logfd(self.run, "a") as f:
+                f.write("0123456789")
+            src, state = self.storage._log_segments_state(self.run)
+            base = self.storage._get_run_path(self.run)
+            self.storage._ship_log_segments_bg(src, state, base)
+
+            # only complete segments get shipped while the run is active
+            segments = os.path.join(self.tmpdir, base, ".console.log.d")
+            self.assertEqual(["00000", "00001"], sorted(os.listdir(segments)))
+            self.assertEqual([], list(self.storage.list_artifacts(self.run)))
+
+            with self.storage.console_logfd(self.run, "a") as f:
+                f.write("abc")
+            self.storage.copy_log(self.run)
+
+        p = os.path.join(base, "console.log")
+        self.assertEqual("0123456789abc", self.storage._get_as_string(p))
+        self.assertFalse(os.path.exists(segments))
+        self.assertFalse(os.path.exists(src))
+        self.assertFalse(os.path.exists(state))
+
+    @mock.patch("jobserv.storage.base.CONSOLE_SEGMENT_BYTES", 4)
+    @mock.patch("jobserv.storage.base._get_segment_shipper")
+    def test_ship_log_segments_queued(self, shipper):
+        jobs_dir = os.path.join(self.tmpdir, "jobs")
+        with mock.patch("jobserv.storage.base.JOBS_DIR", jobs_dir):
+            with self.storage.console_logfd(self.run, "a") as f:
+                f.write("0123456789")
+            self.storage.ship_log_segments(self.run)
+            self.storage.ship_log_segments(self.run)
+            # only one upload is queued at a time
+            self.assertEqual(1, shipper().submit.call_count)
+
+            fn, *args = shipper().submit.call_args[0]
+            fn(*args)
+            with self.storage.console_logfd(self.run, "a") as f:
+                f.write("abcdef")
+            self.storage.ship_log_segments(self.run)
+            self.assertEqual(2, shipper().submit.call_count)
+
+    @mock.patch("jobserv.storage.base._get_segment_shipper")
+    @mock.patch("jobserv.api.run.Storage")
+    def test_upload_dedup(self, storage, shipper):
+        storage.return_value = self.storage
+        shipper().submit.side_effect = lambda fn, *args: fn(*args)
+        jobs_dir = os.path.join(self.tmpdir, "jobs")
+        self.run.status = BuildStatus.RUNNING
+        b = Build(self.proj, 2)
+        db.session.add(b)
+        db.session.flush()
+        run2 = Run(b, "run1")
+        run2.status = BuildStatus.RUNNING
+        db.session.add(run2)
+        db.session.commit()
+
+        content = b"firmware" * 100
+        digest = {
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "md5": hashlib.md5(content).hexdigest(),
+        }
+        key = "%s-%s" % (digest["sha256"], digest["md5"])
+        bad = {"sha256": "0" * 64, "md5": "0" * 32}
+        uploads = json.dumps({"fw.img": digest, "bad.img": bad, "f.txt": None})
+
+        headers = [
+            ("Authorization", "Token %s" % self.run.api_key),
+            ("Content-type", "application/json"),
+        ]
+        url = "/projects/local-1/builds/1/runs/run1/create_signed"
+        with mock.patch("jobserv.storage.base.JOBS_DIR", jobs_dir):
+            r = self.client.post(url, data=uploads, headers=headers)
+            self.assertEqual(200, r.status_code, r.data)
+            urls = json.loads(r.data.decode())["data"]["urls"]
+            for name in ("fw.img", "bad.img"):
+                headers = {"Content-type": urls[name]["content-type"]}
+                r = self.client.put(urls[name]["url"], data=content, headers=headers)
+                self.assertEqual(200, r.status_code, r.data)
+            self.storage.copy_log(self.run)
+
+        # only the blob that matched its hash was indexed
+        blobs = os.path.join(self.tmpdir, "local-1", ".blobs")
+        self.assertEqual([key], os.listdir(blobs))
+        fw = os.path.join(self.storage._get_run_path(self.run), "fw.img")
+        self.assertEqual(fw, self.storage._get_as_string("local-1/.blobs/" + key))
+
+        headers = [
+            ("Authorization", "Token %s" % run2.api_key),
+            ("Content-type", "application/json"),
+        ]
+        url = "/projects/local-1/builds/2/runs/run1/create_signed"
+        with mock.patch("jobserv.storage.base.JOBS_DIR", jobs_dir):
+            r = self.client.post(url, data=uploads, headers=headers)
+        self.assertEqual(200, r.status_code, r.data)
+        urls = json.loads(r.data.decode())["data"]["urls"]
+        self.assertEqual({"stored": True}, urls["fw.img"])
+        self.assertIn("url", urls["bad.img"])
+        self.assertIn("url", urls["f.txt"])
+        p = os.path.join(self.storage._get_run_path(run2), "fw.img")
+        self.assertEqual(content, self.storage._get_raw(p))
+
+        # the index entry goes away with the build it points at
+        self.storage.delete_build(self.build)
+        self.storage.prune_blobs("local-1")
+        self.assertFalse(os.path.exists(os.path.join(blobs, key)))
+        self.assertEqual(content, self.storage._get_raw(p))
@@ -254,6 +254,34 @@ class RunTest(JobServTest):
             ["QUEUED", "FAILED"], [x.status.name for x in self.build.status_events]
         )
 
+    def test_status_times(self):
+        r = Run(self.build, "name1")
+        db.session.add(r)
+        db.session.commit()
+        self.assertIsNotNone(r.created)
+        self.assertEqual(self.build.status_events[0].time, self.build.created)
+
+        r.set_status(BuildStatus.RUNNING)
+        db.session.commit()
+        self.assertEqual(r.status_events[-1].time, r.started)
+        self.assertEqual(self.build.status_events[-1].time, self.build.started)
+        self.assertIsNone(r.completed)
+        self.assertIsNone(self.build.completed)
+
+        r.set_status(BuildStatus.PASSED)
+        db.session.commit()
+        self.assertEqual(r.status_events[-1].time, r.completed)
+        self.assertEqual(self.build.status_events[-1].time, self.build.completed)
+        data = r.as_json()
+        self.assertEqual(r.completed, data["completed"])
+
+        # a rerun starts over
+        r.set_status(BuildStatus.QUEUED)
+        db.session.commit()
+        self.assertIsNone(r.started)
+        self.assertIsNone(r.completed)
+        self.assertIsNone(self.build.completed)
+
 
 class TestsTest(JobServTest):
     def setUp(self):
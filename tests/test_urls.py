@@ -0,0 +1,39 @@
+# Copyright (C) 2017 Linaro Limited
+# Author: Andy Doan <andy.doan@linaro.org>
+
+from flask import url_for
+
+from jobserv.urls import external_url
+
+from tests import JobServTest
+
+
+class ExternalUrlTest(JobServTest):
+    def test_matches_url_for(self):
+        names = ["simple", "with space", "a/b", "{braces}", "100%", "ünï", "?&#"]
+        bases = ["http://localhost/", "https://example.com:8443/prefix/"]
+        for base in bases:
+            with self.app.test_request_context("/", base_url=base):
+                for name in names:
+                    values = [
+                        ("api_project.project_get", {"proj": name}),
+                        ("api_build.build_get", {"proj": name, "build_id": 12}),
+                        (
+                            "api_run.run_get_artifact",
+                            {"proj": name, "build_id": 1, "run": name, "path": name},
+                        ),
+                        (
+                            "api_test.test_get",
+                            {"proj": name, "build_id": 1, "run": name, "test": name},
+                        ),
+                        ("api_worker.worker_get", {"name": name}),
+                    ]
+                    for endpoint, args in values:
+                        expected = url_for(endpoint, _external=True, **args)
+                        self.assertEqual(expected, external_url(endpoint, **args))
+
+    def test_unknown_values(self):
+        # anything url_for would add as a query string goes through url_for
+        with self.app.test_request_context("/"):
+            url = external_url("api_project.project_get", proj="foo", x="1")
+        self.assertEqual("http://localhost/projects/foo/?x=1", url)